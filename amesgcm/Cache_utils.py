@@ -0,0 +1,99 @@
+import os
+import hashlib
+import numpy as np
+#=========================================================================
+#============On-disk cache for arrays reused across runs==================
+#=========================================================================
+
+#Name of the cache directory, created next to the data
+cache_dirname='.amesgcm_cache'
+
+def cache_dir(filename):
+    '''
+    Return the cache directory for a data file, e.g. /path/to/data/.amesgcm_cache for /path/to/data/00010.atmos_daily.nc
+    '''
+    return os.path.join(os.path.dirname(os.path.abspath(filename)),cache_dirname)
+
+def hash_arrays(*arrays,**kwargs):
+    '''
+    Content-addressed key for a set of arrays and parameters.
+    Args:
+        *arrays : numpy arrays (or masked arrays), e.g. pk, bk, ps, temp
+        **kwargs: other parameters, e.g. interp_type='pstd'. They are converted to strings
+    Returns:
+        key (str): hexadecimal digest, identical only if all the inputs are identical
+    ***NOTE***
+    The shape and data type are included so the same bytes with a different layout give a different key.
+    For masked arrays, the mask is included as well.
+    '''
+    h=hashlib.sha1()
+    for arr in arrays:
+        arr=np.asanyarray(arr)
+        h.update(str((arr.shape,arr.dtype.str)).encode())
+        h.update(np.ascontiguousarray(np.ma.getdata(arr)).tobytes())
+        if np.ma.is_masked(arr):h.update(np.packbits(np.ma.getmaskarray(arr)).tobytes())
+    for name in sorted(kwargs.keys()):
+        h.update(('%s=%s;'%(name,kwargs[name])).encode())
+    return h.hexdigest()
+
+def cache_load(cache_path,key):
+    '''
+    Load arrays from the cache.
+    Args:
+        cache_path (str): cache directory, see cache_dir()
+        key (str)       : key from hash_arrays()
+    Returns:
+        arrays (dict): arrays saved with cache_save() or None if the key is not in the cache
+    '''
+    name=os.path.join(cache_path,key+'.npz')
+    try:
+        with np.load(name) as f:
+            arrays={iname:f[iname] for iname in f.files}
+    except (OSError,ValueError):
+        #Not in the cache, or a corrupted file
+        return None
+    #Update the access time, used for the least-recently-used eviction
+    try:
+        os.utime(name)
+    except OSError:
+        pass
+    return arrays
+
+def cache_save(cache_path,key,max_size=2000.,**arrays):
+    '''
+    Save arrays to the cache, and evict the least recently used entries if the cache grows above max_size.
+    Args:
+        cache_path (str): cache directory, see cache_dir(). It is created if needed
+        key (str)       : key from hash_arrays()
+        max_size (float): maximum size of the cache in [MB]
+        **arrays        : arrays to save, e.g. index=index
+    ***NOTE***
+    The file is written under a temporary name and then renamed, so concurrent jobs never read a partial entry.
+    '''
+    os.makedirs(cache_path,exist_ok=True)
+    name=os.path.join(cache_path,key+'.npz')
+    name_tmp=os.path.join(cache_path,'%s_%i.tmp.npz'%(key,os.getpid()))
+    np.savez(name_tmp,**arrays)
+    os.replace(name_tmp,name)
+    cache_evict(cache_path,max_size)
+
+def cache_evict(cache_path,max_size=2000.):
+    '''
+    Remove the least recently used entries until the cache is smaller than max_size [MB].
+    '''
+    entries=[]
+    for iname in os.listdir(cache_path):
+        if iname.endswith('.npz') and not iname.endswith('.tmp.npz'):
+            try:
+                stat=os.stat(os.path.join(cache_path,iname))
+                entries.append((stat.st_mtime,stat.st_size,iname))
+            except OSError:
+                pass #Removed by another job in the meantime
+    total=sum([e[1] for e in entries])
+    for _,size,iname in sorted(entries):
+        if total<=max_size*1.e6:break
+        try:
+            os.remove(os.path.join(cache_path,iname))
+        except OSError:
+            pass
+        total-=size
@@ -3,7 +3,29 @@ from netCDF4 import Dataset
 import os
 import warnings #Suppress certain errors when dealing with NaN arrays
 
-def fms_press_calc(psfc,ak,bk,lev_type='full'):
+#===Working precision===
+#Floating point type for the intermediate arrays. The files are written in single precision ('f4' in Ncdf_wrapper) so
+#float32 halves the memory compared to float64 and the results are written with no conversion. See set_precision()
+work_dtype=np.float32
+
+def set_precision(precision='float32'):
+    '''
+    Set the working precision of the computations in FV3_utils.
+    Args:
+        precision (str): 'float32' (default) or 'float64'
+    '''
+    global work_dtype
+    if precision not in ['float32','float64']:
+        raise Exception("""Precision not recognized: use 'float32' or 'float64' """)
+    work_dtype=np.dtype(precision).type
+
+def get_dtype(dtype=None):
+    '''
+    Return the working precision, unless a data type is explicitly requested.
+    '''
+    return work_dtype if dtype is None else dtype
+
+def fms_press_calc(psfc,ak,bk,lev_type='full',out=None,dtype=None):
     """
     Return the 3d pressure field from the surface pressure and the ak/bk coefficients.
 
@@ -13,6 +35,8 @@ def fms_press_calc(psfc,ak,bk,lev_type='full'):
         bk: 2nd vertical coordinate parameter
         lev_type: "full" (centers of the levels) or "half" (layer interfaces)
                   Default is "full"
+        out: optional, array of size (Nk-1,psfc.shape) (resp. Nk) where the result is written
+        dtype: floating point type for the calculation, default is the working precision (see set_precision())
     Returns:
         The 3D pressure field at the full PRESS_f(Nk-1:,:,:) or half levels PRESS_h(Nk,:,:,) in [Pa]
     --- 0 --- TOP        ========  p_half
@@ -34,43 +58,57 @@ def fms_press_calc(psfc,ak,bk,lev_type='full'):
     Nk=len(ak)
     # If psfc is a float (e.g. psfc=700.) make it a one element array (e.g. psfc=[700])
     if len(np.atleast_1d(psfc))==1: psfc=np.array([np.squeeze(psfc)])
+    psfc=np.asarray(psfc)
 
-    #Flatten the pressure array to generalize to N dimensions
-    psfc_flat=psfc.flatten()
+    PRESS_h,PRESS_f=_press_half_full(psfc.reshape(-1),ak,bk,dtype)
 
-    # Expands the dimensions vectorized calculations:
-    psfc_v=np.repeat(psfc_flat[:,np.newaxis],Nk, axis=1)    #(Np) ->(Np,Nk)
-    ak_v=np.repeat(ak[np.newaxis,:],len(psfc_flat), axis=0) #(Nk) ->(Np,Nk)
-    bk_v=np.repeat(bk[np.newaxis,:],1, axis=0)              #(Nk) ->(1, Nk)
+    # The pressure is computed with the vertical axis first, reshape PRESS(Nk,:)
+    # to the original pressure shape PRESS(Nk,:,:,:) (resp. Nk-1)
+    if lev_type=="full":
+        new_dim_f=np.append(Nk-1,psfc.shape)
+        PRESS_out=PRESS_f.reshape(new_dim_f)
+    elif lev_type=="half" :
+        new_dim_h=np.append(Nk,psfc.shape)
+        PRESS_out=PRESS_h.reshape(new_dim_h)
+    else:
+        raise Exception("""Pressure levels type not recognized in press_lev(): use 'full' or 'half' """)
+    if out is not None:
+        out[...]=PRESS_out
+        return out
+    return np.squeeze(PRESS_out)
 
+def _press_half_full(psfc_flat,ak,bk,dtype=None):
+    '''
+    Pressure at the half and full levels for a flat array of surface pressure, used by fms_press_calc() and fms_Z_calc().
+    Args:
+        psfc_flat: 1D array of surface pressure [Pa], size Np
+        ak,bk    : vertical coordinate parameters, size Nk
+        dtype    : floating point type for the calculation, default is the working precision
+    Returns:
+        PRESS_h  : pressure at the half levels, size (Nk,Np)
+        PRESS_f  : pressure at the full levels, size (Nk-1,Np)
+    ***NOTE***
+    The vertical axis is first and the (Nk,Np) arrays are obtained by broadcasting ak, bk and psfc, no repeated copies are made.
+    '''
+    dtype=get_dtype(dtype)
+    ak=np.asarray(ak,dtype);bk=np.asarray(bk,dtype);psfc_flat=np.asarray(psfc_flat,dtype)
     #Pressure at half level = layers interfaces. The size of z axis is Nk
-    PRESS_h=psfc_v*bk_v+ak_v
+    PRESS_h=psfc_flat[np.newaxis,:]*bk[:,np.newaxis]+ak[:,np.newaxis]
 
     #Pressure at full levels = centers of the levels. The size of z axis is Nk-1
-    PRESS_f=np.zeros((len(psfc_flat),Nk-1))
+    PRESS_f=np.zeros((len(ak)-1,len(psfc_flat)),dtype)
     #Top layer (1st element is i=0 in Python)
     if ak[0]==0 and bk[0]==0:
-        PRESS_f[:,0]= 0.5*(PRESS_h[:,0]+PRESS_h[:,1])
+        PRESS_f[0,:]= 0.5*(PRESS_h[0,:]+PRESS_h[1,:])
     else:
-        PRESS_f[:,0] = (PRESS_h[:,1]-PRESS_h[:,0])/np.log(PRESS_h[:,1]/PRESS_h[:,0])
+        PRESS_f[0,:] = (PRESS_h[1,:]-PRESS_h[0,:])/np.log(PRESS_h[1,:]/PRESS_h[0,:])
 
     #Rest of the column (i=1..Nk).
     #[2:] goes from the 3rd element to Nk and [1:-1] goes from the 2nd element to Nk-1
-    PRESS_f[:,1:]= (PRESS_h[:,2:]-PRESS_h[:,1:-1])/np.log(PRESS_h[:,2:]/PRESS_h[:,1:-1])
-
-    # First transpose PRESS(:,Nk) to PRESS(Nk,:), then reshape PRESS(Nk,:)
-    # to the original pressure shape PRESS(Nk,:,:,:) (resp. Nk-1)
+    PRESS_f[1:,:]= (PRESS_h[2:,:]-PRESS_h[1:-1,:])/np.log(PRESS_h[2:,:]/PRESS_h[1:-1,:])
+    return PRESS_h,PRESS_f
 
-    if lev_type=="full":
-        new_dim_f=np.append(Nk-1,psfc.shape)
-        return np.squeeze(PRESS_f.T.reshape(new_dim_f))
-    elif lev_type=="half" :
-        new_dim_h=np.append(Nk,psfc.shape)
-        return np.squeeze(PRESS_h.T.reshape(new_dim_h))
-    else:
-        raise Exception("""Pressure levels type not recognized in press_lev(): use 'full' or 'half' """)
-
-def fms_Z_calc(psfc,ak,bk,T,topo=0.,lev_type='full'):
+def fms_Z_calc(psfc,ak,bk,T,topo=0.,lev_type='full',out=None,dtype=None):
     """
     Return the 3d altitude field in [m] above ground level or above aeroid.
 
@@ -82,6 +120,8 @@ def fms_Z_calc(psfc,ak,bk,T,topo=0.,lev_type='full'):
         topo: the surface elevation, same dimension as psfc. If none is provided, the height above ground level (agl) is returned
         lev_type: "full" (centers of the levels) or "half" (layer interfaces)
                   Default is "full"
+        out: optional, array of size (Nk-1,psfc.shape) (resp. Nk) where the result is written
+        dtype: floating point type for the calculation, default is the working precision (see set_precision())
     Returns:
         The layers' altitude  at the full Z_f(:,:,Nk-1) or half levels Z_h(:,:,Nk) in [m]
         Z_f and Z_h are AGL if topo is None, and above aeroid if topo is provided
@@ -133,55 +173,76 @@ def fms_Z_calc(psfc,ak,bk,T,topo=0.,lev_type='full'):
     Using the isentropic relation above:
      => Z_full = Z_half[k+1]+ (R Tfull[k])/(gγ)(p_half[k+1]/p_full[k])**(R/Cp)-1)
     """
+    return fms_press_Z_calc(psfc,ak,bk,T,topo,lev_type,out_z=out,dtype=dtype)[1]
+
+def fms_press_Z_calc(psfc,ak,bk,T,topo=0.,lev_type='full',out_p=None,out_z=None,dtype=None):
+    '''
+    Fused pressure and altitude calculation: return both the 3d pressure and the 3d altitude fields in one pass.
+    Args:
+        psfc,ak,bk,T,topo,lev_type,dtype: same as fms_Z_calc()
+        out_p: optional, array of size (Nk-1,psfc.shape) (resp. Nk) where the pressure is written
+        out_z: optional, array of size (Nk-1,psfc.shape) (resp. Nk) where the altitude is written
+    Returns:
+        PRESS: the pressure at the full or half levels in [Pa], same as fms_press_calc() but not squeezed
+        Z    : the altitude at the full or half levels in [m], same as fms_Z_calc()
+    ***NOTE***
+    The half and full pressure levels are only computed once and the hydrostatic integration from the surface is done
+    as a cumulative sum of the layers' thickness, with no loop over the levels. See fms_Z_calc() for the equations.
+    '''
     g=3.72 #acc. m/s2
     r_co2= 191.00 # kg/mol
     Nk=len(ak)
-    #===get the half and full pressure levels from fms_press_calc==
-
-    PRESS_f=fms_press_calc(psfc,ak,bk,'full') #Z axis is first
-    PRESS_h=fms_press_calc(psfc,ak,bk,'half') #Z axis is first
+    dtype=get_dtype(dtype)
 
     # If psfc is a float, turn it into a one-element array:
     if len(np.atleast_1d(psfc))==1:
         psfc=np.array([np.squeeze(psfc)])
     if len(np.atleast_1d(topo))==1:
         topo=np.array([np.squeeze(topo)])
+    psfc=np.asarray(psfc)
 
-    psfc_flat=psfc.flatten()
-    topo_flat=topo.flatten()
-
-    #  reshape arrays for vector calculations and compute the log pressure====
-
-    PRESS_h=PRESS_h.reshape((Nk  ,len(psfc_flat)))
-    PRESS_f=PRESS_f.reshape((Nk-1,len(psfc_flat)))
-    T=T.reshape((Nk-1,len(psfc_flat)))
+    psfc_flat=psfc.reshape(-1)
+    Np=len(psfc_flat)
+    topo_flat=np.broadcast_to(np.ma.getdata(topo).reshape(-1),(Np,)).astype(dtype,copy=False)
 
-    logPPRESS_h=np.log(PRESS_h)
+    #===get the half and full pressure levels, the vertical axis is first===
+    PRESS_h,PRESS_f=_press_half_full(psfc_flat,ak,bk,dtype)
+    T=np.ma.getdata(T).astype(dtype,copy=False).reshape((Nk-1,Np))
 
-    #===Initialize the output arrays===
-    Z_f=np.zeros((Nk-1,len(psfc_flat)))
-    Z_h=np.zeros((Nk  ,len(psfc_flat)))
+    #The top interface is at 0 Pa when ak[0]=bk[0]=0, log(0) is -inf
+    with np.errstate(divide='ignore'):
+        logPPRESS_h=np.log(PRESS_h)
 
-    #First half layer is equal to the surface elevation
+    #Layers' thickness. Isothermal within  the layer, we have Z=Z0+r*T0/g*ln(P0/P)
+    DZ=(r_co2*T/g)*(logPPRESS_h[1:,:]-logPPRESS_h[:-1,:])
+    #The thickness of a top layer starting at 0 Pa is set to 0, so the top altitude stays finite
+    DZ[0,PRESS_h[0,:]==0]=0.
 
-    Z_h[-1,:] = topo_flat
-
-    # Other layers, from the bottom-up:
-    #Isothermal within  the layer, we have Z=Z0+r*T0/g*ln(P0/P)
-    for k in range(Nk-2,-1,-1):
-        Z_h[k,:] = Z_h[k+1,:]+(r_co2*T[k,:]/g)*(logPPRESS_h[k+1,:]-logPPRESS_h[k,:])
-        Z_f[k,:] = Z_h[k+1,:]+(r_co2*T[k,:]/g)*(1-PRESS_h[k,:]/PRESS_f[k,:])
+    #First half layer is equal to the surface elevation. Other layers, from the bottom-up, are the cumulative sum
+    #of the thickness: Z_h[::-1]=cumsum([topo,DZ[Nk-2],...,DZ[0]])
+    Z_h=np.empty((Nk,Np),dtype)
+    Z_h[-1,:]=topo_flat
+    Z_h[:-1,:]=DZ
+    np.cumsum(Z_h[::-1,:],axis=0,out=Z_h[::-1,:])
 
     #return the arrays
     if lev_type=="full":
-        new_dim_f=np.append(Nk-1,psfc.shape)
-        return Z_f.reshape(new_dim_f)
+        Z_f=Z_h[1:,:]+(r_co2*T/g)*(1-PRESS_h[:-1,:]/PRESS_f)
+        new_dim=np.append(Nk-1,psfc.shape)
+        PRESS_out,Z_out=PRESS_f.reshape(new_dim),Z_f.reshape(new_dim)
     elif lev_type=="half" :
-        new_dim_h=np.append(Nk,psfc.shape)
-        return  Z_h.reshape(new_dim_h)
+        new_dim=np.append(Nk,psfc.shape)
+        PRESS_out,Z_out=PRESS_h.reshape(new_dim),Z_h.reshape(new_dim)
     #=====return the levels in Z coordinates [m]====
     else:
         raise Exception("""Altitudes levels type not recognized: use 'full' or 'half' """)
+    if out_p is not None:
+        out_p[...]=PRESS_out
+        PRESS_out=out_p
+    if out_z is not None:
+        out_z[...]=Z_out
+        Z_out=out_z
+    return PRESS_out,Z_out
 
 #TODO : delete: ==========Former version of find_n() : only provides 1D >1D and ND > 1D mapping=======
 def find_n0(Lfull_IN,Llev_OUT,reverse_input=False):
@@ -259,8 +320,8 @@ def find_n(X_IN,X_OUT,reverse_input=False,modulo=None):
     N_OUT=dimsOUT[0]
 
     #Number of element in arrays other than interpolation axis
-    NdimsIN=np.int(np.prod(dimsIN[1:]))
-    NdimsOUT=np.int(np.prod(dimsOUT[1:]))
+    NdimsIN=int(np.prod(dimsIN[1:]))
+    NdimsOUT=int(np.prod(dimsOUT[1:]))
 
     if (NdimsIN >1 and NdimsOUT> 1) and (NdimsIN !=NdimsOUT):
         print('*** Error in find_n(): dimensions of arrays other than the interpolated (first) axis must be 1 or identical***')
@@ -274,28 +335,47 @@ def find_n(X_IN,X_OUT,reverse_input=False,modulo=None):
     #Reverse input array if monotically decreasing
     if reverse_input:X_IN=X_IN[::-1,:]
 
-    n=np.zeros((N_OUT,Ndim),dtype=int)
-
-    #Some repetition below but that allows to keep the 'if' statement out of the big loop over all array elements
     if len(dimsIN)==1:
-        for i in range(N_OUT):
-            for j in range(Ndim):
-                n[i,j]=np.argmin(np.abs(X_OUT[i,j]-X_IN[:]))
-                if X_IN[n[i,j]]>X_OUT[i,j]:n[i,j]=n[i,j]-1
-    elif len(dimsOUT)==1:
-        for i in range(N_OUT):
-            for j in range(Ndim):
-                n[i,j]=np.argmin(np.abs(X_OUT[i]-X_IN[:,j]))
-                if X_IN[n[i,j],j]>X_OUT[i]:n[i,j]=n[i,j]-1
+        #1D input: a single sorted array is shared by all the columns, use numpy's binary search directly
+        n=np.searchsorted(X_IN[:,0],X_OUT,side='right')-1
+        n=np.broadcast_to(n,(N_OUT,Ndim)).copy()
     else:
-        for i in range(N_OUT):
-            for j in range(Ndim):
-                n[i,j]=np.argmin(np.abs(X_OUT[i,j]-X_IN[:,j]))
-                if X_IN[n[i,j],j]>X_OUT[i,j]:n[i,j]=n[i,j]-1
+        n=_bracket_index(X_IN,X_OUT)
 
     if len(dimsOUT)==1: n=np.squeeze(n)
     return n
 
+def _bracket_index(X_IN,X_OUT):
+    '''
+    Vectorized binary search used by find_n(): for each column j, return the index of the last element in X_IN[:,j] that is
+    smaller or equal to X_OUT[i,j], or -1 if the first element of the column is already above that value.
+    Args:
+        X_IN  (2D array): source levels, size (N_IN,NdimsIN) sorted along the first axis, with NdimsIN=1 or Ndim
+        X_OUT (2D array): desired levels, size (N_OUT,NdimsOUT) with NdimsOUT=1 or Ndim
+    Returns:
+        n (2D array): indices, size (N_OUT,Ndim)
+    ***NOTE***
+    All the columns are searched at once, so the Python loop is only over the log2(N_IN) bisection steps:
+    >>> this is the vectorized equivalent of calling np.searchsorted(X_IN[:,j],X_OUT[i,j],side='right')-1 on each column
+    '''
+    N_IN,NdimsIN=X_IN.shape
+    N_OUT,NdimsOUT=X_OUT.shape
+    Ndim=max(NdimsIN,NdimsOUT)
+    #Column number in the flattened X_IN, e.g. [0,1,...Ndim-1] or [0,0,...,0] if X_IN is the same for all columns
+    col=np.arange(Ndim) if NdimsIN>1 else np.zeros(Ndim,dtype=int)
+    X_IN_flat=X_IN.ravel()
+
+    lo=np.zeros((N_OUT,Ndim),dtype=int)        #lower bound (inclusive)
+    hi=np.full((N_OUT,Ndim),N_IN,dtype=int)    #upper bound (exclusive)
+    for _ in range(int(np.ceil(np.log2(N_IN+1)))):
+        mid=(lo+hi)//2
+        #Elements where lo=hi are converged, clip the index so it stays within the array
+        below=X_IN_flat[np.minimum(mid,N_IN-1)*NdimsIN+col]<=X_OUT
+        active=lo<hi
+        lo=np.where(active & below ,mid+1,lo)
+        hi=np.where(active & ~below,mid  ,hi)
+    return lo-1
+
 def expand_index(Nindex,VAR_shape_axis_FIRST,axis_list):
     '''
     Repeat interpolation indices along an axis.
@@ -333,7 +413,7 @@ def expand_index(Nindex,VAR_shape_axis_FIRST,axis_list):
     #Return the new, flattened version of Nindex
     return Nindex.reshape(dimsOUT_flat)
 
-def vinterp(varIN,Lfull,Llev,type_int='log',reverse_input=False,masktop=True,index=None):
+def vinterp(varIN,Lfull,Llev,type_int='log',reverse_input=False,masktop=True,index=None,dtype=None):
     '''
     Vertical linear or logarithmic interpolation for pressure or altitude.   Alex Kling 5-27-20
     Args:
@@ -345,6 +425,7 @@ def vinterp(varIN,Lfull,Llev,type_int='log',reverse_input=False,masktop=True,ind
         masktop: set to NaN values if above the model top
         index: indices for the interpolation, already processed as [klev,Ndim]
                Indices will be recalculated if not provided.
+        dtype: floating point type for the calculation, default is the working precision (see set_precision())
     Returns:
         varOUT: variable interpolated on the Llev pressure or altitude levels
 
@@ -367,74 +448,101 @@ def vinterp(varIN,Lfull,Llev,type_int='log',reverse_input=False,masktop=True,ind
 
 
     '''
+    weights=vinterp_weights(Lfull,Llev,type_int,reverse_input,masktop,index,dtype=dtype)
+    return vinterp_apply(varIN,weights)
+
+def vinterp_weights(Lfull,Llev,type_int='log',reverse_input=False,masktop=True,index=None,permut=None,dtype=None):
+    '''
+    Pre-compute the vertical interpolation from the Lfull levels to the Llev levels as a compact operator, which can then be
+    applied to any variable on the same grid with vinterp_apply(). This is what vinterp() does for a single variable.
+    Args:
+        Lfull: pressure [Pa] or altitude [m] at full layers (N-dimensional array with VERTICAL AXIS FIRST)
+        Llev : desired level for interpolation as a 1D array in [Pa] or [m]
+        type_int, reverse_input, masktop, index, dtype: same as vinterp()
+        permut: if provided, Lfull is permuted from the variables by .transpose(permut), e.g. permut=[1,0,2,3] for (time,lev,lat,lon) variables.
+                The operator then applies directly to the variables in their original order, without transposing them.
+    Returns:
+        weights: (nindex,nindexp1,alpha) with nindex,nindexp1 the flat indices of the layers n and n+1 in the variable, and alpha the weight
+                 of layer n, all with size (Nlev,Lfull.shape[1:]). alpha is NaN where the values are not defined
+    ***NOTE***
+    The interpolated variable is simply varOUT= varIN.flat[nindex]*alpha + (1-alpha)*varIN.flat[nindexp1]
+    '''
+    dtype=get_dtype(dtype)
     #Special case where only 1 layer is requested
     Nlev=len(np.atleast_1d(Llev))
-    if Nlev==1:Llev=np.array([Llev])
+    Llev=np.reshape(Llev,Nlev).astype(dtype)
+    Lfull=np.asarray(Lfull,dtype)
 
-    dimsIN=varIN.shape               #get input variable dimensions
-    Nfull=dimsIN[0]
-
-    #Special case where varIN and Lfull are a single profile
-    if len(varIN.shape )==1:varIN=varIN.reshape([Nfull,1])
-    if len(Lfull.shape )==1:Lfull=Lfull.reshape([Nfull,1])
-
-    dimsIN=varIN.shape       #repeat in case varIN and Lfull were reshaped
+    #Special case where Lfull is a single profile
+    if len(Lfull.shape)==1:Lfull=Lfull.reshape([Lfull.shape[0],1])
 
+    dimsIN=Lfull.shape
+    Nfull=dimsIN[0]
     dimsOUT=tuple(np.append(Nlev,dimsIN[1:]))
-    Ndim= np.int(np.prod(dimsIN[1:]))          #Ndim is the product  of all dimensions but the vertical axis
-    varIN= np.reshape(varIN, (Nfull, Ndim))    #flatten the other dimensions to (Nfull, Ndim)
+    Ndim= int(np.prod(dimsIN[1:]))              #Ndim is the product  of all dimensions but the vertical axis
     Lfull= np.reshape(Lfull, (Nfull, Ndim) )   #flatten the other dimensions to (Nfull, Ndim)
-    varOUT=np.zeros((Nlev, Ndim))
     Ndimall=np.arange(0,Ndim)                   #all indices (does not change)
 
-    #
-    if reverse_input:
-        Lfull=Lfull[::-1,:]
-        varIN=varIN[::-1,:]
-
-    for k in range(0,Nlev):
-        #Find nearest layer to Llev[k]
-        if np.any(index):
-            #index have been pre-computed:
-            n= index[k,:]
-        else:
-            # Compute index on the fly for that layer.
-            # Note that reversed_input is always set to False as if desired, Lfull was reversed earlier
-            n= np.squeeze(find_n(Lfull,Llev[k],False))
-        #==Slower method (but explains what is done below): loop over Ndim======
-        # for ii in range(Ndim):
-        #     if n[ii]<Nfull-1:
-        #         alpha=np.log(Llev[k]/Lfull[n[ii]+1,ii])/np.log(Lfull[n[ii],ii]/Lfull[n[ii]+1,ii])
-        #         varOUT[k,ii]=varIN[n[ii],ii]*alpha+(1-alpha)*varIN[n[ii]+1,ii]
-
-        #=================    Fast method  no loop  =======================
-        #Convert the layers n to indexes, for a 2D matrix using nindex=i*ncol+j
-        nindex  =    n*Ndim+Ndimall  # n
-        nindexp1=(n+1)*Ndim+Ndimall  # n+1
-
-        #initialize alpha, size is [Ndim]
-        alpha=np.NaN*Ndimall
-        #Only calculate alpha  where the indices are <Nfull
-        Ndo=Ndimall[nindexp1<Nfull*Ndim]
-        if type_int=='log':
-            alpha[Ndo]=np.log(Llev[k]/Lfull.flatten()[nindexp1[Ndo]])/np.log(Lfull.flatten()[nindex[Ndo]]/Lfull.flatten()[nindexp1[Ndo]])
-        elif type_int=='lin':
-            alpha[Ndo]=(Llev[k]-Lfull.flatten()[nindexp1[Ndo]])/(Lfull.flatten()[nindex[Ndo]]- Lfull.flatten()[nindexp1[Ndo]])
-
-        #Mask if Llev[k]<model top for the pressure interpolation
-        if masktop : alpha[Llev[k]<Lfull.flatten()[nindex]]=np.NaN
-
-
-        #Here, we need to make sure n+1 is never> Nfull by setting n+1=Nfull, if it is the case.
-        #This does not affect the calculation as alpha is set to NaN for those values.
-        nindexp1[nindexp1>=Nfull*Ndim]=nindex[nindexp1>=Nfull*Ndim]
-
-        varOUT[k,:]=varIN.flatten()[nindex]*alpha+(1-alpha)*varIN.flatten()[nindexp1]
-
-    return np.reshape(varOUT,dimsOUT)
+    if reverse_input:Lfull=Lfull[::-1,:]
+    Lflat=Lfull.ravel()
+
+    #Find nearest layer to Llev, unless the indices have been pre-computed.
+    # Note that reversed_input is always set to False as if desired, Lfull was reversed earlier
+    if not np.any(index):
+        index=find_n(Lfull,Llev,False)
+    n=np.reshape(index,(Nlev,Ndim))
+
+    #Convert the layers n to indexes, for a 2D matrix using nindex=i*ncol+j
+    nindex  =    n*Ndim+Ndimall  # n
+    nindexp1=(n+1)*Ndim+Ndimall  # n+1
+    Llev2D=np.repeat(Llev[:,np.newaxis],Ndim,axis=1)
+
+    #initialize alpha, size is [Nlev,Ndim]. Only calculate alpha where the indices are <Nfull
+    alpha=np.full((Nlev,Ndim),np.NaN,dtype)
+    Ndo=nindexp1<Nfull*Ndim
+    if type_int=='log':
+        alpha[Ndo]=np.log(Llev2D[Ndo]/Lflat[nindexp1[Ndo]])/np.log(Lflat[nindex[Ndo]]/Lflat[nindexp1[Ndo]])
+    elif type_int=='lin':
+        alpha[Ndo]=(Llev2D[Ndo]-Lflat[nindexp1[Ndo]])/(Lflat[nindex[Ndo]]- Lflat[nindexp1[Ndo]])
+
+    #Mask if Llev[k]<model top for the pressure interpolation. Note that n=-1 refers to the last layer
+    if masktop : alpha[Llev2D<Lflat[nindex]]=np.NaN
+
+    #Here, we need to make sure n+1 is never> Nfull by setting n+1=Nfull, if it is the case.
+    #This does not affect the calculation as alpha is set to NaN for those values.
+    nindexp1[~Ndo]=nindex[~Ndo]
+    nindex=np.mod(nindex,Nfull*Ndim) #n=-1 is the last layer
+
+    #Convert the indices to the layout of the variables: reversed vertical axis, then original order of the axes
+    for nn in [nindex,nindexp1]:
+        if reverse_input:nn[:]=(Nfull-1-nn//Ndim)*Ndim+nn%Ndim
+        if permut is not None:
+            multi_index=np.unravel_index(nn,dimsIN)
+            shape_var=np.zeros(len(dimsIN),dtype=int)
+            shape_var[permut]=dimsIN
+            nn[:]=np.ravel_multi_index(tuple(multi_index[np.argsort(permut)[i]] for i in range(len(dimsIN))),shape_var)
+
+    return nindex.reshape(dimsOUT),nindexp1.reshape(dimsOUT),alpha.reshape(dimsOUT)
+
+def vinterp_apply(varIN,weights,out=None):
+    '''
+    Apply the interpolation operator from vinterp_weights() to one variable.
+    Args:
+        varIN  : variable to interpolate, with the vertical axis first (or in its original order if permut was used in vinterp_weights())
+        weights: (nindex,nindexp1,alpha) from vinterp_weights()
+        out    : optional, output array with the same size as alpha
+    Returns:
+        varOUT : variable interpolated on the Llev pressure or altitude levels, same size and type as alpha
+    '''
+    nindex,nindexp1,alpha=weights
+    #This is a view, not a copy, if varIN is contiguous and already has the type of alpha
+    var_flat=np.ma.getdata(varIN).astype(alpha.dtype,copy=False).reshape(-1)
+    out=np.multiply(np.take(var_flat,nindex),alpha,out=out)
+    out+=(1-alpha)*np.take(var_flat,nindexp1)
+    return out
 
 
-def axis_interp(var_IN, x, xi, axis, reverse_input=False, type_int='lin',modulo=None):
+def axis_interp(var_IN, x, xi, axis, reverse_input=False, type_int='lin',modulo=None,dtype=None,out=None):
     '''
     One dimensional linear /log interpolation along one axis. [Alex Kling, May 2021]
     Args:
@@ -445,6 +553,8 @@ def axis_interp(var_IN, x, xi, axis, reverse_input=False, type_int='lin',modulo=
         reverse_input (boolean) : reverse input arrays, e.g if zfull(0)=120 km, zfull(N)=0km (which is typical)
         type_int : 'log' for logarithmic (typically pressure), 'lin' for linear
         modulo (float)    : for 'lin' interpolation only, use cyclic input (e.g when using modulo = 24 for time of day, 23.5 and 00am are considered 30 min appart, not 23.5hr)
+        dtype             : floating point type for the calculation, default is the working precision (see set_precision())
+        out (N-D array)   : optional, array with the size of VAR_OUT where the result is written
     Returns:
         VAR_OUT: interpolated data on the requested axis
 
@@ -454,50 +564,60 @@ def axis_interp(var_IN, x, xi, axis, reverse_input=False, type_int='lin',modulo=
 
     > For lon/lat interpolation, you may consider using  interp_KDTree() instead
 
+    > Masked values in var_IN or x are treated as NaN, and the output is masked where it is not defined if var_IN is a masked array.
+
     We have:
 
     X_OUT= Xn*A + (1-A)*Xn+1
     with A = log(xi/xn+1)/log(xn/xn+1) in 'log' mode
          A =    (xi-xn+1)/(xn-xn+1)    in 'lin' mode
-    '''
-    #Convert list to numpy array as needed
-    if type(var_IN)!=np.ndarray:var_IN=np.array(var_IN)
+         A = mod(xn+1-xi,modulo)/mod(xn+1-xn,modulo) in 'lin' mode with cyclic input, which is valid on both sides of the period
+    '''
+    dtype=get_dtype(dtype)
+    is_masked=np.ma.isMaskedArray(var_IN)
+    #Masked values are replaced by NaN so they do not contribute to the interpolation
+    var_IN=np.ma.filled(np.ma.masked_array(var_IN,dtype=dtype),np.NaN)
+    x=np.ma.filled(np.ma.masked_array(x,dtype=float),np.NaN).reshape(-1)
+    xi=np.ma.filled(np.ma.masked_array(xi,dtype=float),np.NaN).reshape(-1)
     #Move interpolated axis to 1st axis:
     var_IN=np.moveaxis(var_IN,axis,0)
     if reverse_input:
         var_IN=var_IN[::-1,...]
         x=x[::-1]
 
-    index=find_n(x,xi,False) #This is called everytime as it is fast on a 1D array
+    n=np.reshape(find_n(x,xi,False),-1) #This is called everytime as it is fast on a 1D array
+    np1=n+1
+    Nx=len(x)
+    #Treatment of edge cases where the interpolated value is outside the domain, i.e. n is the last element and n+1 does not exist
+    if modulo is not None:
+        #If looping around (e.g. longitude, time of day...) replace n+1 by the first element. n=-1 is already the last element
+        np1[np1>=Nx]=0
+    else:
+        #This will set the interpolated value to NaN as x[n] - x[np1] =0
+        np1[np1>=Nx]=Nx-1
+        #Also set n=n+1 (which results in NaN) if n =-1 (requested value is smaller than first element array)
+        n[n==-1]=0
 
-    dimsIN=var_IN.shape
-    dimsOUT=tuple(np.append(len(xi),dimsIN[1:]))
-    print(dimsOUT)
-    var_OUT=np.zeros(dimsOUT)
-
-    for k in range(0,len(index)):
-        n= index[k]
-        np1=n+1
-        # Treatment of edge cases where the interpolated value is outside the domain, i.e. n is the last element  and n+1 does not exist
-        if np1>=len(x):
-            #If looping around (e.g. longitude, time of day...)replace n+1 by the first element
-            if modulo is not None:
-                np1=0
-            else:
-                #This will set the interpolated value to NaN in xi as last value  as x[n] - x[np1] =0
-                np1-=1
-        #Also set n=n+1 (which results in NaN) if n =-1 (requested value is samller than first element array) and the values are NOT cyclic
-        if n==-1 and modulo is None:n=0
+    with np.errstate(divide='ignore', invalid='ignore'):
         if type_int=='log':
-            alpha=np.log(xi[k]/x[np1])/np.log(x[n]/x[np1])
+            alpha=np.log(xi/x[np1])/np.log(x[n]/x[np1])
         elif type_int=='lin':
             if modulo is None:
-                alpha=(xi[k]-x[np1])/(x[n]- x[np1])
+                alpha=(xi-x[np1])/(x[n]- x[np1])
             else:
-                alpha=np.mod(xi[k]-x[np1]+modulo,modulo)/np.mod(x[n]- x[np1]+modulo,modulo)
-        var_OUT[k,:]=var_IN[n,...]*alpha+(1-alpha)*var_IN[np1,...]
+                #Distances are measured backward from x[n+1], so the interpolation is also correct across the end of the period
+                alpha=np.mod(x[np1]-xi,modulo)/np.mod(x[np1]-x[n],modulo)
+    #Broadcast alpha to the other dimensions
+    alpha=alpha.astype(dtype).reshape((len(xi),)+(1,)*(var_IN.ndim-1))
 
-    return   np.moveaxis(var_OUT,0,axis)
+    #Gather all the requested positions at once and blend them
+    var_OUT=None if out is None else np.moveaxis(out,axis,0)
+    with np.errstate(invalid='ignore'):
+        var_OUT=np.multiply(np.take(var_IN,n,axis=0),alpha,out=var_OUT)
+        var_OUT+=(1-alpha)*np.take(var_IN,np1,axis=0)
+    var_OUT=np.moveaxis(var_OUT,0,axis)
+    if is_masked:var_OUT=np.ma.masked_invalid(var_OUT,copy=False)
+    return var_OUT
 
 
 def polar2XYZ(lon, lat, alt,Re=3400*10**3): #radian
@@ -519,7 +639,7 @@ def polar2XYZ(lon, lat, alt,Re=3400*10**3): #radian
     return X,Y,Z
 
 
-def interp_KDTree(var_IN,lat_IN,lon_IN,lat_OUT,lon_OUT,N_nearest=10):
+def interp_KDTree(var_IN,lat_IN,lon_IN,lat_OUT,lon_OUT,N_nearest=10,dtype=None):
     '''
     Inverse-distance-weighted interpolation using nearest neighboor for ND variables.  [Alex Kling , May 2021]
     Args:
@@ -527,6 +647,7 @@ def interp_KDTree(var_IN,lat_IN,lon_IN,lat_OUT,lon_OUT,N_nearest=10):
         lat_IN,lon_IN        (1D or 2D):   lat, lon 1D arrays or LAT[y,x] LON[y,x] for irregular grids in [deg]
         lat_OUT,lon_OUT(1D or 2D):lat,lon for the TARGET grid structure , e.g. lat1,lon1 or LAT1[y,x], LON1[y,x] for irregular grids in [deg]
         N_nearest: integer, number of nearest neighbours for the search.
+        dtype: floating point type for the calculation, default is the working precision (see set_precision())
     Returns:
         VAR_OUT: interpolated data on the target grid
 
@@ -538,6 +659,8 @@ def interp_KDTree(var_IN,lat_IN,lon_IN,lat_OUT,lon_OUT,N_nearest=10):
     '''
     from scipy.spatial import cKDTree #TODO Import called each time. May be moved out of the routine is scipy is a requirement for the pipeline
 
+    dtype=get_dtype(dtype)
+    var_IN=var_IN.astype(dtype,copy=False)
     dimsIN=var_IN.shape
     nlon_IN=dimsIN[-1]
     nlat_IN=dimsIN[-2]
@@ -554,12 +677,9 @@ def interp_KDTree(var_IN,lat_IN,lon_IN,lat_OUT,lon_OUT,N_nearest=10):
 
     #If lat, lon are 1D, broadcast dimensions:
 
-    Ndim= np.int(np.prod(dimsIN[0:-2])) # Ndim is the product of all input dimensions but lat & lon
+    Ndim= int(np.prod(dimsIN[0:-2])) # Ndim is the product of all input dimensions but lat & lon
     dims_IN_reshape=tuple(np.append(Ndim,nlon_IN*nlat_IN))
-    dims_OUT_reshape=tuple(np.append(Ndim,nlat_OUT*nlon_OUT))
     dims_OUT=np.append(dimsIN[0:-2],[nlat_OUT,nlon_OUT]).astype(int) #Needed if var is (lat,lon)
-    var_OUT=np.zeros(dims_OUT_reshape)          #Initialization
-    Ndimall=np.arange(0,Ndim)                   #all indices (does not change)
 
     #Compute cartesian coordinate for source and target files  polar2XYZ(lon,lat,lev)
     xs,ys,zs=polar2XYZ(lon_IN*np.pi/180 ,lat_IN*np.pi/180,0.,Re=1.)
@@ -568,7 +688,7 @@ def interp_KDTree(var_IN,lat_IN,lon_IN,lat_OUT,lon_OUT,N_nearest=10):
     tree = cKDTree(list(zip(xs.flatten(), ys.flatten(),zs.flatten())))
     d, inds = tree.query(list(zip(xt.flatten(), yt.flatten(),zt.flatten())), k = N_nearest)
     #Inverse distance
-    w = 1.0 / d**2
+    w = (1.0 / d**2).astype(dtype)
     var_OUT=np.sum(w*var_IN.reshape(dims_IN_reshape)[:,inds],axis=2)/np.sum(w, axis=1) # sum the weights  and normalize
     return var_OUT.reshape(dims_OUT)
 
@@ -765,7 +885,7 @@ def areo_avg(VAR,areo,Ls_target,Ls_angle,symmetric=True):
     return VAR_avg.reshape(shape_out)
 
 
-def mass_stream(v_avg,lat,level,type='pstd',psfc=700,H=8000.,factor=1.e-8):
+def mass_stream(v_avg,lat,level,type='pstd',psfc=700,H=8000.,factor=1.e-8,chunk=None):
     '''
     Compute the mass stream function.
                             P
@@ -783,6 +903,8 @@ def mass_stream(v_avg,lat,level,type='pstd',psfc=700,H=8000.,factor=1.e-8):
         psfc : reference surface pressure in [Pa]
         H    : reference scale height in [m] when pressure are used.
         factor: normalize the mass stream function by a factor, use factor =1. to obtain [kg/s]
+        chunk : (optional) number of columns (product of the dimensions after 'lat') integrated at once, to limit the memory used by
+                 the intermediate arrays on large fields. Default is to process all the columns together.
     Returns:
         MSF: The meridional mass stream function in factor*[kg/s]
     ***NOTE***
@@ -799,6 +921,8 @@ def mass_stream(v_avg,lat,level,type='pstd',psfc=700,H=8000.,factor=1.e-8):
                                                             ⌠
     The integral is calculated using trapezoidal rule, e.g. ⌡ f(z)dz  = (Zn-Zn-1){f(Zn)+f(Zn-1)}/2
                                                             n-1
+    The integral from the top is obtained for all the levels at once as a reverse cumulative sum of the trapezoids, with
+    MSF=0 at the first and last two levels.
     '''
     g=3.72 #m/s2
     a=3400*1000 #m
@@ -808,13 +932,10 @@ def mass_stream(v_avg,lat,level,type='pstd',psfc=700,H=8000.,factor=1.e-8):
     #If size is (pstd,lat), turns to (pstd,lat,1) for generality
     if len(shape_out)==2:v_avg=v_avg.reshape(nlev,len(lat),1)
 
-    #Flatten array
-    v_avg=v_avg.reshape((nlev,len(lat),np.prod(v_avg.shape[2:])))
+    #Flatten array. This is a copy so the NaN and masked values are not set to zero in the input array
+    v_avg=v_avg.reshape((nlev,len(lat),np.prod(v_avg.shape[2:]))).copy()
     MSF=np.zeros_like(v_avg)
 
-    #Sum variable, same dimensions as v_avg but for the first dimension
-    I=np.zeros(v_avg.shape[2:])
-
     #Make note of NaN positions and replace by zero for downward integration
     isNan=False
     if np.isnan(v_avg).any():
@@ -835,15 +956,19 @@ def mass_stream(v_avg,lat,level,type='pstd',psfc=700,H=8000.,factor=1.e-8):
     else: #Copy zagl or zstd instead of using a pseudo height
         Z=level.copy()
 
-    for k0 in range(nlev-2,0,-1):
-        I[:]=0.
-        for k in range(nlev-2,k0,-1):
-            zn=   Z[k]
-            znp1= Z[k+1]
-            fn=  v_avg[k,:,...] *np.exp(-zn/H)
-            fnp1=v_avg[k+1,:,...]*np.exp(-znp1/H)
-            I=I+0.5*(znp1-zn)*(fnp1+fn)
-        MSF[k0,:,...]=2*np.pi*a*psfc/(g*H)*np.cos(np.pi/180*lat).reshape([len(lat),1])*I*factor
+    #Integrand at each level, and scaling of the integral. The trapezoids T[k] span the layers between Z[k] and Z[k+1]
+    exp_Z=np.exp(-Z.astype(np.float64)/H).astype(v_avg.dtype).reshape([nlev,1,1])
+    dZ=(0.5*(Z[1:]-Z[:-1])).astype(v_avg.dtype).reshape([nlev-1,1,1])
+    norm=2*np.pi*a*psfc/(g*H)*np.cos(np.pi/180*lat).reshape([len(lat),1])
+
+    ncol=v_avg.shape[2]
+    if chunk is None:chunk=max(ncol,1)
+    for i0 in range(0,ncol,chunk):
+        cols=slice(i0,min(i0+chunk,ncol))
+        fn=v_avg[:,:,cols]*exp_Z
+        T=dZ*(fn[1:,...]+fn[:-1,...])
+        #MSF[k0]=T[k0+1]+...+T[nlev-2], summed from the top down in double precision
+        MSF[1:nlev-2,:,cols]=norm*np.cumsum(T[nlev-2:1:-1,...],axis=0,dtype=np.float64)[::-1,...]*factor
 
     #Replace NaN where they initially were:
     if isNan:MSF[mask]=np.NaN
@@ -1480,7 +1605,45 @@ def polar_warming(T,lat,outside_range=np.NaN):
     return np.concatenate((PW_half_hemisphere(T_SH,lat_SH,outside_range),PW_half_hemisphere(T_NH,lat_NH,outside_range)),axis=0)
 
 
-def tshift(array, lon,timeo,timex=None):
+def tshift_weights(lon,timeo,timex=None):
+    '''
+    Interpolation indices and weights for the conversion to uniform local time, see tshift()
+    Args:
+        lon: longitude
+        timeo : time_of_day index from input file
+        timex (optional) : local time (hr) to shift to, e.g. '3. 15.'
+    Returns:
+        imm,ipp : indices of the input time_of_day before and after each target local time, size (lon,nsteps_out)
+        fraction: interpolation weight of ipp, size (lon,nsteps_out)
+    ***Note***
+    The weights only depend on the longitudes and the time_of_day so they can be computed once and used for all the variables of a file.
+    '''
+    timeo = np.squeeze(timeo)
+    nsteps=len(timeo)   # number of timesteps per day in input
+    dt_samp = 24.0/nsteps      #   Time increment of input data (in hours)
+
+    # calculate interpolation indeces
+    # convert east longitude to equivalent hours
+    xshif = 24.0*np.array(lon)/360.
+    xshif[xshif < 0]+=24.
+
+    # target local time for each longitude, shape is (lon,nsteps_out), in the precision of the longitudes
+    if timex is None:       # match dimensions of output file to input
+        dtt = (np.arange(nsteps)*dt_samp).astype(xshif.dtype)[np.newaxis,:]-xshif[:,np.newaxis] -timeo[0] + dt_samp
+    else:
+        dtt = np.array(timex).astype(xshif.dtype)[np.newaxis,:]- xshif[:,np.newaxis]   # time_out - xfshif
+
+    #      insure that data local time is bounded by [0,24] hours
+    dtt[dtt < 0.]+=24.
+
+    im = np.floor(dtt/dt_samp)    #  this is index into the data aray
+    fraction = (dtt-im*dt_samp).astype(float)/dt_samp # assume uniform tinc between input data samples
+    #Indices are wrapped around the day, for any number of time_of_day
+    imm = im.astype(int)%nsteps
+    ipp = (imm+1)%nsteps
+    return imm,ipp,fraction
+
+def tshift(array, lon,timeo,timex=None,weights=None):
     '''
     Conversion to uniform local time.
     Args:
@@ -1488,6 +1651,7 @@ def tshift(array, lon,timeo,timex=None):
         lon: longitude
         timeo : time_of_day index from input file
         timex (optional) : local time (hr) to shift to, e.g. '3. 15.'
+        weights (optional): interpolation indices and weights from tshift_weights(lon,timeo,timex), to reuse for several variables
     Returns:
         tshift: array shifted to uniform local time.
 
@@ -1501,104 +1665,27 @@ def tshift(array, lon,timeo,timex=None):
     dims=np.shape(array)  #get dimensions of array
     end=len(dims)-1
     id=dims[0]   #number of longitudes in file
-    nsteps=len(timeo)   # number of timesteps per day in input
-
-    nsf = np.float_(nsteps)   # number of timesteps per day in input
-
-    timeo = np.squeeze(timeo)
-
-    # array dimensions for output
-    if timex is None:       # time shift all local times
-        nsteps_out = nsteps
-    else:
-        nsteps_out = len(timex)
+    nsteps=len(np.atleast_1d(np.squeeze(timeo)))   # number of timesteps per day in input
 
     #Assuming time is last dimension, check if it is local time timex
-    #If not, reshape the array into (stuff, days, local time)
     if dims[end] != nsteps:
-        ndays = dims[end] / nsteps
-        if ndays*nsteps != dims[end]:
-            print('Time dimensions do not conform')
-            return
-        array = np.reshape(array,(dims[0,end-1], nsteps, ndays))
-        newdims=np.linspace(len(dims+1),dtype=np.int32)
-        newdims[len(dims)-1]=len(dims)
-        newdims[len(dims)]=len(dims)-1
-        array = np.transpose(array,newdims)
-
-    dims=np.shape(array) #get new dims of array if reshaped
-
-
-    if len(dims) > 2:
-        recl = np.prod(dims[1:len(dims)-1])
-    else:
-        recl=1
-
-
-    array=np.reshape(array,(id,recl,nsteps))
+        print('Time dimensions do not conform')
+        return
 
-    #create output array
-    narray=np.zeros((id,recl,nsteps_out))
+    if weights is None:weights=tshift_weights(lon,timeo,timex)
+    imm,ipp,fraction=weights
+    nsteps_out=imm.shape[1]
 
-    dt_samp = 24.0/nsteps      #   Time increment of input data (in hours)
+    #Flatten all dimensions but longitude and time_of_day: (lon,recl,nsteps)
+    array=np.reshape(np.asarray(array),(id,-1,nsteps))
 
-    # time increment of output
-    if timex is None:       # match dimensions of output file to input
-        dt_save = dt_samp  #   Time increment of output data (in hours)
-    else:
-        dt_save = 1.    # assume output time increament in 1 hour
+    #           Now carry out the interpolation, gathering the two input time_of_day of each (lon, local time)
+    #Weights are cast to the precision of the array
+    frac=fraction[:,np.newaxis,:].astype(array.dtype)
+    one_frac=(1.-fraction)[:,np.newaxis,:].astype(array.dtype)
+    narray = one_frac*np.take_along_axis(array,imm[:,np.newaxis,:],axis=2) + frac*np.take_along_axis(array,ipp[:,np.newaxis,:],axis=2)
 
-    # calculate interpolation indeces
-    # convert east longitude to equivalent hours
-    xshif = 24.0*lon/360.
-    kk=np.where(xshif < 0)
-    xshif[kk]=xshif[kk]+24.
-
-    fraction = np.zeros((id,nsteps_out))
-    imm = np.zeros((id,nsteps_out))
-    ipp = np.zeros((id,nsteps_out))
-
-    for nd in range(nsteps_out):
-        #dtt = nd*dt_save - xshif - timex[0] + dt_samp
-        if timex is None:
-           dtt = nd*dt_save-xshif -timeo[0] + dt_samp
-        else:
-           dtt = timex[nd]- xshif   # time_out - xfshif - tod[0] + hrs/stpe in input
-
-        #      insure that data local time is bounded by [0,24] hours
-        kk = np.where(dtt < 0.)
-        dtt[kk] = dtt[kk] + 24.
-
-        im = np.floor(dtt/dt_samp)    #  this is index into the data aray
-        fraction[:,nd] = dtt-im*dt_samp
-        kk = np.where(im < 0.)
-        im[kk] = im[kk] + nsf
-
-        ipa = im + 1.
-        kk = np.where(ipa >= nsf)
-        ipa[kk] = ipa[kk] - nsf
-
-        imm[:,nd] = im[:]
-        ipp[:,nd] = ipa[:]
-
-    fraction = fraction / dt_samp # assume uniform tinc between input data samples
-
-    #           Now carry out the interpolation
-    for nd in range(nsteps_out):    #   Number of output time levels
-        for i in range(id):         #   Number of longitudes
-            im = np.int(imm[i,nd])%24
-            ipa= np.int(ipp[i,nd])
-            frac = fraction[i,nd]
-            narray[i,:,nd] = (1.-frac)*array[i,:,im] + frac*array[i,:,ipa]
-
-    narray = np.squeeze(narray)
-    ndimsfinal=np.zeros(len(dims),dtype=int)
-    for nd in range(end):
-        ndimsfinal[nd]=dims[nd]
-    ndimsfinal[end]=nsteps_out
-    narray = np.reshape(narray,ndimsfinal)
-
-    return narray
+    return np.reshape(narray,dims[:end]+(nsteps_out,))
 
 
 
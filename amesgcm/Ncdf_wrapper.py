@@ -1,7 +1,8 @@
 import numpy as np
-from netCDF4 import Dataset,MFDataset
+from netCDF4 import Dataset
 from scipy.io import FortranFile
 from amesgcm.FV3_utils import daily_to_average, daily_to_diurn
+from amesgcm.Orbit_utils import ls2sol_1year
 import os
 
 #=========================================================================
@@ -118,6 +119,21 @@ class Ncdf(object):
         self.var_dict[variable_name].units=units_txt
         self.var_dict[variable_name][:]=DATAin
 
+    #Write a slab of data along the first axis (typically the unlimited 'time' dimension) starting at index t0.
+    #The variable is created on the first call, so a large variable can be written piece by piece.
+    #Example: Log.log_slab('temp',temp[10:20,...],('time','pstd','lat','lon'),10,'temperature','K')
+    def log_slab(self,variable_name,DATAin,dim_array,t0=0,longname_txt="",units_txt=""):
+        if variable_name not in self.var_dict.keys():
+            self._def_variable(variable_name,dim_array,longname_txt,units_txt)
+        self.var_dict[variable_name][t0:t0+DATAin.shape[0],...]=DATAin
+
+    #Define a variable without writing it and return it, so the values can be written by blocks of any dimension.
+    #Example: Log.def_variable('temp',('time','pfull','lat','lon'),'temperature','K')[:,0:5,...]=temp_block
+    def def_variable(self,variable_name,dim_array,longname_txt="",units_txt=""):
+        if variable_name not in self.var_dict.keys():
+            self._def_variable(variable_name,dim_array,longname_txt,units_txt)
+        return self.var_dict[variable_name]
+
     #Example: Log.add_dim_with_content('lon',lon_array,'longitudes','degree','X')
     def log_axis1D(self,variable_name,DATAin,dim_name,longname_txt="",units_txt="",cart_txt=""):
         if variable_name not in self.var_dict.keys():
@@ -194,11 +210,82 @@ class Ncdf(object):
                     else:
                         self.copy_Ncvar(Ncfile_in.variables[ivar])
 
-    def merge_files_from_list(self,Ncfilename_list,exclude_var=[]):
-        Mf_IN=MFDataset(Ncfilename_list,'r')
-        self.copy_all_dims_from_Ncfile(Mf_IN)
-        self.copy_all_vars_from_Ncfile(Mf_IN,exclude_var=exclude_var)
-        Mf_IN.close()
+    #Concatenate a list of files along the 'time' dimension. The dimensions and variables are defined from the first file and
+    #the records of each file are then appended one variable at the time, by slabs of at most max_mem [MB], so the full
+    #time series is never loaded in memory. Variables without a 'time' dimension are copied from the first file.
+    #The other dimensions, and the axes defined on them (e.g. lat, lon, pfull), must be identical in all the files.
+    #To resume an interrupted merge, open the merged file with action='a' and provide the number of files already appended (nskip).
+    #If provided, on_file_done(filename,nt) is called once the records of each file are flushed, with nt the number of records so far.
+    #Returns the number of bytes read from the input files.
+    def merge_files_from_list(self,Ncfilename_list,exclude_var=[],max_mem=500.,nskip=0,on_file_done=None):
+        resume=len(self.f_Ncdf.variables)>0
+        if resume:
+            self.dim_dict.update(self.f_Ncdf.dimensions)
+            self.var_dict.update(self.f_Ncdf.variables)
+        f_IN=Dataset(Ncfilename_list[0],'r')
+        if not resume:self.copy_all_dims_from_Ncfile(f_IN)
+        #---Define the time-varying variables and copy the others---
+        time_vars=[];ref_dims={};ref_axes={}
+        for idim in f_IN.dimensions.keys():
+            if idim!='time':ref_dims[idim]=f_IN.dimensions[idim].size
+        for ivar in f_IN.variables.keys():
+            if ivar in exclude_var or not self._test_var_dimensions(f_IN.variables[ivar]):continue
+            Ncvar=f_IN.variables[ivar]
+            if 'time' in Ncvar.dimensions:
+                time_vars.append(ivar)
+            elif self._is_cart_axis(Ncvar):
+                ref_axes[ivar]=np.array(Ncvar[:])
+            if resume:continue
+            if 'time' in Ncvar.dimensions:
+                longname_txt=getattr(Ncvar,'long_name',Ncvar._name)
+                units_txt=    getattr(Ncvar,'units','')
+                if self._is_cart_axis(Ncvar):
+                    self._def_axis1D(ivar,Ncvar.dimensions,longname_txt,units_txt,getattr(Ncvar,'cartesian_axis',''))
+                else:
+                    self._def_variable(ivar,Ncvar.dimensions,longname_txt,units_txt)
+            elif self._is_cart_axis(Ncvar):
+                self.copy_Ncaxis_with_content(Ncvar)
+            else:
+                self.copy_Ncvar(Ncvar)
+        f_IN.close()
+        #---Records already appended when resuming---
+        t0=0;nbytes=0
+        for ifile in Ncfilename_list[:nskip]:
+            f_IN=Dataset(ifile,'r')
+            t0+=f_IN.dimensions['time'].size
+            f_IN.close()
+        #---Append the records of each file---
+        for ifile in Ncfilename_list[nskip:]:
+            f_IN=Dataset(ifile,'r')
+            self._check_merged_file(f_IN,ifile,ref_dims,ref_axes,time_vars)
+            nt=f_IN.dimensions['time'].size
+            for ivar in time_vars:
+                Ncvar=f_IN.variables[ivar]
+                #Number of timesteps that fit in max_mem, assuming 8 bytes per value to account for the masked array
+                size_1step=8*np.prod(Ncvar.shape[1:],dtype=float)
+                nchunk=int(max(1,min(nt,max_mem*1.e6//size_1step)))
+                for i0 in range(0,nt,nchunk):
+                    i1=min(i0+nchunk,nt)
+                    self.var_dict[ivar][t0+i0:t0+i1,...]=Ncvar[i0:i1,...]
+                nbytes+=nt*np.prod(Ncvar.shape[1:])*Ncvar.dtype.itemsize
+            f_IN.close()
+            t0+=nt
+            if on_file_done:
+                self.f_Ncdf.sync()
+                on_file_done(ifile,t0)
+        return nbytes
+
+    def _check_merged_file(self,f_IN,ifile,ref_dims,ref_axes,time_vars):
+        #Test that a file can be appended to the merged file: same dimensions and axes, 'time' as first dimension
+        for idim,size in ref_dims.items():
+            if idim not in f_IN.dimensions.keys() or f_IN.dimensions[idim].size!=size:
+                raise Exception("Dimension '%s' in %s does not match the first file"%(idim,ifile))
+        for ivar,values in ref_axes.items():
+            if ivar not in f_IN.variables.keys() or not np.array_equal(np.array(f_IN.variables[ivar][:]),values):
+                raise Exception("Axis '%s' in %s does not match the first file"%(ivar,ifile))
+        for ivar in time_vars:
+            if ivar not in f_IN.variables.keys() or f_IN.variables[ivar].dimensions[0]!='time':
+                raise Exception("Variable '%s' in %s is missing or does not have 'time' as first dimension"%(ivar,ifile))
 
 #======================================================================================
 #====Wrapper for creation of netcdf-like object from Legacy GCM Fortran binaries=======
@@ -219,6 +306,12 @@ class Fort(object):
 
     PUBLIC METHODS:
     >> f.write_to_fixed(), f.write_to_average()  f.write_to_daily()  and f.write_to_diurn() can be used to generate FV3-like netcdf files
+
+    ***NOTE***
+    Only the header, the static fields and the scalars (time, areo...) are read when the object is created. The file is memory-mapped
+    and the other variables are read from the disk each time they are accessed, e.g. f.variables['temp'], so write_to_fixed()
+    does not read the dynamic records. Use f.write_to_files(['fixed','average','daily','diurn']) to create several files while
+    reading the dynamic records only once.
     '''
 
     #===Inner class for fortran_variables (Fort_var) that make up the Fort file===
@@ -243,6 +336,45 @@ class Fort(object):
             self.dimensions=dimensions_tuple
 
 
+    class Fort_lazy_var(object):
+        '''
+        Sub-class that holds the attributes of a dynamic variable (name, long_name, units, dimensions) and the function that
+        loads its values from the memory-mapped file. The values are only read when the variable is accessed.
+        '''
+        def __init__(self,load_function,name_txt,long_name_txt,units_txt,dimensions_tuple):
+            self.load_function=load_function
+            self.name = name_txt
+            self.long_name = long_name_txt
+            self.units= units_txt
+            self.dimensions=dimensions_tuple
+
+        def load(self,tslice=slice(None)):
+            return Fort.Fort_var(self.load_function(tslice),self.name,self.long_name,self.units,self.dimensions)
+
+    class Fort_variables(dict):
+        '''
+        Dictionary of the variables. Dynamic variables (Fort_lazy_var) are read from the file each time they are accessed
+        and are not kept in memory, so the variables can be processed one at the time.
+        '''
+        def __getitem__(self,name_txt):
+            value=dict.__getitem__(self,name_txt)
+            if isinstance(value,Fort.Fort_lazy_var):return value.load()
+            return value
+
+        def dimensions(self,name_txt):
+            '''
+            Return the dimensions of a variable without loading its values
+            '''
+            return dict.__getitem__(self,name_txt).dimensions
+
+        def read_slab(self,name_txt,t0,t1):
+            '''
+            Return the timesteps t0 to t1 (excluded) of a variable with a time dimension. Only those timesteps are read.
+            '''
+            value=dict.__getitem__(self,name_txt)
+            if isinstance(value,Fort.Fort_lazy_var):return value.load(slice(t0,t1))
+            return Fort.Fort_var(np.asarray(value)[t0:t1,...],value.name,value.long_name,value.units,value.dimensions)
+
     #==== End of inner class===
 
     def __init__(self,filename=None,description_txt=""):
@@ -264,14 +396,14 @@ class Fort(object):
         self.tod=np.arange(0.5*24/self.nperday,24,24/self.nperday)  # i.e np.arange(0.75,24,1.5) every 1.5 hours, centered at half timestep =0.75
 
         self.dimensions={} #Initialize dictionary
-        self.variables={} #Initialize dictionary
+        self.variables=self.Fort_variables() #Initialize dictionary
 
         if self.fort_type=='11':
             self._read_Fort11_header()
             self._read_Fort11_constants()
             self._read_Fort11_static()
             self._create_dims()
-            self._read_Fort11_dynamic()
+            self._index_Fort11_dynamic()
             self._add_axis_as_variables()
             #TODO monotically increasing MY: Get date as FV3 file e.g. 00000
             #self.fdate="%05i"%self._ls2sol_1year(self.variables['areo'][0]) #based on areo, depreciated
@@ -282,103 +414,120 @@ class Fort(object):
         '''
         Create 'fixed' file, i.e.  all static variables
         '''
-
-        Log=Ncdf(self.path+'/'+self.fdate+'.fixed.nc')
-
-        #Define dimensions
-        for ivar in ['lat','lon','pfull','phalf','zgrid']:
-            if ivar =='lon':cart_ax='X'
-            if ivar =='lat':cart_ax='Y'
-            if ivar in ['pfull' ,'phalf','zgrid']:cart_ax='Z'
-            fort_var=self.variables[ivar]
-            Log.add_dim_with_content(dimension_name=ivar,DATAin=fort_var,longname_txt=fort_var.long_name,units_txt=fort_var.units,cart_txt=cart_ax)
-
-        #Log static variables
-        for ivar in self.variables.keys():
-            if 'time' not in self.variables[ivar].dimensions:
-                fort_var=self.variables[ivar]
-                Log.log_variable(variable_name=ivar,DATAin=fort_var,dim_array=fort_var.dimensions,longname_txt=fort_var.long_name,units_txt=fort_var.units)
-        Log.close()
+        self.write_to_files(['fixed'])
 
     def write_to_daily(self):
         '''
         Create daily file, e.g. contineuous time serie
         '''
-        Log=Ncdf(self.path+'/'+self.fdate+'.atmos_daily.nc')
-
-        #Define dimensions
-        for ivar in ['lat','lon','pfull','phalf','zgrid']:
-            if ivar =='lon':cart_ax='X'
-            if ivar =='lat':cart_ax='Y'
-            if ivar in ['pfull' ,'phalf','zgrid']:cart_ax='Z'
-            fort_var=self.variables[ivar]
-            Log.add_dim_with_content(dimension_name=ivar,DATAin=fort_var,longname_txt=fort_var.long_name,units_txt=fort_var.units,cart_txt=cart_ax)
-
-        #Add scalar_axis dimension (size 1, only used with areo)
-        Log.add_dimension('scalar_axis',1)
-
-        #Add aggregation dimension (None size for unlimited)
-        Log.add_dimension('time',None)
-        fort_var=self.variables['time']
-        Log.log_axis1D(variable_name='time',DATAin=fort_var,dim_name='time',longname_txt=fort_var.long_name,units_txt=fort_var.units,cart_txt='T')
-
-        #Special case for the solar longitude (areo): needs to be interpolated linearly every 16 timesteps
-        ivar='areo';fort_var=self.variables[ivar]
-        var_out=self._linInterpLs(np.squeeze(fort_var[:]),16).reshape([len(fort_var),1]) #areo is reshaped as [time,scalar_axis]=[160,1]
-        Log.log_variable(variable_name=ivar,DATAin=var_out,dim_array=fort_var.dimensions,longname_txt=fort_var.long_name,units_txt=fort_var.units)
-
-        #Log dynamic variables, as well as pk, bk
-        for ivar in self.variables.keys():
-            if 'time' in self.variables[ivar].dimensions and ivar!='areo' or ivar in ['pk','bk']:
-                fort_var=self.variables[ivar]
-                Log.log_variable(variable_name=ivar,DATAin=fort_var,dim_array=fort_var.dimensions,longname_txt=fort_var.long_name,units_txt=fort_var.units)
-        Log.close()
+        self.write_to_files(['daily'])
 
     def write_to_average(self,day_average=5):
         '''
         Create average file, e.g. N day averages (typically 5)
         '''
-        Log=Ncdf(self.path+'/'+self.fdate+'.atmos_average.nc')
-        #Define dimensions
-        for ivar in ['lat','lon','pfull','phalf','zgrid']:
-            if ivar =='lon':cart_ax='X'
-            if ivar =='lat':cart_ax='Y'
-            if ivar in ['pfull' ,'phalf','zgrid']:cart_ax='Z'
-            fort_var=self.variables[ivar]
-            Log.add_dim_with_content(dimension_name=ivar,DATAin=fort_var,longname_txt=fort_var.long_name,units_txt=fort_var.units,cart_txt=cart_ax)
+        self.write_to_files(['average'],day_average)
 
-        #Add scalar_axis dimension (size 1, only used with areo)
-        Log.add_dimension('scalar_axis',1)
+    def write_to_diurn(self,day_average=5):
+        '''
+        Create diurn file, e.g.variable are organized by time of day. Additionally, the data is also binned  (typically 5)
+        '''
+        self.write_to_files(['diurn'],day_average)
 
-        #Add aggregation dimension (None size for unlimited)
-        Log.add_dimension('time',None)
+    def write_to_files(self,file_types=['fixed','average','daily','diurn'],day_average=5):
+        '''
+        Create the requested FV3-like netcdf files in a single pass over the fort.11 file.
+        Args:
+            file_types (list): files to create, any of 'fixed', 'average', 'daily' and 'diurn'
+            day_average (int): binning period in sols for the average and diurn files (typically 5)
+        ***NOTE***
+        The dynamic variables are read by bins of day_average sols. Each bin is read once, appended to the daily file,
+        and averaged (average file) or averaged by time of day (diurn file), with the same results as daily_to_average()
+        and daily_to_diurn() on the full time series. Only one bin of one variable is held in memory at the time.
+        '''
+        if 'fixed' in file_types:
+            Log=Ncdf(self.path+'/'+self.fdate+'.fixed.nc')
+            self._write_dims(Log)
+            #Log static variables
+            for ivar in self.variables.keys():
+                if 'time' not in self.variables.dimensions(ivar):
+                    fort_var=self.variables[ivar]
+                    Log.log_variable(variable_name=ivar,DATAin=fort_var,dim_array=fort_var.dimensions,longname_txt=fort_var.long_name,units_txt=fort_var.units)
+            Log.close()
 
-        #Perform day average and log new time axis
         time_in=self.variables['time']
-        time_out=daily_to_average(varIN=fort_var,dt_in=time_in[1]-time_in[0],nday=day_average,trim=True)
-        Log.log_axis1D(variable_name='time',DATAin=time_out,dim_name='time',longname_txt=time_in.long_name,units_txt=time_in.units,cart_txt='T')
+        dt_in=time_in[1]-time_in[0]
+        #Number of timesteps in one bin, same as in daily_to_average()
+        combinedN=int(np.round(1/dt_in))*day_average
+
+        #===Create the files and log the axis===
+        Log_dict={}
+        if 'daily' in file_types:
+            Log=Ncdf(self.path+'/'+self.fdate+'.atmos_daily.nc')
+            self._write_dims(Log,add_time=True)
+            Log.log_axis1D(variable_name='time',DATAin=time_in,dim_name='time',longname_txt=time_in.long_name,units_txt=time_in.units,cart_txt='T')
+            Log.log_variable(variable_name='time',DATAin=time_in,dim_array=time_in.dimensions,longname_txt=time_in.long_name,units_txt=time_in.units)
+            #Special case for the solar longitude (areo): needs to be interpolated linearly every 16 timesteps
+            ivar='areo';fort_var=self.variables[ivar]
+            var_out=self._linInterpLs(np.squeeze(fort_var[:]),16).reshape([len(fort_var),1]) #areo is reshaped as [time,scalar_axis]=[160,1]
+            Log.log_variable(variable_name=ivar,DATAin=var_out,dim_array=fort_var.dimensions,longname_txt=fort_var.long_name,units_txt=fort_var.units)
+            Log_dict['daily']=Log
+
+        for ftype in ['average','diurn']:
+            if ftype in file_types:
+                Log=Ncdf(self.path+'/'+self.fdate+'.atmos_%s.nc'%(ftype))
+                self._write_dims(Log,add_time=True,add_tod=(ftype=='diurn'))
+                #Perform day average and log new time axis
+                time_out=daily_to_average(varIN=time_in,dt_in=dt_in,nday=day_average,trim=True)
+                Log.log_axis1D(variable_name='time',DATAin=time_out,dim_name='time',longname_txt=time_in.long_name,units_txt=time_in.units,cart_txt='T')
+                if ftype=='average':Log.log_variable(variable_name='time',DATAin=time_out,dim_array=time_in.dimensions,longname_txt=time_in.long_name,units_txt=time_in.units)
+                Log_dict[ftype]=Log
 
         #Log static variables
-        for ivar in ['pk','bk']:
-            fort_var=self.variables[ivar]
-            Log.log_variable(variable_name=ivar,DATAin=fort_var,dim_array=fort_var.dimensions,longname_txt=fort_var.long_name,units_txt=fort_var.units)
-
-        #Log dynamic variables
-        for ivar in self.variables.keys():
-            if 'time' in self.variables[ivar].dimensions:
+        for ftype,Log in Log_dict.items():
+            for ivar in ['pk','bk']:
                 fort_var=self.variables[ivar]
-                var_out=daily_to_average(fort_var,time_in[1]-time_in[0],nday=day_average,trim=True)
-                Log.log_variable(variable_name=ivar,DATAin=var_out,dim_array=fort_var.dimensions,longname_txt=fort_var.long_name,units_txt=fort_var.units)
-
-        Log.close()
+                Log.log_variable(variable_name=ivar,DATAin=fort_var,dim_array=fort_var.dimensions,longname_txt=fort_var.long_name,units_txt=fort_var.units)
 
+        #===Log dynamic variables, one bin at the time===
+        if not Log_dict:return
+        for t0 in range(0,self.nsteps,combinedN):
+            t1=min(t0+combinedN,self.nsteps)
+            #Average and diurn files only use complete bins (trim=True)
+            ibin=t0//combinedN if t1-t0==combinedN else None
+            for ivar in self.variables.keys():
+                dims_in=self.variables.dimensions(ivar)
+                if 'time' not in dims_in or ivar=='time':continue
+                if ibin is None and 'daily' not in Log_dict:continue
+                fort_var=self.variables.read_slab(ivar,t0,t1)
+
+                if 'daily' in Log_dict and ivar!='areo':
+                    Log_dict['daily'].log_slab(ivar,fort_var,dims_in,t0,fort_var.long_name,fort_var.units)
+                if ibin is None:continue
+
+                if 'average' in Log_dict:
+                    var_out=daily_to_average(fort_var,dt_in,nday=day_average,trim=True)
+                    Log_dict['average'].log_slab(ivar,var_out,dims_in,ibin,fort_var.long_name,fort_var.units)
+
+                if 'diurn' in Log_dict:
+                    if type(dims_in)==str: #dimensions has 'time' only, it is a string
+                        dims_out=(dims_in,)+(self.tod_name,)
+                    else: #dimensions is a tuple, e.g. ('time','lat','lon')
+                        dims_out=(dims_in[0],)+(self.tod_name,)+dims_in[1:]
+                    var_out=daily_to_diurn(fort_var[:],time_in[0:self.nperday])
+                    if day_average!=1:var_out=daily_to_average(var_out,1.,day_average) #dt is 1 sol between two diurn timestep
+                    Log_dict['diurn'].log_slab(ivar,var_out,dims_out,ibin,fort_var.long_name,fort_var.units)
 
+        for Log in Log_dict.values():Log.close()
 
-    def write_to_diurn(self,day_average=5):
+    def _write_dims(self,Log,add_time=False,add_tod=False):
         '''
-        Create diurn file, e.g.variable are organized by time of day. Additionally, the data is also binned  (typically 5)
+        Define the dimensions of the new file, and log the spatial axis
+        Args:
+            Log     : Ncdf object for the new file
+            add_time: if True, also add the scalar_axis and (unlimited) time dimensions
+            add_tod : if True, add the time_of_day dimension for diurn files
         '''
-        Log=Ncdf(self.path+'/'+self.fdate+'.atmos_diurn.nc')
         #Define dimensions
         for ivar in ['lat','lon','pfull','phalf','zgrid']:
             if ivar =='lon':cart_ax='X'
@@ -386,48 +535,21 @@ class Fort(object):
             if ivar in ['pfull' ,'phalf','zgrid']:cart_ax='Z'
             fort_var=self.variables[ivar]
             Log.add_dim_with_content(dimension_name=ivar,DATAin=fort_var,longname_txt=fort_var.long_name,units_txt=fort_var.units,cart_txt=cart_ax)
+        if not add_time:return
 
         #Add scalar_axis dimension (size 1, only used with areo)
         Log.add_dimension('scalar_axis',1)
 
         #Add time_of_day dimensions
-        Log.add_dim_with_content(dimension_name=self.tod_name,DATAin=self.tod,longname_txt='time of day',units_txt='hours since 0000-00-00 00:00:00',cart_txt='N')
+        if add_tod:Log.add_dim_with_content(dimension_name=self.tod_name,DATAin=self.tod,longname_txt='time of day',units_txt='hours since 0000-00-00 00:00:00',cart_txt='N')
 
         #Add aggregation dimension (None size for unlimited)
         Log.add_dimension('time',None)
 
-        #Perform day average and log new time axis
-        time_in=self.variables['time']
-        time_out=daily_to_average(varIN=time_in,dt_in=time_in[1]-time_in[0],nday=day_average,trim=True)
-        Log.log_axis1D(variable_name='time',DATAin=time_out,dim_name='time',longname_txt=time_in.long_name,units_txt=time_in.units,cart_txt='T')
-
-        #Log static variables
-        for ivar in ['pk','bk']:
-            fort_var=self.variables[ivar]
-            Log.log_variable(variable_name=ivar,DATAin=fort_var,dim_array=fort_var.dimensions,longname_txt=fort_var.long_name,units_txt=fort_var.units)
-
-        #Loop over all variables in file
-        for ivar in self.variables.keys():
-            if 'time' in self.variables[ivar].dimensions :
-                fort_var=self.variables[ivar]
-                #If time is the dimension (but not just a time array)
-                if 'time' in fort_var.dimensions and ivar!='time':
-                    dims_in=fort_var.dimensions
-                    if type(dims_in)==str: #dimensions has 'time' only, it is a string
-                        dims_out=(dims_in,)+(self.tod_name,)
-                    else: #dimensions is a tuple, e.g. ('time','lat','lon')
-                        dims_out=(dims_in[0],)+(self.tod_name,)+dims_in[1:]
-
-                    var_out=daily_to_diurn(fort_var[:],time_in[0:self.nperday])
-                    if day_average!=1:var_out=daily_to_average(var_out,1.,day_average) #dt is 1 sol between two diurn timestep
-                    Log.log_variable(ivar,var_out,dims_out,fort_var.long_name,fort_var.units)
-
-        Log.close()
-
-
     #Public method
     def close(self):
         self.f.close()
+        self.mmap=None #Release the memory-mapped file
         print(self.filename+" was closed")
     #Private methods
 
@@ -528,92 +650,9 @@ class Fort(object):
 
         self.zgrid = self.sdepth[1::2]    #TODO check
 
-    def _ra_1D(self,new_array,name_txt):
-        '''
-        _ra stands for 'Return array': Append single timesteps along the first (time) dimensions
-        '''
-        if type(new_array)!=np.ndarray:new_array=np.array([new_array])
-
-        #Add time axis to new data e.g. turn [lat,lon]to as [1,lat,lon]
-        new_shape=np.append([1],new_array.shape)
-        #First time that varialbe is encountered
-        if name_txt not in self.variables.keys():
-            return new_array
-        else: #Get values from existing array and append to it. Note that np.concatenate((x,y)) takes a tuple as argument.
-            return np.append(self.variables[name_txt],new_array)
-
-    def _ra_2D(self,name_txt,Rec=None):
-        '''
-        _ra stands for 'Return array': Append single timesteps along the first (time) dimensions
-        Args:
-            name_txt : char, name of variables, e.g. 'temp'
-            Rec: Record to archive. if None, read directly in fortran binary.
-
-        '''
-        if Rec is None:
-            Rec=self.f.read_reals('f4').reshape(self.JM,self.IM, order='F')
-        #Set to pole point to value at N-1
-        Rec[-1,...]=Rec[-2,...]
-        #Add time axis to new data e.g. turn [lat,lon]to as [1,lat,lon]
-        new_shape=np.append([1],Rec.shape)
-        #First time that varialbe is encountered
-        if name_txt not in self.variables.keys():
-            return Rec.reshape(new_shape)
-        else: #Get values from existing array and append to it. Note that np.concatenate((x,y)) takes a tuple as argument.
-            return np.concatenate((self.variables[name_txt],Rec.reshape(new_shape)))
-
-    def _ra_3D_atmos(self,name_txt,Rec=None):
-        '''
-        _ra stands for 'Return array': Append single timesteps along the first (time) dimensions
-        '''
-        if Rec is None:
-            Rec=self.f.read_reals('f4').reshape(self.JM,self.IM, self.LM, order='F')
-        #Set to pole point to value at N-1
-        Rec[-1,...]=Rec[-2,...]
-        Rec=Rec.transpose([2,0,1])
-        #Add time axis to new data e.g. turn [lat,lon]to as [1,lat,lon]
-        new_shape=np.append([1],Rec.shape)
-        #First time that varialbe is encountered
-        if name_txt not in self.variables.keys():
-            return Rec.reshape(new_shape)
-        else: #Get values from existing array and append to it. Note that np.concatenate((x,y)) takes a tuple as argument.
-            return np.concatenate((self.variables[name_txt],Rec.reshape(new_shape)))
-
-    def _log_var(self,name_txt,long_name,unit_txt,dimensions,Rec=None,scaling=None):
-        '''
-
-        '''
-        #No Record is provided, read from file
-        if Rec is None:
-            if dimensions==('time','lat','lon'):
-                Rec=self.f.read_reals('f4').reshape(self.JM,self.IM, order='F')
-            if dimensions==('time','pfull','lat','lon'):
-                Rec=self.f.read_reals('f4').reshape(self.JM,self.IM, self.LM, order='F')
-            if dimensions==('time','zgrid','lat','lon'):
-                Rec=self.f.read_reals('f4').reshape(self.JM,self.IM, self.NL, order='F')
-            #If scaling, scale it!
-            if scaling:Rec*=scaling
-        #Reorganize 3D vars
-        if dimensions==('time','pfull','lat','lon') or dimensions==('time','zgrid','lat','lon'):Rec=Rec.transpose([2,0,1])
-        #Set to pole point to value at N-1
-        Rec[...,-1,:]=Rec[...,-2,:]
-
-        #Add time axis to new data e.g. turn [lat,lon]to as [1,lat,lon]
-        new_shape=np.append([1],Rec.shape)
-        #First time that varialbe is encountered
-        if name_txt not in self.variables.keys():
-            Rec=Rec.reshape(new_shape)
-        else: #Get values from existing array and append to it. Note that np.concatenate((x,y)) takes a tuple as argument.
-            Rec= np.concatenate((self.variables[name_txt],Rec.reshape(new_shape)))
-
-        #Log the variable
-        self.variables[name_txt]=  self.Fort_var(Rec ,name_txt,long_name,unit_txt,dimensions)
-
-
-
-    def _read_Fort11_dynamic(self):
+    def _Fort11_dynamic_records(self):
         '''
-        Read variables from fort.11 files that changes with each timestep.
+        Return the layout of the records written to fort.11 at each timestep.
 
         In mhistv.f :
 
@@ -641,91 +680,161 @@ class Fort(object):
             write(11) dheat
             write(11) geot
 
+        Returns:
+            records: list of (data type, shape, variables) for each record. The shape is the C-order shape of the record, e.g.
+                     (LM,IM,JM) for T(JM,IM,LM) in Fortran, with the arrays written in the same record stacked on the first axis.
+                     variables is a list of (name, long_name, units, dimensions, scaling) for each array of the record.
+                     The first two records hold scalars and are treated separately
+        '''
+        JM=self.JM;IM=self.IM;LM=self.LM;NL=self.NL;ntrace=self.ntrace
+        d2=('time','lat','lon');d3=('time','pfull','lat','lon')
+        return [
+        ('f4',(10,),None),
+        ('i4',(2,),None),
+        ('f4',(1,IM,JM),[('ps','surface pressure','Pa',d2,100)]),
+        ('f4',(1,LM,IM,JM),[('temp','temperature','K',d3,None)]),
+        ('f4',(1,LM,IM,JM),[('ucomp','zonal wind','m/sec',d3,None)]),
+        ('f4',(1,LM,IM,JM),[('vcomp','meridional wind','m/s',d3,None)]),
+        ('f4',(1,IM,JM),[('ts','surface temperature','K',d2,None)]),
+        ('f4',(1,IM,JM),[('snow','surface amount of CO2 ice on the ground','kg/m2',d2,None)]),
+        ('f4',(1,IM,JM),[('stressx','zonal component of surface stress','N/m2',d2,None)]),
+        ('f4',(1,IM,JM),[('stressy','merdional component of surface stress','N/m2',d2,None)]),
+        ('f4',(1,IM,JM),[('tstrat','stratosphere temperature','K',d2,None)]),
+        ('f4',(1,IM,JM),[('tausurf','visible dust optical depth at the surface.','none',d2,None)]),
+        ('f4',(1,IM,JM),[('ssun','solar energy absorbed by the atmosphere','W/m2',d2,None)]),
+        #Write(11) QTRACE # dust mass:1, dust number 2|| water ice mass: 3 and water ice number 4|| dust core mass:5|| water vapor mass: 6
+        ('f4',(ntrace,LM,IM,JM),[('dst_mass','dust aerosol mass mixing ratio','kg/kg',d3,None),
+                                 ('dst_num','dust aerosol number','number/kg',d3,None),
+                                 ('ice_mass','water ice aerosol mass mixing ratio','kg/kg',d3,None),
+                                 ('ice_num','water ice  aerosol number','number/kg',d3,None),
+                                 ('cor_mass','dust core mass mixing ratio for water ice','kg/kg',d3,None),
+                                 ('vap_mass','water vapor mass mixing ratio','kg/kg',d3,None)]),
+        #write(11) QCOND   dust mass:1, dust number 2|| water ice mass: 3 and water ice number 4|| dust core mass:5|| water vapor mass: 6
+        ('f4',(ntrace,IM,JM),[('dst_mass_sfc','dust aerosol mass on the surface','kg/m2',d2,None),
+                              ('dst_num_sfc','dust aerosol number on the surface','number/m2',d2,None),
+                              ('ice_mass_sfc','water ice aerosol mass on the surface','kg/m2',d2,None),
+                              ('ice_num_sfc','water ice  aerosol number on the surface','number/m2',d2,None),
+                              ('cor_mass_sfc','dust core mass for water ice on the surface','kg/m2',d2,None),
+                              ('vap_mass_sfc','water vapor mass on the surface','kg/m2',d2,None)]),
+        #write(11) stemp
+        ('f4',(1,NL,IM,JM),[('soil_temp','sub-surface soil temperature','K',('time','zgrid','lat','lon'),None)]),
+        #write(11) fuptopv, fdntopv, fupsurfv, fdnsurfv
+        ('f4',(4,IM,JM),[('fuptopv','upward visible flux at the top of the atmosphere','W/m2',d2,None),
+                         ('fdntopv','downward visible flux at the top of the atmosphere','W/m2',d2,None),
+                         ('fupsurfv','upward visible flux at the surface','W/m2',d2,None),
+                         ('fdnsurfv','downward visible flux at the surface','W/m2',d2,None)]),
+        #write(11) fuptopir, fupsurfir, fdnsurfir
+        ('f4',(3,IM,JM),[('fuptopir','upward IR flux at the top of the atmosphere','W/m2',d2,None),
+                         ('fupsurfir','upward IR flux at the surface','W/m2',d2,None),
+                         ('fdnsurfir','downward IR flux at the surface','W/m2',d2,None)]),
+        #write(11) surfalb
+        ('f4',(1,IM,JM),[('surfalb','surface albedo in the visible, soil or H2O, CO2 ices if present','none',d2,None)]),
+        #write(11) dheat
+        #write(11) geot
+        ('f4',(1,LM,IM,JM),[('dheat','diabatic heating rate','K/sol',d3,None)]),
+        ('f4',(1,LM,IM,JM),[('geot','geopotential','m2/s2',d3,None)])]
+
+    def _scan_Fort11_records(self):
+        '''
+        Scan the record markers of the file once and return the position of all the records.
+        Returns:
+            offsets: byte offset of the (leading) record marker for each record
+            nbytes : size of the data in each record, in bytes
+        ***NOTE***
+        Fortran sequential records are written as [marker][data][marker], with the marker holding the size of the data.
+        Only the markers are read: the data is skipped.
+        '''
+        marker=np.dtype(np.uint32) #Same as the default for scipy.io.FortranFile
+        offsets=[];nbytes=[]
+        file_size=os.path.getsize(self.filename)
+        with open(self.filename,'rb') as fb:
+            pos=0
+            while pos<file_size:
+                head=np.frombuffer(fb.read(marker.itemsize),marker)
+                if len(head)==0:break
+                size=int(head[0])
+                fb.seek(size,1)
+                tail=np.frombuffer(fb.read(marker.itemsize),marker)
+                if len(tail)==0 or int(tail[0])!=size:
+                    raise Exception('Corrupted or truncated record at byte %i in %s'%(pos,self.filename))
+                offsets.append(pos);nbytes.append(size)
+                pos+=size+2*marker.itemsize
+        return np.array(offsets,dtype=np.int64),np.array(nbytes,dtype=np.int64)
+
+    def _index_Fort11_dynamic(self):
+        '''
+        Index the variables from fort.11 files that changes with each timestep, and map them in memory.
+        The dynamic records have the same layout at each timestep (see _Fort11_dynamic_records()), so the file is
+        memory-mapped as an array of timesteps and each variable is a (strided) view of that array.
+        The scalars (time, areo...) are loaded now, the other variables are only read when they are accessed.
+        '''
+        records=self._Fort11_dynamic_records()
+        nrec=len(records)
+        marker=np.dtype(np.uint32)
+
+        #Index all the records, the first 3 are the header, constants and static fields
+        offsets,nbytes=self._scan_Fort11_records()
+        offsets,nbytes=offsets[3:],nbytes[3:]
+        nsteps=len(offsets)//nrec
+        #Expected layout of one timestep, as a structured data type
+        step_dtype=[]
+        for irec,(rec_type,rec_shape,_) in enumerate(records):
+            step_dtype+=[('head%i'%(irec),marker),('rec%i'%(irec),rec_type,rec_shape),('tail%i'%(irec),marker)]
+        step_dtype=np.dtype(step_dtype)
+        expected_nbytes=np.array([np.dtype(rec_type).itemsize*np.prod(rec_shape) for rec_type,rec_shape,_ in records])
+        if (nsteps==0 or len(offsets)%nrec!=0 or
+            np.any(nbytes.reshape(nsteps,nrec)!=expected_nbytes) or
+            np.any(offsets.reshape(nsteps,nrec)!=offsets[0]+np.arange(nsteps)[:,np.newaxis]*step_dtype.itemsize+(offsets[:nrec]-offsets[0]))):
+            raise Exception('Unexpected layout for the dynamic records in %s'%(self.filename))
+        if nsteps!=self.nperday*self.nsolfile:
+            print('*** Warning *** %i timesteps found in %s, expected %i'%(nsteps,self.filename,self.nperday*self.nsolfile))
+        self.nsteps=nsteps
+
+        #Map the timesteps in memory, nothing is read at this point
+        self.mmap=np.memmap(self.filename,dtype=step_dtype,mode='r',offset=int(offsets[0]),shape=(nsteps,))
+
+        #TAU=Rec[0];VPOUT=Rec[1]; RSDIST=Rec[2]; TOFDAY=Rec[3]; PSF=Rec[4]; PTROP=Rec[5]; TAUTOT=Rec[6]; RPTAU=Rec[7]; SIND=Rec[8]; GASP2=Rec[9]
+        Rec=np.array(self.mmap['rec0'])
+        self.variables['time']=  self.Fort_var(Rec[:,0].astype(np.float64)/24  ,'time','elapsed time from the start of the run','days since 0000-00-00 00:00:00',('time'))
+        self.variables['areo']= self.Fort_var(Rec[:,1]     ,'areo','solar longitude','degree',('time','scalar_axis'))  #TODO monotically increasing ?
+        self.variables['rdist']= self.Fort_var(Rec[:,2]    ,'rdist','square of the Sun-Mars distance','(AU)**2',('time'))
+        self.variables['tofday']=self.Fort_var(Rec[:,3]   ,'npcflag','time of day','hours since 0000-00-00 00:00:00',('time')) #TODO edge or center ?
+        self.variables['psf']=   self.Fort_var(Rec[:,4].astype(np.float64)*100  ,'psf','Initial global surface pressure','Pa',('time'))
+        self.variables['ptrop']= self.Fort_var(Rec[:,5]    ,'ptrop','pressure at the tropopause','Pa',('time'))
+        self.variables['tautot']=self.Fort_var(Rec[:,6]   ,'tautot','Input (global) dust optical depth at the reference pressure','none',('time'))
+        self.variables['rptau']= self.Fort_var(Rec[:,7].astype(np.float64)*100,'rptau','reference pressure for dust optical depth','Pa',('time'))
+        self.variables['sind']=  self.Fort_var(Rec[:,8]     ,'sind','sine of the sub-solar latitude','none',('time'))
+        self.variables['gasp']=  self.Fort_var(Rec[:,9].astype(np.float64)*100 ,'gasp','global average surface pressure','Pa',('time'))
+
+        #NC3=Rec[0]; NCYCLE=Rec[1]
+        Rec=np.array(self.mmap['rec1'])
+        self.variables['nc3']=     self.Fort_var(Rec[:,0]     ,'nc3','full COMP3 is done every nc3 time steps.','None',('time'))
+        self.variables['ncycle']=  self.Fort_var(Rec[:,0]  ,'ncycle','ncycle','none',('time'))
+
+        #Other variables are loaded on demand
+        for irec,(_,_,var_list) in enumerate(records[2:],start=2):
+            for iarr,(name_txt,long_name,unit_txt,dimensions,scaling) in enumerate(var_list):
+                load_function=lambda tslice,irec=irec,iarr=iarr,scaling=scaling: self._load_Fort11_var(irec,iarr,scaling,tslice)
+                self.variables[name_txt]=self.Fort_lazy_var(load_function,name_txt,long_name,unit_txt,dimensions)
+
+    def _load_Fort11_var(self,irec,iarr,scaling=None,tslice=slice(None)):
+        '''
+        Read one variable for all the timesteps from the memory-mapped file
+        Args:
+            irec : record number in the timestep, see _Fort11_dynamic_records()
+            iarr : position of the variable in the record
+            scaling: if provided, multiply the values by this factor
+            tslice : if provided, only read those timesteps, e.g. slice(0,80)
+        Returns:
+            var_out: the variable as [time,lat,lon] or [time,lev,lat,lon]
         '''
-        nsteps=   self.nperday* self.nsolfile  #typically 16 x 10 =160
-        append=False
-        for iwsol in range(0,nsteps):
-            Rec=self.f.read_record('f4')
-            #TAU=Rec[0];VPOUT=Rec[1]; RSDIST=Rec[2]; TOFDAY=Rec[3]; PSF=Rec[4]; PTROP=Rec[5]; TAUTOT=Rec[6]; RPTAU=Rec[7]; SIND=Rec[8]; GASP2=Rec[9]
-
-            self.variables['time']=  self.Fort_var(self._ra_1D(Rec[0]/24,'time')  ,'time','elapsed time from the start of the run','days since 0000-00-00 00:00:00',('time'))
-            self.variables['areo']= self.Fort_var(self._ra_1D(Rec[1].reshape([1,1]),'areo')     ,'areo','solar longitude','degree',('time','scalar_axis'))  #TODO monotically increasing ?
-            self.variables['rdist']= self.Fort_var(self._ra_1D(Rec[2],'rdist')    ,'rdist','square of the Sun-Mars distance','(AU)**2',('time'))
-            self.variables['tofday']=self.Fort_var(self._ra_1D(Rec[3],'tofday')   ,'npcflag','time of day','hours since 0000-00-00 00:00:00',('time')) #TODO edge or center ?
-            self.variables['psf']=   self.Fort_var(self._ra_1D(Rec[4]*100,'psf')  ,'psf','Initial global surface pressure','Pa',('time'))
-            self.variables['ptrop']= self.Fort_var(self._ra_1D(Rec[5],'ptrop')    ,'ptrop','pressure at the tropopause','Pa',('time'))
-            self.variables['tautot']=self.Fort_var(self._ra_1D(Rec[6],'tautot')   ,'tautot','Input (global) dust optical depth at the reference pressure','none',('time'))
-            self.variables['rptau']= self.Fort_var(self._ra_1D(Rec[7]*100,'rptau'),'rptau','reference pressure for dust optical depth','Pa',('time'))
-            self.variables['sind']=  self.Fort_var(self._ra_1D(Rec[8],'sind')     ,'sind','sine of the sub-solar latitude','none',('time'))
-            self.variables['gasp']=  self.Fort_var(self._ra_1D(Rec[9]*100,'gasp') ,'gasp','global average surface pressure','Pa',('time'))
-
-            Rec=self.f.read_record('i4')
-            #NC3=Rec[0]; NCYCLE=Rec[1]
-
-            self.variables['nc3']=     self.Fort_var(self._ra_1D(Rec[0],'nc3')     ,'nc3','full COMP3 is done every nc3 time steps.','None',('time'))
-            self.variables['ncycle']=  self.Fort_var(self._ra_1D(Rec[0],'ncycle')  ,'ncycle','ncycle','none',('time'))
-
-            self._log_var('ps','surface pressure','Pa',('time','lat','lon'),scaling=100)
-            self._log_var('temp','temperature','K',('time','pfull','lat','lon'))
-            self._log_var('ucomp','zonal wind','m/sec',('time','pfull','lat','lon'))
-            self._log_var('vcomp','meridional wind','m/s',('time','pfull','lat','lon'))
-            self._log_var('ts','surface temperature','K',('time','lat','lon'))
-            self._log_var('snow','surface amount of CO2 ice on the ground','kg/m2',('time','lat','lon'))
-            self._log_var('stressx','zonal component of surface stress','N/m2',('time','lat','lon'))
-            self._log_var('stressy','merdional component of surface stress','N/m2',('time','lat','lon'))
-            self._log_var('tstrat','stratosphere temperature','K',('time','lat','lon'))
-            self._log_var('tausurf','visible dust optical depth at the surface.','none',('time','lat','lon'))
-            self._log_var('ssun','solar energy absorbed by the atmosphere','W/m2',('time','lat','lon'))
-
-            #Write(11) QTRACE # dust mass:1, dust number 2|| water ice mass: 3 and water ice number 4|| dust core mass:5|| water vapor mass: 6
-            Rec=self.f.read_reals('f4').reshape(self.JM,self.IM,self.LM,self.ntrace,order='F')
-
-
-            self._log_var('dst_mass','dust aerosol mass mixing ratio','kg/kg',('time','pfull','lat','lon')           ,Rec=Rec[...,0])
-            self._log_var('dst_num','dust aerosol number','number/kg',('time','pfull','lat','lon')                   ,Rec=Rec[...,1])
-            self._log_var('ice_mass','water ice aerosol mass mixing ratio','kg/kg',('time','pfull','lat','lon')      ,Rec=Rec[...,2])
-            self._log_var('ice_num','water ice  aerosol number','number/kg',('time','pfull','lat','lon')             ,Rec=Rec[...,3])
-            self._log_var('cor_mass','dust core mass mixing ratio for water ice','kg/kg',('time','pfull','lat','lon'),Rec=Rec[...,4])
-            self._log_var('vap_mass','water vapor mass mixing ratio','kg/kg',('time','pfull','lat','lon')            ,Rec=Rec[...,5])
-
-
-            #write(11) QCOND   dust mass:1, dust number 2|| water ice mass: 3 and water ice number 4|| dust core mass:5|| water vapor mass: 6
-            Rec=self.f.read_reals('f4').reshape(self.JM,self.IM,self.ntrace,order='F')
-
-            self._log_var('dst_mass_sfc','dust aerosol mass on the surface','kg/m2',('time','lat','lon')           ,Rec=Rec[...,0])
-            self._log_var('dst_num_sfc','dust aerosol number on the surface','number/m2',('time','lat','lon')      ,Rec=Rec[...,1])
-            self._log_var('ice_mass_sfc','water ice aerosol mass on the surface','kg/m2',('time','lat','lon')      ,Rec=Rec[...,2])
-            self._log_var('ice_num_sfc','water ice  aerosol number on the surface','number/m2',('time','lat','lon'),Rec=Rec[...,3])
-            self._log_var('cor_mass_sfc','dust core mass for water ice on the surface','kg/m2',('time','lat','lon'),Rec=Rec[...,4])
-            self._log_var('vap_mass_sfc','water vapor mass on the surface','kg/m2',('time','lat','lon')            ,Rec=Rec[...,5])
-
-
-            #write(11) stemp
-            Rec=self.f.read_reals('f4').reshape(self.JM,self.IM,self.NL,order='F')
-            self._log_var('soil_temp','sub-surface soil temperature','K',('time','zgrid','lat','lon') ,Rec=Rec)
-
-            #write(11) fuptopv, fdntopv, fupsurfv, fdnsurfv
-            Rec=self.f.read_record('({0},{1})f4'.format(self.IM,self.JM),'({0},{1})f4'.format(self.IM,self.JM),'({0},{1})f4'.format(self.IM,self.JM),'({0},{1})f4'.format(self.IM,self.JM))
-
-            self._log_var('fuptopv','upward visible flux at the top of the atmosphere','W/m2',('time','lat','lon'),Rec=Rec[0])
-            self._log_var('fdntopv','downward visible flux at the top of the atmosphere','W/m2',('time','lat','lon'),Rec=Rec[1])
-            self._log_var('fupsurfv','upward visible flux at the surface','W/m2',('time','lat','lon'),Rec=Rec[2])
-            self._log_var('fdnsurfv','downward visible flux at the surface','W/m2',('time','lat','lon'),Rec=Rec[3])
-
-            #write(11) fuptopir, fupsurfir, fdnsurfir
-            Rec=self.f.read_record('({0},{1})f4'.format(self.IM,self.JM),'({0},{1})f4'.format(self.IM,self.JM),'({0},{1})f4'.format(self.IM,self.JM))
-
-            self._log_var('fuptopir','upward IR flux at the top of the atmosphere','W/m2',('time','lat','lon'),Rec=Rec[0])
-            self._log_var('fupsurfir','upward IR flux at the surface','W/m2',('time','lat','lon'),Rec=Rec[1])
-            self._log_var('fdnsurfir','downward IR flux at the surface','W/m2',('time','lat','lon'),Rec=Rec[2])
-
-            #write(11) surfalb
-            self._log_var('surfalb','surface albedo in the visible, soil or H2O, CO2 ices if present','none',('time','lat','lon'))
-
-            #write(11) dheat
-            #write(11) geot
-            self._log_var('dheat','diabatic heating rate','K/sol',('time','pfull','lat','lon'))
-            self._log_var('geot','geopotential','m2/s2',('time','pfull','lat','lon'))
+        #Fortran records are [...,lon,lat] in C-order, swap to [...,lat,lon] and copy to memory
+        var_out=np.array(self.mmap['rec%i'%(irec)][tslice,iarr,...].swapaxes(-1,-2))
+        #If scaling, scale it!
+        if scaling:var_out*=scaling
+        #Set to pole point to value at N-1
+        var_out[...,-1,:]=var_out[...,-2,:]
+        return var_out
 
     def _add_axis_as_variables(self):
         '''
@@ -775,26 +884,7 @@ class Fort(object):
         ***NOTE***
         For the moment this is consistent with Ls 0->359.99, not for monotically increasing Ls
         '''
-        Lsp=250.99   #Ls at perihelion
-        tperi=485.35 #Time (in sols) at perihelion
-        Ns=668.6     #Number of sols in 1 MY
-        e=0.093379   #from GCM: modules.f90
-        nu=(Ls_deg-Lsp)*np.pi/180
-        E=2*np.arctan(np.tan(nu/2)*np.sqrt((1-e)/(1+e)))
-        M=E-e*np.sin(E)
-        Ds= M/(2*np.pi)*Ns+tperi
-        #====Offset correction======
-        if offset:
-            #Ds is a float
-            if len(np.atleast_1d(Ds))==1:
-                Ds-=Ns
-                if Ds<0:Ds+=Ns
-            #Ds is an array
-            else:
-                Ds-=Ns
-                Ds[Ds<0]=Ds[Ds<0]+Ns
-        if round: Ds=np.round(Ds,-1)  #-1 means round to the nearest 10
-        return Ds
+        return ls2sol_1year(Ls_deg,offset,round10)
 
     def _linInterpLs(self,Ls,stride=16):
         '''
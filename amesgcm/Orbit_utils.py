@@ -0,0 +1,140 @@
+import numpy as np
+#=========================================================================
+#==========Conversions between solar longitude, sol and Mars year=========
+#=========================================================================
+
+#===Orbital parameters, from the GCM: modules.f90===
+Lsp=250.99   #Ls at perihelion
+tperi=485.35 #Time (in sols) at perihelion
+Ns=668.6     #Number of sols in 1 MY
+e=0.093379   #Eccentricity
+
+def MY_func(Ls_cont):
+    '''
+    This function return the Mars Year
+    Args:
+        Ls_cont: solar longitude, contineuous
+    Returns:
+        MY : int the Mars year
+    '''
+    return (Ls_cont)//(360.)+1
+
+def Ls_cont2MY_Ls360(Ls_cont):
+    '''
+    Split a contineuous solar longitude into a Mars year and a solar longitude in [0-360[
+    Args:
+        Ls_cont: solar longitude, contineuous, float or array
+    Returns:
+        MY    : the Mars year (MY starts at 1)
+        Ls_360: solar longitude in [0-360[
+    '''
+    return MY_func(Ls_cont),np.mod(Ls_cont,360.)
+
+def MY_Ls3602Ls_cont(MY,Ls_360):
+    '''
+    Return the contineuous solar longitude for a Mars year and a solar longitude in [0-360], e.g. MY=2, Ls_360=90 returns 450
+    '''
+    return Ls_360+(MY-1)*360.
+
+def ls2sol_1year(Ls_deg,offset=True,round10=True):
+    '''
+    Returns a sol number from the solar longitude.
+    Args:
+        Ls_deg: solar longitude in degree, float or array
+        offset : if True, make year starts at Ls 0
+        round10 : if True, round to the nearest 10 sols
+    Returns:
+        Ds :sol number
+    ***NOTE***
+    For the moment this is consistent with Ls 0->359.99, not for monotically increasing Ls, use ls2sol() for those.
+    '''
+    nu=(Ls_deg-Lsp)*np.pi/180
+    E=2*np.arctan(np.tan(nu/2)*np.sqrt((1-e)/(1+e)))
+    M=E-e*np.sin(E)
+    Ds= M/(2*np.pi)*Ns+tperi
+    #====Offset correction======
+    if offset:
+        #Works for both floats and arrays
+        Ds-=Ns
+        Ds+=Ns*(Ds<0)
+    if round10: Ds=np.round(Ds,-1)  #-1 means round to the nearest 10
+    return Ds
+
+def ls2sol(Ls_cont):
+    '''
+    Returns the number of sols since the beginning of MY 1 for a contineuous solar longitude
+    Args:
+        Ls_cont: solar longitude, contineuous, float or array, e.g. 450 for Ls=90 during the second year
+    Returns:
+        sol_cont: sol number, contineuous, monotonically increasing with Ls_cont and equal to 0 at Ls=0
+    '''
+    MY,Ls_360=Ls_cont2MY_Ls360(Ls_cont)
+    #Count the sols from Ls=0: ls2sol_1year() is not exactly 0 at Ls=0 and wraps around slightly before Ls=360
+    sol_360=np.mod(ls2sol_1year(Ls_360,True,False)-ls2sol_1year(0.,True,False),Ns)
+    return (MY-1)*Ns+sol_360
+
+#Lookup table for the inverse conversion, computed on the first call to sol2ls()
+_sol_table=None
+_Ls_table=None
+
+def _sol_Ls_table(dLs=0.01):
+    '''
+    Return the sol numbers for one Mars year on a regular grid of solar longitudes, used for the inverse conversion.
+    Args:
+        dLs: spacing of the solar longitude grid in [deg]
+    Returns:
+        sol_table: sol numbers from 0 (Ls=0) to Ns (Ls=360), monotonically increasing
+        Ls_table : solar longitudes from 0 to 360
+    '''
+    global _sol_table,_Ls_table
+    if _sol_table is None:
+        Ls_table=np.linspace(0,360.,int(np.round(360./dLs))+1)
+        #ls2sol() starts at 0 for Ls=0 and increases with Ls, the sol for Ls=360 is Ns
+        _sol_table,_Ls_table=ls2sol(Ls_table),Ls_table
+    return _sol_table,_Ls_table
+
+def sol2ls(sol_cont):
+    '''
+    Returns the contineuous solar longitude from the number of sols since the beginning of MY 1. This is the inverse of ls2sol()
+    Args:
+        sol_cont: sol number, contineuous, float or array
+    Returns:
+        Ls_cont: solar longitude, contineuous
+    ***NOTE***
+    The Kepler equation is not inverted directly: the solar longitude is interpolated linearly in a lookup table
+    with a 0.01 deg resolution, which is accurate to better than 1.e-7 deg.
+    '''
+    sol_table,Ls_table=_sol_Ls_table()
+    #Number of complete years since Ls=0 of MY 1
+    nyear=np.floor(np.asarray(sol_cont)/Ns)
+    return np.interp(sol_cont-nyear*Ns,sol_table,Ls_table)+nyear*360.
+
+def sol2MY(sol_cont):
+    '''
+    Returns the Mars year from the number of sols since the beginning of MY 1
+    '''
+    return MY_func(sol2ls(sol_cont))
+
+def nearest_index(Ls_cont,Ls_query,assume_sorted=False):
+    '''
+    Return the index of the timesteps closest to the requested solar longitudes.
+    Args:
+        Ls_cont      : 1D array of contineuous solar longitudes, e.g. the 'areo' variable of a file
+        Ls_query     : requested solar longitudes (contineuous), float or array
+        assume_sorted: if True, Ls_cont is known to be increasing and the search uses a bisection
+    Returns:
+        ti: index in Ls_cont, int or array
+    ***NOTE***
+    Ls_cont is not checked here: the caller tests once per file whether it is increasing, which is the case for
+    contineuous solar longitudes, so long multi-year time series are not scanned for each request.
+    With assume_sorted=False, the full array is searched.
+    '''
+    Ls_cont=np.asarray(Ls_cont);Ls_query=np.asarray(Ls_query)
+    if assume_sorted and len(Ls_cont)>1:
+        i1=np.clip(np.searchsorted(Ls_cont,Ls_query),1,len(Ls_cont)-1)
+        #Pick the closest of the two neighbours, the first one in case of a tie, as np.argmin()
+        ti=np.where(Ls_query-Ls_cont[i1-1]<=Ls_cont[i1]-Ls_query,i1-1,i1)
+        ti=np.searchsorted(Ls_cont,Ls_cont[ti]) #first of repeated values
+    else:
+        ti=np.argmin(np.abs(Ls_query[...,np.newaxis]-Ls_cont),axis=-1)
+    return ti if ti.ndim else int(ti)
@@ -0,0 +1,135 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor,as_completed
+from amesgcm.Script_utils import prRed,prCyan,prGreen,prYellow
+#=========================================================================
+#=====================Parallel processing utilities=======================
+#=========================================================================
+
+def check_unique_outputs(file_list,output_list):
+    '''
+    Make sure that no two input files would write to the same output file, exit otherwise.
+    Args:
+        file_list (list)  : input files
+        output_list (list): for each input file, the output file name or a list of output file names
+    Returns:
+        None
+    '''
+    written=dict()
+    duplicates=[]
+    for ifile,outputs in zip(file_list,output_list):
+        if isinstance(outputs,str):outputs=[outputs]
+        for iout in outputs:
+            #Normalize the path so '00010.atmos_daily.nc' and './00010.atmos_daily.nc' are the same file
+            key=os.path.realpath(iout)
+            if key in written.keys() and written[key]!=ifile:
+                duplicates.append((written[key],ifile,iout))
+            written.setdefault(key,ifile)
+    if duplicates:
+        for file1,file2,iout in duplicates:
+            prRed('***Error*** %s and %s would both write %s'%(file1,file2,iout))
+        prRed('Remove the duplicated files from the list or use a different extension (--ext)')
+        exit()
+
+def _timed_call(func,ifile):
+    '''
+    Run func(ifile) and return the elapsed time in [sec]. This is the function executed by each worker.
+    '''
+    start_time=time.time()
+    func(ifile)
+    return time.time()-start_time
+
+def jobs_for_memory(file_list,njobs,max_mem=None):
+    '''
+    Limit the number of processes so that the files processed at the same time fit in the memory budget.
+    Args:
+        file_list (list): files to process
+        njobs (int)     : requested number of processes
+        max_mem (float) : memory budget in [MB], None for no limit
+    Returns:
+        njobs (int): number of processes, at least 1
+    ***NOTE***
+    The memory needed by one job is estimated as the size of the largest input file, which is an upper bound for
+    conversions that hold at most one variable in memory at the time.
+    '''
+    if max_mem is None or not file_list:return njobs
+    largest=max([_file_size(ifile) for ifile in file_list])
+    if largest==0:return njobs
+    njobs_mem=max(1,int(max_mem*1.e6//largest))
+    if njobs_mem<njobs:
+        prYellow('Using %i processes instead of %i to stay within --max_mem %g MB (largest file is %.1f MB)'%(njobs_mem,njobs,max_mem,largest/1.e6))
+        njobs=njobs_mem
+    return njobs
+
+def _file_size(ifile):
+    '''
+    Size of a file in [bytes], 0 if the file does not exist
+    '''
+    try:
+        return os.path.getsize(ifile)
+    except OSError:
+        return 0
+
+def run_file_jobs(func,file_list,njobs=1,output_list=None,max_mem=None):
+    '''
+    Process a list of files independently, either one after the other or on a pool of processes.
+    Args:
+        func (function)    : function processing a single file, called as func(ifile). It must be defined at the top
+                             level of a module (or be a functools.partial of such a function) so it can be sent to the workers
+        file_list (list)   : files to process
+        njobs (int)        : number of processes, 1 processes the files serially in the current process
+        output_list (list) : output file(s) written for each input file, checked for duplicates before starting
+        max_mem (float)    : memory budget in [MB] for all the processes, see jobs_for_memory()
+    Returns:
+        status (list): (filename, success as True/False, elapsed time in [sec]) for each file, in the order of file_list
+    ***NOTE***
+    In serial mode, exceptions are not caught so the scripts behave exactly as when looping over the files.
+    With a pool, a failure on one file is reported and the other files are still processed.
+    '''
+    if output_list is not None:check_unique_outputs(file_list,output_list)
+    njobs=max(1,min(njobs,len(file_list)))
+    njobs=jobs_for_memory(file_list,njobs,max_mem)
+
+    status=[]
+    if njobs==1:
+        for ifile in file_list:
+            status.append((ifile,True,_timed_call(func,ifile)))
+        return status
+
+    prCyan('Processing %i files on %i processes ...'%(len(file_list),njobs))
+    start_time=time.time()
+    results={}
+    with ProcessPoolExecutor(max_workers=njobs) as executor:
+        futures={executor.submit(_timed_call,func,ifile):ifile for ifile in file_list}
+        #Report each file as soon as it is done
+        for ndone,ifuture in enumerate(as_completed(futures),start=1):
+            ifile=futures[ifuture]
+            #SystemExit (e.g. exit() after an error message) is also reported as a failure by the workers
+            try:
+                results[ifile]=(ifile,True,ifuture.result())
+                prCyan('  [%i/%i] %s done (%.3f sec)'%(ndone,len(file_list),ifile,results[ifile][2]))
+            except BaseException as error_msg:
+                prRed('***Error*** while processing %s: %s'%(ifile,error_msg))
+                results[ifile]=(ifile,False,0.)
+    status=[results[ifile] for ifile in file_list]
+    print_job_summary(status,time.time()-start_time)
+    return status
+
+def print_job_summary(status,wall_time=None):
+    '''
+    Print the status and processing time of each file.
+    Args:
+        status (list)    : (filename, success as True/False, elapsed time in [sec]), as returned by run_file_jobs()
+        wall_time (float): if provided, also print the total wall time in [sec] and the amount of data processed
+    '''
+    for ifile,success,elapsed in status:
+        if success:
+            prGreen('  [ OK ]   %s (%.3f sec)'%(ifile,elapsed))
+        else:
+            prRed('  [FAILED] %s'%(ifile))
+    nfailed=len([s for s in status if not s[1]])
+    if nfailed:prYellow('%i out of %i files failed'%(nfailed,len(status)))
+    if wall_time is not None:
+        nbytes=sum([_file_size(ifile) for ifile,success,_ in status if success])
+        prCyan('Processed %.1f MB in %.2f sec (%.1f MB/s), %.2f sec of processing time'%(nbytes/1.e6,wall_time,
+               nbytes/1.e6/max(wall_time,1.e-6),sum([s[2] for s in status])))
@@ -4,6 +4,7 @@ import subprocess
 from netCDF4 import Dataset, MFDataset
 import numpy as np
 import re
+from amesgcm.Orbit_utils import MY_func
 #=========================================================================   
 #=========================Scripts utilities===============================
 #=========================================================================
@@ -17,15 +18,6 @@ def prYellow(skk): print("\033[93m{}\033[00m".format(skk))
 def prPurple(skk): print("\033[95m{}\033[00m".format(skk)) 
 def prLightPurple(skk): print("\033[94m{}\033[00m".format(skk)) 
 
-def MY_func(Ls_cont):
-    '''
-    This function return the Mars Year
-    Args:
-        Ls_cont: solar longitude, contineuous
-    Returns:
-        MY : int the Mars year
-    '''
-    return (Ls_cont)//(360.)+1
  
 def find_tod_in_diurn(fNcdf): 
     '''
@@ -429,7 +421,7 @@ def regrid_Ncfile(VAR_Ncdf,file_Nc_in,file_Nc_target):
             var_OUT=axis_interp(var_OUT, lat_in,lat_t,axis=-2, reverse_input=False, type_int='lin')
         #Special case if input latitude is 1 element (slice or medidional average) We only interpolate on the longitude axis     
         elif len(np.atleast_1d(lat_in))==1:
-            var_OUT=axis_interp(var_OUT, lon_in,lon_t,axis=-1, reverse_input=False, type_int='lin')
+            var_OUT=axis_interp(var_OUT, lon_in,lon_t,axis=-1, reverse_input=False, type_int='lin',modulo=360)
         else:#Bi-directional interpolation    
             var_OUT=interp_KDTree(var_OUT,lat_in,lon_in,lat_t,lon_t) #lon/lat
         
@@ -453,12 +445,12 @@ def regrid_Ncfile(VAR_Ncdf,file_Nc_in,file_Nc_target):
     #STEP 3: Linear interpolation in Ls
     if 'time' in VAR_Ncdf.dimensions:
         pos_axis=0
+        #For diurn files, areo is (time,time_of_day_XX,scalar_axis): use the values at the first time of day
+        if ftype_in=='diurn':areo_in,areo_t=areo_in[:,0,...],areo_t[:,0,...]
         var_OUT=axis_interp(var_OUT, np.squeeze(areo_in)%360,np.squeeze(areo_t)%360, pos_axis, reverse_input=False, type_int='lin')   
         
     #STEP 4: Linear interpolation in time of day  
-    #TODO the interpolation scheme is not cyclic. 
-    #> If Available diurn times  are 04 10 16 22 and requested time is 23, value is left to zero  and not interpololated from 22 and 04 times as it should
-    # if requesting 
+    #The interpolation is cyclic: if available diurn times are 04 10 16 22 and requested time is 23, the value is interpolated from 22 and 04
     if ftype_in =='diurn':
         pos_axis=1
         
@@ -466,7 +458,7 @@ def regrid_Ncfile(VAR_Ncdf,file_Nc_in,file_Nc_target):
         tod_name_t=find_tod_in_diurn(file_Nc_target)
         tod_in=file_Nc_in.variables[tod_name_in][:]
         tod_t=file_Nc_target.variables[tod_name_t][:]
-        var_OUT=axis_interp(var_OUT, tod_in,tod_t, pos_axis, reverse_input=False, type_int='lin')  
+        var_OUT=axis_interp(var_OUT, tod_in,tod_t, pos_axis, reverse_input=False, type_int='lin',modulo=24)  
     
     return var_OUT   
 
@@ -341,6 +341,49 @@ def zeroPhi_filter(VAR, btype, low_highcut, fs,axis=0,order=4,no_trend=False):
     else:
         return VAR_trend +VAR_f 
 
+def zeroPhi_filter_blocks(VAR_in, VAR_out, btype, low_highcut, fs,order=4,no_trend=False,max_mem=500.,njobs=1):
+    '''
+    Temporal filter of zeroPhi_filter(), applied by blocks of the non-time dimensions so the full variable is never in memory.
+    Args:
+        VAR_in:  values to filter, with the time dimension FIRST, e.g. a Netcdf variable so only the current block is read
+        VAR_out: array or Netcdf variable of the same shape as VAR_in, where the filtered blocks are written
+        btype, low_high_cut, fs, order, no_trend: see zeroPhi_filter()
+        max_mem: size of the blocks in [MB]
+        njobs:   number of processes filtering blocks in parallel, 1 to filter the blocks in the current process
+    Returns:
+        None, the results are written in VAR_out
+
+    ***NOTE***
+    The time series at each grid point are filtered independently so the results are identical to zeroPhi_filter(VAR_in[:]).
+    The blocks are taken along the largest non-time dimension and their size accounts for the ~4 double precision copies of
+    the block made by the filter.
+    '''
+    shape=VAR_in.shape
+    if len(shape)==1:
+        VAR_out[:]=zeroPhi_filter(VAR_in[:], btype, low_highcut, fs,axis=0,order=order,no_trend=no_trend)
+        return
+    axis=1+int(np.argmax(shape[1:]))
+    size_1slice=4*8*np.prod(shape,dtype=float)/shape[axis]
+    nblock=int(max(1,min(shape[axis],max_mem*1.e6//size_1slice)))
+    blocks=[tuple([slice(None)]*axis+[slice(i0,min(i0+nblock,shape[axis]))]) for i0 in range(0,shape[axis],nblock)]
+
+    if njobs<=1 or len(blocks)==1:
+        for iblock in blocks:
+            VAR_out[iblock]=zeroPhi_filter(VAR_in[iblock], btype, low_highcut, fs,axis=0,order=order,no_trend=no_trend)
+        return
+
+    #Blocks are read and written in the current process, at most 2 blocks per process are in memory at the same time
+    from concurrent.futures import ProcessPoolExecutor,wait,FIRST_COMPLETED
+    with ProcessPoolExecutor(max_workers=njobs) as executor:
+        pending={}
+        for iblock in blocks:
+            if len(pending)>=2*njobs:
+                done,_=wait(pending,return_when=FIRST_COMPLETED)
+                for ifuture in done:VAR_out[pending.pop(ifuture)]=ifuture.result()
+            pending[executor.submit(zeroPhi_filter,VAR_in[iblock], btype, low_highcut, fs,0,order,no_trend)]=iblock
+        for ifuture in wait(pending).done:
+            VAR_out[pending[ifuture]]=ifuture.result()
+
     
 def zonal_decomposition(VAR):
     '''
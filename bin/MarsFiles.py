@@ -11,6 +11,8 @@ import re
 import glob
 import shutil
 import subprocess
+import time
+import json
 import numpy as np
 from netCDF4 import Dataset
 import warnings #Suppress certain errors when dealing with NaN arrays
@@ -19,9 +21,11 @@ import warnings #Suppress certain errors when dealing with NaN arrays
 
 #===========
 from amesgcm.Ncdf_wrapper import Ncdf, Fort
-from amesgcm.FV3_utils import tshift,daily_to_average,daily_to_diurn,get_trend_2D
+from amesgcm.FV3_utils import set_precision,tshift,tshift_weights,daily_to_average,daily_to_diurn,get_trend_2D
 #from amesgcm.FV3_utils import regrid_Ncfile #regrid source
 from amesgcm.Script_utils import prYellow,prCyan,prRed,find_tod_in_diurn,FV3_file_type,filter_vars,regrid_Ncfile
+from amesgcm.Parallel_utils import run_file_jobs
+from amesgcm.Orbit_utils import ls2sol_1year,ls2sol
 #==========
 
 
@@ -117,6 +121,14 @@ parser.add_argument('-za','--zonal_avg', action='store_true',
             """> Usage: MarsFiles.py *.atmos_diurn.nc -za \n"""
             """ \n""")
 
+parser.add_argument('-pipe','--pipeline',type=str,default=None,
+        help="""Apply a sequence of operations in a single pass: each variable is read once and only the final file is written \n"""
+            """> Available steps: 'ba:nday' (bin_average), 'bd:nday' (bin_diurn), 'tshift' or 'tshift:3 15' (target local times), 'za' (zonal_avg)\n"""
+            """>                  'hpf:sol_min', 'lpf:sol_max', 'bpf:sol_min sol_max' (temporal filters, use with --no_trend if needed)\n"""
+            """> Usage: MarsFiles.py *.atmos_daily.nc --pipeline bd:5,tshift,za \n"""
+            """>        MarsFiles.py *.atmos_daily.nc --pipeline recipe.txt  (one step per line, e.g. '- bd:5') \n"""
+            """ \n""")
+
 parser.add_argument('-include','--include',nargs='+',
                      help="""For data reduction, filtering, time-shift, only include listed variables. Dimensions and 1D variables are always included \n"""
                          """> Usage: MarsFiles.py *.atmos_daily.nc -ba --include ps ts ucomp    \n"""
@@ -126,6 +138,20 @@ parser.add_argument('-e','--ext',type=str,default=None,
                  help="""> Append an extension _ext.nc to the output file instead of replacing any existing file \n"""
                       """>  Usage: MarsFiles.py ****.atmos.average.nc [actions] -ext B \n"""
                       """   This will produce   ****.atmos.average_B.nc files     \n""")
+
+parser.add_argument('-j','--jobs',type=int,default=1,
+                 help="""> Number of files processed in parallel for --fv3, --tshift, --bin_average, --bin_diurn, filtering, --tidal, --regrid_source, --zonal_avg and --pipeline \n"""
+                      """>  When a single file is filtered (-hpf, -lpf, -bpf), number of processes filtering blocks of that file \n"""
+                      """>  [DEFAULT is 1, one file at the time]  \n"""
+                      """>  Usage: MarsFiles.py *.atmos_daily.nc -ba --jobs 8 \n""")
+parser.add_argument('-mem','--max_mem',type=float,default=None,
+                 help="""> Memory budget in [MB] for --jobs, the number of processes is reduced so the files processed at the same time fit in memory \n"""
+                      """>  Usage: MarsFiles.py fort.11_* -fv3 fixed average daily --jobs 8 --max_mem 4000 \n"""
+                      """>  With --combine, size of the slabs in [MB] used to append each variable [DEFAULT is 500] \n"""
+                      """>  With -hpf, -lpf and -bpf, size of the blocks in [MB] filtered at once [DEFAULT is 500] \n""")
+parser.add_argument('-prec','--precision',type=str,default='float32',choices=['float32','float64'],
+                 help="""> Floating point precision of the calculations [DEFAULT is float32, the precision of the files] \n"""
+                      """>  Usage: MarsFiles.py *.atmos_daily.nc -rs target.nc --precision float64 \n""")
 parser.add_argument('--debug',  action='store_true', help='Debug flag: release the exceptions')
 
 
@@ -135,7 +161,59 @@ parser.add_argument('--debug',  action='store_true', help='Debug flag: release t
 cat_method='internal'
 def main():
     file_list=parser.parse_args().input_file
+    filtering=parser.parse_args().high_pass_filter or parser.parse_args().low_pass_filter or parser.parse_args().band_pass_filter
+    #--combine uses the list of files as a whole, the other operations (including --fv3) process each file independently
+    if parser.parse_args().jobs>1 and filtering and len(file_list)==1:
+        #A single file is filtered by blocks on the pool of processes
+        process_files(file_list,parser.parse_args().jobs)
+    elif parser.parse_args().jobs>1 and not parser.parse_args().combine:
+        if parser.parse_args().fv3:
+            #The --fv3 output names come from the first date in each file, read them before starting the jobs
+            output_list=[fv3_output_names(filei,parser.parse_args().fv3) for filei in file_list]
+        else:
+            #The output names are derived from the input names, so two jobs write the same output only if they process the same file
+            output_list=[os.path.join(os.getcwd(),filei) for filei in file_list]
+        run_file_jobs(process_one_file,file_list,parser.parse_args().jobs,output_list,parser.parse_args().max_mem)
+    else:
+        process_files(file_list)
+
+def fv3_output_names(filei,typelistfv3):
+    '''
+    Return the files written by --fv3 for one LegacyGCM_*.nc or fort.11 file, as named in make_FV3_files() and Fort.write_to_files()
+    Args:
+        filei (str)       : LegacyGCM_*.nc or fort.11 file
+        typelistfv3 (list): requested file types, e.g. ['fixed','average','daily','diurn']
+    Returns:
+        output_list (list): full path to the output files
+    ***NOTE***
+    The names start with the first date in the file (e.g. 00220.atmos_daily.nc), so two different input files can write the same outputs.
+    LegacyGCM_*.nc files are converted in the current directory, fort.11 files in their own directory.
+    '''
+    if filei[-3:]=='.nc':
+        histfile=Dataset(filei,'r')
+        fdate='%05i'%(ls2sol_1year(histfile.variables['ls'][0]))
+        histfile.close()
+        histdir=os.getcwd()
+    else:
+        f=Fort(filei)
+        #Only fort.11 files are converted
+        if not hasattr(f,'fdate'):return os.path.abspath(filei)
+        fdate=f.fdate
+        histdir=os.path.abspath(f.path)
+    return [os.path.join(histdir,fdate+'.atmos_%s.nc'%(typefv3)) if typefv3!='fixed' else os.path.join(histdir,fdate+'.fixed.nc') for typefv3 in typelistfv3]
+
+def process_one_file(filei):
+    '''
+    Apply the requested operation to a single file, this is the function executed by each job when --jobs is used
+    '''
+    process_files([filei])
+
+def process_files(file_list,njobs_blocks=1):
+    '''
+    Apply the requested operation to the list of files. njobs_blocks is the number of processes used to filter the blocks of a file (-hpf, -lpf, -bpf)
+    '''
     cwd=os.getcwd()
+    set_precision(parser.parse_args().precision)
     path2data=os.getcwd()
 
     if parser.parse_args().fv3 and parser.parse_args().combine:
@@ -188,10 +266,8 @@ def main():
             print('Processing fort.11 files')
             for fname in histlist:
                 f=Fort(fname)
-                if 'fixed' in parser.parse_args().fv3: f.write_to_fixed()
-                if 'average' in parser.parse_args().fv3: f.write_to_average()
-                if 'daily' in parser.parse_args().fv3: f.write_to_daily()
-                if 'diurn' in parser.parse_args().fv3: f.write_to_diurn()
+                #All the requested files are written in a single pass over the fort.11 file
+                f.write_to_files(parser.parse_args().fv3)
 
 
 
@@ -221,9 +297,9 @@ def main():
             p = subprocess.Popen(catdiu, universal_newlines=True, shell=True)
             p.wait()
             os.chdir(cwd)
-            p = subprocess.run('rm -f Ls*.nc', universal_newlines=True, shell=True)
-            p = subprocess.run('mv temp/*.nc .', universal_newlines=True, shell=True)
-            p = subprocess.run('rm -rf temp/', universal_newlines=True, shell=True)
+            for ifile in glob.glob('Ls*.nc'):os.remove(ifile)
+            for ifile in glob.glob(os.path.join(tempdir,'*.nc')):os.replace(ifile,os.path.basename(ifile))
+            shutil.rmtree(tempdir)
             if do_1year:
                 a=make_FV3_files(hist1year,cwd)
         #=================================
@@ -240,10 +316,8 @@ def main():
             fnum = len(histlist)
             #Easy case: merging *****.fixed.nc means delete all but the first file:
             if file_list[0][5:]=='.fixed.nc' and fnum>=2:
-                rm_cmd='rm -f '
                 for i in range(1,fnum):
-                    rm_cmd+=' '+histlist[i]
-                p = subprocess.run(rm_cmd, universal_newlines=True, shell=True)
+                    if os.path.exists(histlist[i]):os.remove(histlist[i])
                 prCyan('Cleaned all but '+file_list[0])
                 exit()
             #=========
@@ -258,14 +332,6 @@ def main():
             else:
                 exclude_list=[]
 
-            #this is a temporaty file ***_tmp.nc
-            file_tmp=histlist[0][:-3]+'_tmp'+'.nc'
-            Log=Ncdf(file_tmp,'Merged file')
-            Log.merge_files_from_list(histlist,exclude_var=exclude_list)
-            Log.close()
-
-            #=====Delete files that have been combined====
-
             #Rename merged file  LegacyGCM_LsINI_LsEND.nc or first files of the list (e.g 00010.atmos_average.nc)
             if file_list[0][:12]=='LegacyGCM_Ls':
                 ls_ini=file_list[0][12:15]
@@ -275,14 +341,34 @@ def main():
             else:
                 fileout=histlist[0]
 
-            #---Assemble 'remove' and 'move' commands to execute-----
-            rm_cmd='rm -f '
-            for ifile in histlist:
-                rm_cmd+=' '+ifile
-            cmd_txt='mv '+file_tmp+' '+fileout
-            p = subprocess.run(rm_cmd, universal_newlines=True, shell=True)
-            p = subprocess.run(cmd_txt, universal_newlines=True, shell=True)
-            prCyan(fileout +' was merged')
+            #The records are appended by slabs of at most --max_mem MB for each variable (500 MB by default)
+            max_mem=parser.parse_args().max_mem if parser.parse_args().max_mem else 500.
+            try:
+                combine_files(histlist,fileout,exclude_list,max_mem)
+            except Exception as exception:
+                if parser.parse_args().debug:raise
+                prRed('***Error*** %s, the files were not merged'%(exception))
+                exit()
+
+    #===========================================================================
+    #=========  Chain of operations applied while reading each variable once ====
+    #===========================================================================
+    elif parser.parse_args().pipeline:
+        steps=parse_pipeline(parser.parse_args().pipeline)
+        for filei in file_list:
+            #Add path unless full path is provided
+            if not ('/' in filei):
+                fullnameIN = path2data + '/' + filei
+            else:
+                fullnameIN=filei
+            #Same name as when the operations are applied one after the other, e.g. ***_to_diurn_T_zonal_avg.nc
+            fullnameOUT = fullnameIN[:-3]+''.join([PIPELINE_STEPS[name] for name,_ in steps])+'.nc'
+            if parser.parse_args().no_trend and any([name in ['hpf','lpf','bpf'] for name,_ in steps]):fullnameOUT=fullnameOUT[:-3]+'_no_trend.nc'
+
+            #Append extension, in any:
+            if parser.parse_args().ext:fullnameOUT=fullnameOUT[:-3]+'_'+parser.parse_args().ext+'.nc'
+
+            process_pipeline(fullnameIN,fullnameOUT,steps)
 
 #===============================================================================
 #================= Tshift implementation by Victoria H. ===========================
@@ -361,6 +447,8 @@ def main():
 
             # read 4D field and do time shift
             longitude = np.array(fdiurn.variables['lon'])
+            #The interpolation weights only depend on the longitudes and local times, compute them once for all the variables
+            weights=tshift_weights(longitude,tod_orig,timex=tod_in)
             var_list = filter_vars(fdiurn,parser.parse_args().include) # get all variables
 
             for ivar in var_list:
@@ -375,7 +463,7 @@ def main():
                     itime = vkeys.index('time')
                     itod = vkeys.index(tod_name_in)
                     newvar = np.transpose(varIN,(ilon,ilat,itime,itod))
-                    newvarOUT = tshift(newvar,longitude,tod_orig,timex=tod_in)
+                    newvarOUT = tshift(newvar,longitude,tod_orig,timex=tod_in,weights=weights)
                     varOUT = np.transpose(newvarOUT, (2,3,1,0))
                     fnew.log_variable(ivar,varOUT,['time',tod_name_out,'lat','lon'],long_name_txt,units_txt)
                 if (len(vkeys) == 5):
@@ -385,7 +473,7 @@ def main():
                     itime = vkeys.index('time')
                     itod = vkeys.index(tod_name_in)
                     newvar = np.transpose(varIN,(ilon,ilat,iz,itime,itod))
-                    newvarOUT = tshift(newvar,longitude,tod_orig,timex=tod_in)
+                    newvarOUT = tshift(newvar,longitude,tod_orig,timex=tod_in,weights=weights)
                     varOUT = np.transpose(newvarOUT,(3,4,2,1,0))
                     fnew.log_variable(ivar,varOUT,['time',tod_name_out,zaxis,'lat','lon'],long_name_txt,units_txt)
             fnew.close()
@@ -535,7 +623,10 @@ def main():
 
 
         # This functions requires scipy > 1.2.0 , so we only import the package here if needed
-        from amesgcm.Spectral_utils import zeroPhi_filter
+        from amesgcm.Spectral_utils import zeroPhi_filter_blocks
+        #Size of the blocks filtered at once in [MB], and processes used for the blocks when a single file is filtered
+        max_mem=parser.parse_args().max_mem if parser.parse_args().max_mem else 500.
+        njobs=njobs_blocks
 
         if parser.parse_args().high_pass_filter:
             btype='high';out_ext='_hpf';nsol=np.asarray(parser.parse_args().high_pass_filter).astype(float)
@@ -606,8 +697,9 @@ def main():
 
                 if 'time' in varNcf.dimensions and ivar not in ['time','areo'] :
                     prCyan("Processing: %s ..."%(ivar))
-                    var_out=zeroPhi_filter(varNcf[:], btype, low_highcut, fs,axis=0,order=4,no_trend=parser.parse_args().no_trend)
-                    fnew.log_variable(ivar,var_out,varNcf.dimensions,varNcf.long_name,varNcf.units)
+                    #Filter by blocks of the non-time dimensions, each block is written to the new file once filtered
+                    var_out=fnew.def_variable(ivar,varNcf.dimensions,varNcf.long_name,varNcf.units)
+                    zeroPhi_filter_blocks(varNcf, var_out, btype, low_highcut, fs,order=4,no_trend=parser.parse_args().no_trend,max_mem=max_mem,njobs=njobs)
                 else:
                     if  ivar in ['pfull', 'lat', 'lon','phalf','pk','bk','pstd','zstd','zagl']:
                         prCyan("Copying axis: %s..."%(ivar))
@@ -937,6 +1029,273 @@ def main():
 #*******************************************************************************
 
 
+def fsync_path(path):
+    '''
+    Flush a file, or the entries of a directory, to the disk.
+    '''
+    fd=os.open(path,os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def write_journal(file_journal,journal):
+    '''
+    Write the journal of a merge to the disk. The journal is written to a temporary file first so a manifest is never partially written.
+    '''
+    with open(file_journal+'.part','w') as f:
+        json.dump(journal,f,indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(file_journal+'.part',file_journal)
+
+def combine_files(histlist,fileout,exclude_list=[],max_mem=500.):
+    '''
+    Concatenate files along the 'time' dimension, with a journal so an interrupted merge can be resumed.
+    Args:
+        histlist    : list of files to merge, with the full path
+        fileout     : merged file, e.g. the first file of the list
+        exclude_list: variables not to include in the merged file
+        max_mem     : size of the slabs in [MB] used to append each variable
+    ***NOTE***
+    The records are appended to a temporary file ***_tmp.nc and the files already appended are listed in the sidecar manifest ***_tmp.json.
+    If the merge is interrupted, running the same command again resumes after the last file that was completely appended. The temporary file
+    is flushed to the disk and renamed as fileout in a single operation, and the input files are deleted only after that.
+    '''
+    file_tmp=histlist[0][:-3]+'_tmp'+'.nc'
+    file_journal=histlist[0][:-3]+'_tmp'+'.json'
+    journal=None
+    if os.path.exists(file_journal):
+        with open(file_journal,'r') as f:
+            journal=json.load(f)
+    #---The merged file is already in place, only the inputs need to be deleted---
+    if journal and journal['state']=='renamed':
+        prYellow('Resuming the merge of %s: the merged file is complete, deleting the input files'%(journal['output']))
+    else:
+        Log=None
+        if journal and journal['inputs']==histlist and journal['output']==fileout and os.path.exists(file_tmp):
+            try:
+                Log=Ncdf(file_tmp,action='a')
+                nskip=len(journal['done'])
+                prYellow('Resuming the merge of %s, %i out of %i files were already appended'%(fileout,nskip,len(histlist)))
+            except Exception:
+                prYellow('%s could not be opened, starting over'%(file_tmp))
+        if Log is None:
+            journal={'inputs':histlist,'output':fileout,'state':'merging','done':[],'ntime':0}
+            write_journal(file_journal,journal)
+            Log=Ncdf(file_tmp,'Merged file')
+            nskip=0
+
+        def on_file_done(ifile,nt):
+            journal['done'].append(ifile)
+            journal['ntime']=nt
+            write_journal(file_journal,journal)
+
+        start_time=time.time()
+        try:
+            nbytes=Log.merge_files_from_list(histlist,exclude_var=exclude_list,max_mem=max_mem,nskip=nskip,on_file_done=on_file_done)
+        finally:
+            Log.f_Ncdf.close()
+        wall_time=time.time()-start_time
+        prCyan('Appended %.1f MB in %.2f sec (%.1f MB/s)'%(nbytes/1.e6,wall_time,nbytes/1.e6/max(wall_time,1.e-6)))
+
+        #---Replace the output by the merged file---
+        fsync_path(file_tmp)
+        os.replace(file_tmp,fileout)
+        fsync_path(os.path.dirname(os.path.abspath(fileout)))
+        journal['state']='renamed'
+        write_journal(file_journal,journal)
+
+    #=====Delete files that have been combined, the first one last so the manifest can be found until the end====
+    for ifile in journal['inputs'][::-1]:
+        if os.path.abspath(ifile)!=os.path.abspath(journal['output']) and os.path.exists(ifile):os.remove(ifile)
+    os.remove(file_journal)
+    prCyan(journal['output'] +' was merged')
+
+#Steps available with --pipeline and the extension they add to the file name, as the individual operations
+PIPELINE_STEPS={'ba':'_to_average','bd':'_to_diurn','tshift':'_T','za':'_zonal_avg','hpf':'_hpf','lpf':'_lpf','bpf':'_bpf'}
+
+def parse_pipeline(recipe):
+    '''
+    Return the list of operations requested with --pipeline.
+    Args:
+        recipe: comma-separated steps, e.g. 'bd:5,tshift,za', or a text file with one step per line. Comments (#) and leading dashes
+                are ignored so a YAML list, e.g. '- bd:5', may be used.
+    Returns:
+        steps: list of (name, arguments) e.g. [('bd',[5.]),('tshift',[]),('za',[])]
+    '''
+    if os.path.isfile(recipe):
+        with open(recipe,'r') as f:
+            items=[line.split('#')[0].strip().lstrip('-').strip() for line in f]
+    else:
+        items=[item.strip() for item in recipe.split(',')]
+    steps=[]
+    for item in [item for item in items if item]:
+        name,_,args_txt=item.partition(':')
+        name=name.strip()
+        if name not in PIPELINE_STEPS.keys():
+            prRed("""***Error*** '%s' is not available with --pipeline, use %s"""%(name,', '.join(PIPELINE_STEPS.keys())))
+            exit()
+        try:
+            args=[float(val) for val in args_txt.split()]
+        except ValueError:
+            prRed("""***Error*** could not read the values for '%s'"""%(item))
+            exit()
+        nargs={'ba':[0,1],'bd':[0,1],'tshift':range(0,100),'za':[0],'hpf':[1],'lpf':[1],'bpf':[2]}[name]
+        if len(args) not in nargs:
+            prRed("""***Error*** wrong number of values for '%s'"""%(item))
+            exit()
+        steps.append((name,args))
+    if not steps:
+        prRed('***Error*** no operation requested with --pipeline')
+        exit()
+    return steps
+
+def pipeline_axes(name,args,axes):
+    '''
+    Return the axes after one step of --pipeline, with what is needed to process the variables (e.g. the interpolation weights for tshift)
+    Args:
+        name,args: step and its arguments, see parse_pipeline()
+        axes     : dictionary with the 'time', 'lon', time of day ('tod','tod_name', None if not a diurn file) and 'constants' before the step
+    Returns:
+        axes_out : the axes after the step
+    '''
+    axes_out=dict(axes)
+    time_in=axes['time']
+    if name in ['ba','bd']:
+        nday=int(args[0]) if args else 5
+        dt_in=time_in[1]-time_in[0]
+        iperday=int(np.round(1/dt_in))
+        combinedN=int(iperday*nday)
+        if len(time_in)%combinedN!=0:
+            prYellow('***Warning*** requested  %i sols bin period. File has %i timestep/sols and %i/(%i x %i) is not a round number'%(nday,iperday,len(time_in),nday,iperday))
+        axes_out.update(nday=nday,dt_in=dt_in,iperday=iperday)
+        axes_out['time']=daily_to_average(time_in,dt_in,nday)
+        if name=='bd':
+            axes_out['tod_name']='time_of_day_%02d'%(iperday)
+            axes_out['tod']=np.mod(np.squeeze(daily_to_diurn(time_in[0:iperday],time_in[0:iperday]))*24,24)
+    elif name=='tshift':
+        if axes['tod'] is None:
+            prRed('***Error*** tshift requires a time of day axis, use a diurn file or a bd step first')
+            exit()
+        timex=np.array(args) if args else None
+        axes_out['weights']=tshift_weights(axes['lon'],axes['tod'],timex=timex)
+        if timex is not None:
+            axes_out['tod_name']='time_of_day_%02i'%(len(timex))
+            axes_out['tod']=timex
+            #Closest time of day in the input, for areo
+            axes_out['it_closest']=[np.argmin(np.abs(tt-axes['tod'])) for tt in timex]
+    elif name=='za':
+        axes_out['lon']=np.array([axes['lon'].mean()])
+    else:
+        nsol=np.array(args)
+        dt=time_in[1]-time_in[0]
+        if any(nn <= 2*dt for nn in nsol):
+            prRed('***Error***  min cut-off cannot be smaller than the Nyquist period of 2xdt=%g sol'%(2*dt))
+            exit()
+        btype={'hpf':'high','lpf':'low','bpf':'band'}[name]
+        if btype=='low':
+            axes_out['constants']=axes['constants']+[('sol_max',nsol[0],"Low-pass filter cut-off period ")]
+        elif btype=='high':
+            axes_out['constants']=axes['constants']+[('sol_min',nsol[0],"High-pass filter cut-off period ")]
+        else:
+            axes_out['constants']=axes['constants']+[('sol_min',nsol[0],"High-pass filter low cut-off period "),('sol_max',nsol[1],"High-pass filter high cut-off period ")]
+        # Flip the sols so the low frequency comes first for the band pass filter
+        axes_out.update(btype=btype,fs=1/dt,low_highcut=1/nsol[::-1] if btype=='band' else 1./nsol)
+    return axes_out
+
+def pipeline_var(name,ivar,var,dims,axes,axes_out):
+    '''
+    Apply one step of --pipeline to a variable, with the same conventions as the corresponding individual operation.
+    Args:
+        name    : step, see parse_pipeline()
+        ivar    : variable name
+        var,dims: values and dimensions of the variable
+        axes,axes_out: axes before and after the step, see pipeline_axes()
+    Returns:
+        var,dims: the values and dimensions after the step, or None,None if the variable cannot be kept in the output
+    '''
+    if name=='ba':
+        if 'time' in dims:var=daily_to_average(var,axes_out['dt_in'],axes_out['nday'])
+    elif name=='bd':
+        if 'time' in dims:
+            var=daily_to_diurn(var,axes['time'][0:axes_out['iperday']])
+            if axes_out['nday']!=1:var=daily_to_average(var,1.,axes_out['nday']) #dt is 1 sol between two diurn timestep
+            dims=(dims[0],axes_out['tod_name'])+tuple(dims[1:])
+    elif name=='tshift':
+        tod_name=axes['tod_name']
+        if tod_name in dims:
+            if len(dims) in [4,5] and dims[:2]==('time',tod_name) and dims[-1]=='lon':
+                #[time,tod,(lev),lat,lon] > [lon,time,(lev),lat,tod] as expected by tshift(), and back
+                var=np.moveaxis(var,[-1,1],[0,-1])
+                var=np.moveaxis(tshift(var,axes['lon'],axes['tod'],timex=axes_out['tod'] if 'it_closest' in axes_out else None,weights=axes_out['weights']),[0,-1],[-1,1])
+            elif 'it_closest' in axes_out and ivar=='areo':
+                var=np.take(var,axes_out['it_closest'],axis=dims.index(tod_name))
+            elif 'it_closest' in axes_out:
+                return None,None
+            dims=tuple([axes_out['tod_name'] if dd==tod_name else dd for dd in dims])
+    elif name=='za':
+        if ivar in ['grid_xt_bnds','grid_yt_bnds']:return None,None
+        if dims[-1]=='lon':
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", category=RuntimeWarning)
+                var=np.nanmean(var,axis=-1)[...,np.newaxis]
+    else:
+        if 'time' in dims and ivar!='areo':
+            from amesgcm.Spectral_utils import zeroPhi_filter
+            var=zeroPhi_filter(var, axes_out['btype'], axes_out['low_highcut'], axes_out['fs'],axis=0,order=4,no_trend=parser.parse_args().no_trend)
+    return var,dims
+
+def process_pipeline(fullnameIN,fullnameOUT,steps):
+    '''
+    Apply the --pipeline operations to a file: each variable is read once, goes through all the steps in memory and is written to the final file.
+    Args:
+        fullnameIN : input file, e.g. atmos_daily or atmos_diurn
+        fullnameOUT: output file
+        steps      : list of operations, see parse_pipeline()
+    '''
+    fIN = Dataset(fullnameIN, 'r', format='NETCDF4_CLASSIC')
+    var_list = filter_vars(fIN,parser.parse_args().include) # get all variables
+    tod_list=[idim for idim in fIN.dimensions.keys() if idim.startswith('time_of_day')]
+    tod_name=tod_list[0] if tod_list else None
+
+    #---Axes after each step, computed before reading any variable---
+    axes_list=[{'time':np.array(fIN.variables['time'][:]),'lon':np.array(fIN.variables['lon'][:]),'tod_name':tod_name,
+                'tod':np.array(fIN.variables[tod_name][:]) if tod_name else None,'constants':[]}]
+    for name,args in steps:
+        axes_list.append(pipeline_axes(name,args,axes_list[-1]))
+    axes=axes_list[-1]
+
+    fnew = Ncdf(fullnameOUT) # define a Ncdf object from the Ncdf wrapper module
+    #Copy all dims but the ones that may be modified by the pipeline
+    fnew.copy_all_dims_from_Ncfile(fIN,exclude_dim=['time','lon',tod_name])
+    fnew.add_dimension('time',None)
+    fnew.log_axis1D('time',axes['time'],'time',longname_txt="sol number",units_txt='days since 0000-00-00 00:00:00',cart_txt='T')
+    fnew.add_dim_with_content('lon',axes['lon'],longname_txt="longitude",units_txt="degrees_E",cart_txt='X')
+    if axes['tod_name']:fnew.add_dim_with_content(axes['tod_name'],axes['tod'],longname_txt="time of day",units_txt="hours since 0000-00-00 00:00:00",cart_txt='N')
+    for cst_name,value,longname_txt in axes['constants']:fnew.add_constant(cst_name,value,longname_txt,"sol")
+
+    #Loop over all variables in file
+    for ivar in var_list:
+        varNcf     = fIN.variables[ivar]
+        if ivar in ['time','lon',tod_name]:
+            continue
+        elif ivar in ['pfull', 'lat','phalf','pk','bk','pstd','zstd','zagl']:
+            prCyan("Copying axis: %s..."%(ivar))
+            fnew.copy_Ncaxis_with_content(varNcf)
+        else:
+            prCyan("Processing: %s ..."%(ivar))
+            var,dims=varNcf[:],varNcf.dimensions
+            for (name,args),axes_in,axes_out in zip(steps,axes_list[:-1],axes_list[1:]):
+                var,dims=pipeline_var(name,ivar,var,dims,axes_in,axes_out)
+                if var is None:break
+            if var is None:
+                prYellow('  %s is not compatible with the pipeline, skipping'%(ivar))
+                continue
+            fnew.log_variable(ivar,var,dims,getattr(varNcf,'long_name',ivar),getattr(varNcf,'units',''))
+    fnew.close()
+    fIN.close()
+
 def make_FV3_files(fpath,typelistfv3,renameFV3=True,cwd=None):
     '''
     Make FV3-type atmos_average,atmos_daily,atmos_diurn
@@ -1015,29 +1374,15 @@ def make_FV3_files(fpath,typelistfv3,renameFV3=True,cwd=None):
         #===========END function========
 
 
-    if 'average' in typelistfv3:
-        newfname_avg = fdate+'.atmos_average.nc'  #5 sol averages over tod and time
-        newfpath_avg = os.path.join(histdir,newfname_avg)
-        newfavg = Ncdf(newfpath_avg)
-        proccess_file(newfavg,'average')
-        do_avg_vars(histfile,newfavg,True,True)
-        newfavg.close()
-
-    if 'daily' in typelistfv3:
-        newfname_daily = fdate+'.atmos_daily.nc'  #daily snapshot output...this is exactly the current output?
-        newfpath_daily = os.path.join(histdir,newfname_daily)
-        newfdaily = Ncdf(newfpath_daily)
-        proccess_file(newfdaily,'daily')
-        do_avg_vars(histfile,newfdaily,False,False)
-        newfdaily.close()
-
-    if 'diurn' in typelistfv3:
-        newfname_diurn = fdate+'.atmos_diurn.nc'  #5 sol averages over time only
-        newfpath_diurn = os.path.join(histdir,newfname_diurn)
-        newfdiurn = Ncdf(newfpath_diurn)
-        proccess_file(newfdiurn,'diurn')
-        do_avg_vars(histfile,newfdiurn,True,False)
-        newfdiurn.close()
+    #Create all the requested files, each variable is then read once and logged to all of them
+    newf_dict={}
+    for typefv3 in ['average','daily','diurn']:
+        if typefv3 in typelistfv3:
+            newfpath = os.path.join(histdir,fdate+'.atmos_%s.nc'%(typefv3)) #average: 5 sol averages over tod and time, diurn: 5 sol averages over time only
+            newf_dict[typefv3] = Ncdf(newfpath)
+            proccess_file(newf_dict[typefv3],typefv3)
+    if newf_dict:do_avg_vars(histfile,newf_dict)
+    for newf in newf_dict.values():newf.close()
 
     if 'fixed' in typelistfv3:
     #Copy Legacy.fixed to current directory
@@ -1047,16 +1392,31 @@ def make_FV3_files(fpath,typelistfv3,renameFV3=True,cwd=None):
 
 
 
+#Time averaging (avgtime) and time of day averaging (avgtod) performed for each type of file
+avg_flags={'average':(True,True),'daily':(False,False),'diurn':(True,False)}
+
 #Function to perform time averages over all fields
-def do_avg_vars(histfile,newf,avgtime,avgtod,Nday=5):
+def do_avg_vars(histfile,newf_dict,Nday=5):
+    '''
+    Perform the time averages over all fields and log them to the new files.
+    Args:
+        histfile : Legacy file (netCDF4 Dataset)
+        newf_dict: Ncdf objects for the new files, e.g. {'average':newfavg,'diurn':newfdiurn}
+        Nday     : number of sols in the averaging bins
+    ***NOTE***
+    Each variable is read once, and all the requested files are derived from the same array.
+    '''
     histvars = histfile.variables.keys()
+    ntod  = histfile.dimensions['ntod']
     for vname in histvars:
         var     = histfile.variables[vname]
-        npvar = var[:]
         dims  = var.dimensions
-        ndims = npvar.ndim
-        vshape= npvar.shape
-        ntod  = histfile.dimensions['ntod']
+        ndims = len(dims)
+        #Only the solar longitude, the 4D and 5D variables and the time of day are logged
+        if not (ndims==1 and vname=='ls' or ndims in [4,5] or vname=='tloc'):continue
+        if vname!='tloc':
+            npvar = var[:]
+            vshape= npvar.shape
 
         longname_txt=getattr(histfile.variables[vname],'long_name','')
 
@@ -1065,88 +1425,83 @@ def do_avg_vars(histfile,newf,avgtime,avgtod,Nday=5):
 
         units_txt=getattr(histfile.variables[vname],'units','')
 
-        if avgtod:
-            newdims  = replace_dims(dims,True)
-        elif avgtime:
-            newdims  = replace_dims(dims,False)
-        else:
-            newdims  = replace_dims(dims,True)
-
-
         if 'time' in dims:
-            tind = dims.index('time')
-            tind_new= newdims.index('time')
             numt = histfile.dimensions['time'].size
-        #TODO fix time !!
-        #now do various time averaging and write to files
-        if ndims == 1:
-            if vname == 'ls':
-                #first check if spans new year
 
-                if not np.all(npvar[1:] >= npvar[:-1]):
-                    year = 0.
-                    for x in range(1,npvar.size):
-                        if 350. < npvar[x-1] < 360. and npvar[x] < 10.:
-                            year += 1.
-                        npvar[x] += 360.*year
+        if vname == 'ls':
+            #first check if spans new year, and add 360 to all the values after the new year
+            if not np.all(npvar[1:] >= npvar[:-1]):
+                new_year=np.logical_and(np.logical_and(npvar[:-1]>350.,npvar[:-1]<360.),npvar[1:]<10.)
+                npvar[1:]+=360.*np.cumsum(new_year)
+            ls_start = npvar[0]
+            ls_end   = npvar[-1]
+            #ls_end is past 360 if the file spans a new year, the sol number keeps increasing
+            sol_start,sol_end=np.round(ls2sol(np.array([ls_start,ls_end])),-1)
+
+        for typefv3,newf in newf_dict.items():
+            avgtime,avgtod=avg_flags[typefv3]
+            if avgtod:
+                newdims  = replace_dims(dims,True)
+            elif avgtime:
+                newdims  = replace_dims(dims,False)
+            else:
+                newdims  = replace_dims(dims,True)
 
+            #TODO fix time !!
+            #now do various time averaging and write to files
+            if vname == 'ls':
                 #Create a time array
-                time0=ls2sol_1year(npvar[0])+np.linspace(0,10.,len(npvar))
-
+                time0=sol_start+np.linspace(0,10.,len(npvar))
                 if avgtime:
                     varnew = np.mean(npvar.reshape(-1,Nday),axis=1)
                     time0 =  np.mean(time0.reshape(-1,Nday),axis=1)
 
                 if not avgtime and not avgtod: #i.e daily file
                     # Solar longitude
-                    ls_start = npvar[0]
-                    ls_end   = npvar[-1]
                     step     = (ls_end-ls_start)/np.float32(((numt-1)*ntod.size))
                     varnew = np.arange(0,numt*ntod.size,dtype=np.float32)
                     varnew[:] = varnew[:]*step+ls_start
 
                     #Time
-                    step = (ls2sol_1year(ls_end)-ls2sol_1year(ls_start))/np.float32((numt*ntod.size))
+                    step = (sol_end-sol_start)/np.float32((numt*ntod.size))
                     time0 = np.arange(0,numt*ntod.size,dtype=np.float32)
-                    time0[:] = time0[:]*step+ls2sol_1year(ls_start)
+                    time0[:] = time0[:]*step+sol_start
 
                 newf.log_axis1D('areo',varnew,dims,longname_txt='solar longitude',units_txt='degree',cart_txt='T')
                 newf.log_axis1D('time',time0,dims,longname_txt='sol number',units_txt='days since 0000-00-00 00:00:00',cart_txt='T')#added AK
-            else:
-                continue
-        elif ndims == 4:
-            varnew = npvar
-            if avgtime:
-                varnew = np.mean(npvar.reshape(-1,Nday,vshape[1],vshape[2],vshape[3]),axis=1)
-            if avgtod:
-                varnew = varnew.mean(axis=1)
-            if not avgtime and not avgtod:
-                varnew = npvar.reshape(-1,vshape[2],vshape[3])
-            #Rename variable
-            vname2,longname_txt2,units_txt2=change_vname_longname_unit(vname,longname_txt,units_txt)
-            #AK convert surface pressure from mbar to Pa
-            if vname2=='ps':varnew*=100.
-            newf.log_variable(vname2,varnew,newdims,longname_txt2,units_txt2)
-        elif ndims == 5:
-            varnew = npvar
-            if avgtime:
-                varnew = np.mean(npvar.reshape(-1,Nday,vshape[1],vshape[2],vshape[3],vshape[4]),axis=1)
-            if avgtod:
-                varnew = varnew.mean(axis=1)
-            if not avgtime and not avgtod:
-                varnew = npvar.reshape(-1,vshape[2],vshape[3],vshape[4])
-            #Rename variables
-            vname2,longname_txt2,units_txt2=change_vname_longname_unit(vname,longname_txt,units_txt)
-            newf.log_variable(vname2,varnew,newdims,longname_txt2,units_txt2)
-        elif vname == 'tloc':
-            if avgtime and not avgtod:
-                vname2='time_of_day_16'
-                longname_txt2='time of day'
-                units_txt2='hours since 0000-00-00 00:00:00'
-                # Overwrite tod from ('time_of_day_16', 'lon') to time_of_day_16
-                newdims=('time_of_day_16')
-                npvar=np.arange(0.75,24,1.5)  # every 1.5 hours, centered at half timestep ? AK
-                newf.log_variable(vname2,npvar,newdims,longname_txt2,units_txt2)
+            elif ndims == 4:
+                varnew = npvar
+                if avgtime:
+                    varnew = np.mean(npvar.reshape(-1,Nday,vshape[1],vshape[2],vshape[3]),axis=1)
+                if avgtod:
+                    varnew = varnew.mean(axis=1)
+                if not avgtime and not avgtod:
+                    varnew = npvar.reshape(-1,vshape[2],vshape[3])
+                #Rename variable
+                vname2,longname_txt2,units_txt2=change_vname_longname_unit(vname,longname_txt,units_txt)
+                #AK convert surface pressure from mbar to Pa. This is not done in place, npvar is used for the other files
+                if vname2=='ps':varnew=varnew*100.
+                newf.log_variable(vname2,varnew,newdims,longname_txt2,units_txt2)
+            elif ndims == 5:
+                varnew = npvar
+                if avgtime:
+                    varnew = np.mean(npvar.reshape(-1,Nday,vshape[1],vshape[2],vshape[3],vshape[4]),axis=1)
+                if avgtod:
+                    varnew = varnew.mean(axis=1)
+                if not avgtime and not avgtod:
+                    varnew = npvar.reshape(-1,vshape[2],vshape[3],vshape[4])
+                #Rename variables
+                vname2,longname_txt2,units_txt2=change_vname_longname_unit(vname,longname_txt,units_txt)
+                newf.log_variable(vname2,varnew,newdims,longname_txt2,units_txt2)
+            elif vname == 'tloc':
+                if avgtime and not avgtod:
+                    vname2='time_of_day_16'
+                    longname_txt2='time of day'
+                    units_txt2='hours since 0000-00-00 00:00:00'
+                    # Overwrite tod from ('time_of_day_16', 'lon') to time_of_day_16
+                    newdims=('time_of_day_16')
+                    tod=np.arange(0.75,24,1.5)  # every 1.5 hours, centered at half timestep ? AK
+                    newf.log_variable(vname2,tod,newdims,longname_txt2,units_txt2)
 
     return 0
 
@@ -1240,38 +1595,5 @@ def replace_at_index(tuple_dims, idx, new_name):
         return tuple_dims[:idx] + (new_name,) + tuple_dims[idx+1:]
 
 
-def ls2sol_1year(Ls_deg,offset=True,round10=True):
-    '''
-    Returns a sol number from the solar longitude.
-    Args:
-        Ls_deg: solar longitude in degree
-        offset : if True, make year starts at Ls 0
-        round10 : if True, round to the nearest 10 sols
-    Returns:
-        Ds :sol number
-    ***NOTE***
-    For the moment this is consistent with Ls 0->359.99, not for monotically increasing Ls
-    '''
-    Lsp=250.99   #Ls at perihelion
-    tperi=485.35 #Time (in sols) at perihelion
-    Ns=668.6     #Number of soils in 1 MY
-    e=0.093379   #from GCM: modules.f90
-    nu=(Ls_deg-Lsp)*np.pi/180
-    E=2*np.arctan(np.tan(nu/2)*np.sqrt((1-e)/(1+e)))
-    M=E-e*np.sin(E)
-    Ds= M/(2*np.pi)*Ns+tperi
-    #====Offset correction======
-    if offset:
-        #Ds is a float
-        if len(np.atleast_1d(Ds))==1:
-            Ds-=Ns
-            if Ds<0:Ds+=Ns
-        #Ds is an array
-        else:
-            Ds-=Ns
-            Ds[Ds<0]=Ds[Ds<0]+Ns
-    if round: Ds=np.round(Ds,-1)  #-1 means round to the nearest 10
-    return Ds
-
 if __name__ == "__main__":
     main()
@@ -7,11 +7,15 @@ import subprocess # run command
 import sys        # system command
 import time       # monitor interpolation time
 import re         # string matching module to handle time_of_day_XX
+from functools import partial # bind the interpolation settings to the function processing each file
+from concurrent.futures import ThreadPoolExecutor # interpolate several variables at once
 
-from amesgcm.FV3_utils import fms_press_calc,fms_Z_calc,vinterp,find_n,polar2XYZ,interp_KDTree,axis_interp
+from amesgcm.FV3_utils import set_precision,fms_press_calc,fms_Z_calc,fms_press_Z_calc,vinterp,vinterp_weights,vinterp_apply,find_n,polar2XYZ,interp_KDTree,axis_interp
 from amesgcm.Script_utils import check_file_tape,prYellow,prRed,prCyan,prGreen,prPurple, print_fileContent
 from amesgcm.Script_utils import section_content_amesgcm_profile,find_tod_in_diurn,filter_vars,find_fixedfile
 from amesgcm.Ncdf_wrapper import Ncdf
+from amesgcm.Parallel_utils import run_file_jobs
+from amesgcm.Cache_utils import cache_dir,hash_arrays,cache_load,cache_save
 
 #=====Attempt to import specific scientic modules one may not find in the default python on NAS ====
 try:
@@ -41,16 +45,20 @@ parser = argparse.ArgumentParser(description="""\033[93m MarsInterp, pressure in
 
 parser.add_argument('input_file', nargs='+', #sys.stdin
                              help='***.nc file or list of ***.nc files ')
-parser.add_argument('-t','--type',type=str,default='pstd',
+parser.add_argument('-t','--type',type=str,nargs='+',default=['pstd'],
                  help=""">  --type may be 'pstd', 'zstd' or 'zagl' [DEFAULT is pstd, 36 levels] \n"""
+                      """>  Several types may be requested, the variables are then read only once for all the output files \n"""
                       """>  Usage: MarsInterp.py ****.atmos.average.nc \n"""
-                      """          MarsInterp.py ****.atmos.average.nc -t zstd \n""")
+                      """          MarsInterp.py ****.atmos.average.nc -t zstd \n"""
+                      """          MarsInterp.py ****.atmos.average.nc -t pstd zstd zagl \n""")
 
-parser.add_argument('-l','--level',type=str,default=None,
+parser.add_argument('-l','--level',type=str,nargs='+',default=None,
                  help=""">  Layers ID as defined in your personal ~/.amesgcm_profile hidden file \n"""
                       """"(For 1st time set-up, copy \033[96mcp ~/amesGCM3/mars_templates/amesgcm_profile ~/.amesgcm_profile\033[00m )   \n"""
+                      """>  If several types are requested, provide one layer ID for each type \n"""
                       """>  Usage: MarsInterp.py ****.atmos.average.nc -t pstd -l p44 \n"""
-                      """          MarsInterp.py ****.atmos.average.nc -t zstd -l phalf_mb  \n""")
+                      """          MarsInterp.py ****.atmos.average.nc -t zstd -l phalf_mb  \n"""
+                      """          MarsInterp.py ****.atmos.average.nc -t pstd zstd -l p44 phalf_mb  \n""")
 
 parser.add_argument('-include','--include',nargs='+',
                      help="""Only include listed variables. Dimensions and 1D variables are always included \n"""
@@ -61,6 +69,24 @@ parser.add_argument('-e','--ext',type=str,default=None,
                  help="""> Append an extension _ext.nc to the output file instead of replacing any existing file \n"""
                       """>  Usage: MarsInterp.py ****.atmos.average.nc -ext B \n"""
                       """   This will produce   ****.atmos.average_pstd_B.nc files     \n""")
+
+parser.add_argument('-c','--chunk',type=int,default=None,
+                 help=""">  Process the file by slabs of N time steps to limit the memory usage [DEFAULT is the full file at once] \n"""
+                      """>  Usage: MarsInterp.py ****.atmos_daily.nc -t zstd --chunk 50 \n""")
+parser.add_argument('-j','--jobs',type=int,default=1,
+                 help=""">  Number of files processed in parallel [DEFAULT is 1, one file at the time] \n"""
+                      """>  Usage: MarsInterp.py *.atmos_average.nc -t pstd --jobs 8 \n""")
+parser.add_argument('-nt','--threads',type=int,default=1,
+                 help=""">  Number of variables interpolated in parallel within each file [DEFAULT is 1] \n"""
+                      """>  Usage: MarsInterp.py ****.atmos_diurn.nc -t pstd --threads 8 \n""")
+parser.add_argument('-cache','--cache',action='store_true',
+                 help=""">  Save the interpolation indices to a .amesgcm_cache/ directory next to the data and re-use them  \n"""
+                      """>  when the same file is interpolated again, e.g. with a different --include list \n"""
+                      """>  Usage: MarsInterp.py ****.atmos_daily.nc -t zagl --cache \n""")
+parser.add_argument('-prec','--precision',type=str,default='float32',choices=['float32','float64'],
+                 help=""">  Floating point precision of the calculations [DEFAULT is float32, the precision of the files] \n"""
+                      """>  Usage: MarsInterp.py ****.atmos_average.nc -t zstd --precision float64 \n""")
+parser.add_argument('--cache_size',type=float,default=2000.,help=argparse.SUPPRESS) #maximum size of the cache in MB, used jointly with --cache
 parser.add_argument('--debug',  action='store_true', help='Debug flag: release the exceptions')
 
 
@@ -87,198 +113,344 @@ def main():
     debug =parser.parse_args().debug
     #load all the .nc files
     file_list=parser.parse_args().input_file
-    interp_type=parser.parse_args().type   #e.g.  'pstd'
-    custom_level=parser.parse_args().level #e.g.  'p44'
+    interp_list=parser.parse_args().type   #e.g.  ['pstd'] or ['pstd','zstd']
+    level_list=parser.parse_args().level   #e.g.  ['p44']
+
+    if len(set(interp_list))!=len(interp_list):
+        prRed("***Error*** Each interpolation type may only be requested once")
+        exit()
+    if level_list and len(level_list)!=len(interp_list):
+        prRed("***Error*** Provide one layer ID (-l) for each interpolation type (-t)")
+        exit()
 
     #The fixed file is needed if pk, bk are not available in the requested file, or
     # to load the topography is zstd output is requested
     name_fixed=find_fixedfile(filepath,file_list[0])
-
-    # PRELIMINARY DEFINITIONS
-    #===========================pstd============================================
-    if interp_type=='pstd':
-        longname_txt= 'standard pressure'
-        units_txt= 'Pa'
-        need_to_reverse=False
-        interp_technic='log'
-        if custom_level:
-            content_txt=section_content_amesgcm_profile('Pressure definitions for pstd')
-            #print(content_txt)
-            exec(content_txt) #load all variables in that section
-            lev_in=eval('np.array('+custom_level+')') #copy requested variable
-        else:
-            #Default levels, this is size 36
-            lev_in=np.array([1.0e+03, 9.5e+02, 9.0e+02, 8.5e+02, 8.0e+02, 7.5e+02, 7.0e+02,
-                6.5e+02, 6.0e+02, 5.5e+02, 5.0e+02, 4.5e+02, 4.0e+02, 3.5e+02,
-                3.0e+02, 2.5e+02, 2.0e+02, 1.5e+02, 1.0e+02, 7.0e+01, 5.0e+01,
-                3.0e+01, 2.0e+01, 1.0e+01, 7.0e+00, 5.0e+00, 3.0e+00, 2.0e+00,
-                1.0e+00, 5.0e-01, 3.0e-01, 2.0e-01, 1.0e-01, 5.0e-02, 3.0e-02,
-                1.0e-02])
-    #===========================zstd============================================
-    elif interp_type=='zstd':
-        longname_txt= 'standard altitude'
-        units_txt= 'm'
-        need_to_reverse=True
-        interp_technic='lin'
-        if custom_level:
-            content_txt=section_content_amesgcm_profile('Altitude definitions for zstd')
-            exec(content_txt) #load all variables in that section
-            lev_in=eval('np.array('+custom_level+')') #copy requested variable
+    zsurf=None
+
+    #Definitions for each requested type of interpolation
+    target_list=[]
+    for i,interp_type in enumerate(interp_list):
+        custom_level=level_list[i] if level_list else None #e.g.  'p44'
+        # PRELIMINARY DEFINITIONS
+        #===========================pstd============================================
+        if interp_type=='pstd':
+            longname_txt= 'standard pressure'
+            units_txt= 'Pa'
+            need_to_reverse=False
+            interp_technic='log'
+            if custom_level:
+                content_txt=section_content_amesgcm_profile('Pressure definitions for pstd')
+                #print(content_txt)
+                exec(content_txt) #load all variables in that section
+                lev_in=eval('np.array('+custom_level+')') #copy requested variable
+            else:
+                #Default levels, this is size 36
+                lev_in=np.array([1.0e+03, 9.5e+02, 9.0e+02, 8.5e+02, 8.0e+02, 7.5e+02, 7.0e+02,
+                    6.5e+02, 6.0e+02, 5.5e+02, 5.0e+02, 4.5e+02, 4.0e+02, 3.5e+02,
+                    3.0e+02, 2.5e+02, 2.0e+02, 1.5e+02, 1.0e+02, 7.0e+01, 5.0e+01,
+                    3.0e+01, 2.0e+01, 1.0e+01, 7.0e+00, 5.0e+00, 3.0e+00, 2.0e+00,
+                    1.0e+00, 5.0e-01, 3.0e-01, 2.0e-01, 1.0e-01, 5.0e-02, 3.0e-02,
+                    1.0e-02])
+        #===========================zstd============================================
+        elif interp_type=='zstd':
+            longname_txt= 'standard altitude'
+            units_txt= 'm'
+            need_to_reverse=True
+            interp_technic='lin'
+            if custom_level:
+                content_txt=section_content_amesgcm_profile('Altitude definitions for zstd')
+                exec(content_txt) #load all variables in that section
+                lev_in=eval('np.array('+custom_level+')') #copy requested variable
+            else:
+                #Default levels, this is size 45
+                lev_in=np.array([-7000,-6000,-5000,-4500,-4000,-3500,-3000,-2500,-2000,-1500,-1000,
+                        -500,0,500,1000,1500,2000,2500,3000,3500,4000,4500,5000,
+                        6000,7000,8000,9000,10000,12000,14000,16000,18000,
+                        20000,25000,30000,35000,40000,45000,50000,55000,
+                        60000,70000,80000,90000,100000])
+            try:
+                f_fixed=Dataset(name_fixed,'r')
+                zsurf=f_fixed.variables['zsurf'][:]
+                f_fixed.close()
+            except FileNotFoundError:
+                prRed('***Error*** Topography is needed for zstd interpolation, however')
+                prRed('file %s not found'%(name_fixed))
+                exit()
+        #===========================zagl============================================
+        elif interp_type=='zagl':
+            longname_txt= 'altitude above ground level'
+            units_txt= 'm'
+            need_to_reverse=True
+            interp_technic='lin'
+            if custom_level:
+                content_txt=section_content_amesgcm_profile('Altitude definitions for zagl')
+                #print(content_txt)
+                exec(content_txt) #load all variables in that section
+                lev_in=eval('np.array('+custom_level+')') #copy requested variable
+            else:
+                #Default levels, this is size 45
+                lev_in=np.array([0,500,1000,1500,2000,2500,3000,3500,4000,4500,5000,
+                        6000,7000,8000,9000,10000,12000,14000,16000,18000,
+                        20000,25000,30000,35000,40000,45000,50000,55000,
+                        60000,70000,80000,90000,100000,110000])
         else:
-            #Default levels, this is size 45
-            lev_in=np.array([-7000,-6000,-5000,-4500,-4000,-3500,-3000,-2500,-2000,-1500,-1000,
-                    -500,0,500,1000,1500,2000,2500,3000,3500,4000,4500,5000,
-                    6000,7000,8000,9000,10000,12000,14000,16000,18000,
-                    20000,25000,30000,35000,40000,45000,50000,55000,
-                    60000,70000,80000,90000,100000])
-        try:
-            f_fixed=Dataset(name_fixed,'r')
-            zsurf=f_fixed.variables['zsurf'][:]
-            f_fixed.close()
-        except FileNotFoundError:
-            prRed('***Error*** Topography is needed for zstd interpolation, however')
-            prRed('file %s not found'%(name_fixed))
+            prRed("Interpolation type '%s' is not supported, use  'pstd','zstd' or 'zagl'"%(interp_type))
             exit()
-    #===========================zagl============================================
-    elif interp_type=='zagl':
-        longname_txt= 'altitude above ground level'
-        units_txt= 'm'
-        need_to_reverse=True
-        interp_technic='lin'
-        if custom_level:
-            content_txt=section_content_amesgcm_profile('Altitude definitions for zagl')
-            #print(content_txt)
-            exec(content_txt) #load all variables in that section
-            lev_in=eval('np.array('+custom_level+')') #copy requested variable
-        else:
-            #Default levels, this is size 45
-            lev_in=np.array([0,500,1000,1500,2000,2500,3000,3500,4000,4500,5000,
-                    6000,7000,8000,9000,10000,12000,14000,16000,18000,
-                    20000,25000,30000,35000,40000,45000,50000,55000,
-                    60000,70000,80000,90000,100000,110000])
-    else:
-        prRed("Interpolation type '%s' is not supported, use  'pstd','zstd' or 'zagl'"%(interp_type))
-        exit()
 
-    #For all the files
-    for ifile in file_list:
-        #First check if file is present on the disk (Lou only)
-        check_file_tape(ifile)
+        target_list.append({'interp_type':interp_type,'lev_in':lev_in,'longname_txt':longname_txt,'units_txt':units_txt,
+                            'need_to_reverse':need_to_reverse,'interp_technic':interp_technic})
 
-        #Append extension, in any
-        if parser.parse_args().ext:
-            newname=filepath+'/'+ifile[:-3]+'_'+interp_type+'_'+parser.parse_args().ext+'.nc'
-        else:
-            newname=filepath+'/'+ifile[:-3]+'_'+interp_type+'.nc'
-
-        #=================================================================
-        #=======================Interpolate action========================
-        #=================================================================
-
-        fNcdf=Dataset(ifile, 'r', format='NETCDF4_CLASSIC')
-        # Load pk and bk and ps for 3D pressure field calculation.
-        # We will read the pk and bk for each file in case the vertical resolution is changed.
-
-        try:
-            #First try to read pk and bk in the file
-            pk=np.array(fNcdf.variables['pk'])
-            bk=np.array(fNcdf.variables['bk'])
-        except:
-            #If pk and bk are not available in the file, try the matching XXXXX.fixed.nc
-            name_fixed=find_fixedfile(filepath,ifile)
-            f_fixed=Dataset(name_fixed, 'r', format='NETCDF4_CLASSIC')
-            pk=np.array(f_fixed.variables['pk'])
-            bk=np.array(f_fixed.variables['bk'])
-            f_fixed.close()
-
-        ps=np.array(fNcdf.variables['ps'])
-
-        if len(ps.shape)==3:
-            do_diurn=False
-            tod_name='not_used'
-            permut=[1,0,2,3] # Put vertical axis first for 4D variable, e.g (time,lev,lat,lon) >>> (lev,time,lat,lon)
-                             #                              ( 0    1   2   3 ) >>> ( 1   0    2   3 )
-        elif len(ps.shape)==4:
-            do_diurn=True
-            #find time of day variable name
-            tod_name=find_tod_in_diurn(fNcdf)
-            permut=[2,1,0,3,4]  #Same for diun files, e.g (time,time_of_day_XX,lev,lat,lon) >>> (lev,time_of_day_XX,time,lat,lon)
-                                #                         (  0        1         2   3   4)  >>> ( 2       1          0    3   4 )
-        #== Compute levels in the file, these are permutted arrays
-
-        # Suppress divided by zero error ==
-        with np.errstate(divide='ignore', invalid='ignore'):
-            if interp_type=='pstd':
-                L_3D_P= fms_press_calc(ps,pk,bk,lev_type='full') #permuted by default, e.g lev is first
-
-            elif interp_type=='zagl':
-                temp=fNcdf.variables['temp'][:]
-                L_3D_P= fms_Z_calc(ps,pk,bk,temp.transpose(permut),topo=0.,lev_type='full')
-
-            elif interp_type=='zstd':
-                temp=fNcdf.variables['temp'][:]
-                #Expend the zsurf array to the time dimension
-                zflat=np.repeat(zsurf[np.newaxis,:],ps.shape[0],axis=0)
-                if do_diurn:
-                    zflat=np.repeat(zflat[:,np.newaxis,:,:],ps.shape[1],axis=1)
-
-                L_3D_P= fms_Z_calc(ps,pk,bk,temp.transpose(permut),topo=zflat,lev_type='full')
-
-
-        fnew = Ncdf(newname,'Pressure interpolation using MarsInterp.py')
-        #===========      Replicate existing DIMENSIONS but pfull  =================
-        #get all variables in file:
-        ###var_list=fNcdf.variables.keys()
-        var_list = filter_vars(fNcdf,parser.parse_args().include) # get the variables
+    #Output files for each input file, used to make sure two files are not interpolated to the same output
+    output_list=[[get_newname(ifile,interp_type) for interp_type in interp_list] for ifile in file_list]
 
-        fnew.copy_all_dims_from_Ncfile(fNcdf,exclude_dim=['pfull'])
-        fnew.add_dim_with_content(interp_type,lev_in,longname_txt,units_txt) #Add new vertical dimension
+    #For all the files, the independent files are dispatched to a pool of processes if --jobs is >1
+    run_file_jobs(partial(interp_file,target_list=target_list,zsurf=zsurf),
+                  file_list,parser.parse_args().jobs,output_list)
+    print("Completed in %.3f sec" % (time.time() - start_time))
 
+def get_newname(ifile,interp_type):
+    '''
+    Return the name of the interpolated file, e.g. 00010.atmos_average_pstd.nc or 00010.atmos_average_pstd_B.nc with --ext B
+    '''
+    #Append extension, in any
+    if parser.parse_args().ext:
+        return filepath+'/'+ifile[:-3]+'_'+interp_type+'_'+parser.parse_args().ext+'.nc'
+    else:
+        return filepath+'/'+ifile[:-3]+'_'+interp_type+'.nc'
+
+def interp_file(ifile,target_list,zsurf=None):
+    '''
+    Interpolate one file to the requested vertical grid(s). Each variable is read once and interpolated to all the grids.
+    Args:
+        ifile          : name of the file to interpolate
+        target_list    : list of the requested grids, as dictionaries with:
+                         interp_type    : 'pstd', 'zstd' or 'zagl'
+                         lev_in         : 1D array of the levels to interpolate on, [Pa] or [m]
+                         longname_txt   : long name of the new vertical axis
+                         units_txt      : units of the new vertical axis
+                         need_to_reverse: True if the model levels must be reversed for the interpolation (altitude)
+                         interp_technic : 'log' or 'lin'
+        zsurf          : topography in [m], only needed for zstd
+    Returns:
+        None, the interpolated files are written to the disk
+    '''
+    #First check if file is present on the disk (Lou only)
+    check_file_tape(ifile)
+    #Set the precision here, so the setting is also used when the file is processed in a separate job
+    set_precision(parser.parse_args().precision)
+
+    #=================================================================
+    #=======================Interpolate action========================
+    #=================================================================
+
+    fNcdf=Dataset(ifile, 'r', format='NETCDF4_CLASSIC')
+    # Load pk and bk and ps for 3D pressure field calculation.
+    # We will read the pk and bk for each file in case the vertical resolution is changed.
+
+    try:
+        #First try to read pk and bk in the file
+        pk=np.array(fNcdf.variables['pk'])
+        bk=np.array(fNcdf.variables['bk'])
+    except:
+        #If pk and bk are not available in the file, try the matching XXXXX.fixed.nc
+        name_fixed=find_fixedfile(filepath,ifile)
+        f_fixed=Dataset(name_fixed, 'r', format='NETCDF4_CLASSIC')
+        pk=np.array(f_fixed.variables['pk'])
+        bk=np.array(f_fixed.variables['bk'])
+        f_fixed.close()
+
+    #Only read the dimensions of the surface pressure here, the data is loaded by time slabs below
+    ps_dims=fNcdf.variables['ps'].dimensions
+    nt=len(fNcdf.dimensions['time'])
+    #Number of time steps processed at once, default is the full file
+    chunk=parser.parse_args().chunk if parser.parse_args().chunk else nt
+
+    if len(ps_dims)==3:
+        do_diurn=False
+        tod_name='not_used'
+        permut=[1,0,2,3] # Put vertical axis first for 4D variable, e.g (time,lev,lat,lon) >>> (lev,time,lat,lon)
+                         #                              ( 0    1   2   3 ) >>> ( 1   0    2   3 )
+    elif len(ps_dims)==4:
+        do_diurn=True
+        #find time of day variable name
+        tod_name=find_tod_in_diurn(fNcdf)
+        permut=[2,1,0,3,4]  #Same for diun files, e.g (time,time_of_day_XX,lev,lat,lon) >>> (lev,time_of_day_XX,time,lat,lon)
+                            #                         (  0        1         2   3   4)  >>> ( 2       1          0    3   4 )
+
+    #get all variables in file:
+    ###var_list=fNcdf.variables.keys()
+    var_list = filter_vars(fNcdf,parser.parse_args().include) # get the variables
+
+    #One new file for each type of interpolation
+    fnew_list=[]
+    for target in target_list:
+        fnew = Ncdf(get_newname(ifile,target['interp_type']),'Pressure interpolation using MarsInterp.py')
+        #===========      Replicate existing DIMENSIONS but pfull  =================
+        fnew.copy_all_dims_from_Ncfile(fNcdf,exclude_dim=['pfull'])
+        fnew.add_dim_with_content(target['interp_type'],target['lev_in'],target['longname_txt'],target['units_txt']) #Add new vertical dimension
 
         fnew.copy_Ncaxis_with_content(fNcdf.variables['lon'])
         fnew.copy_Ncaxis_with_content(fNcdf.variables['lat'])
         fnew.copy_Ncaxis_with_content(fNcdf.variables['time'])
 
         if do_diurn:fnew.copy_Ncaxis_with_content(fNcdf.variables[tod_name])
-
-        #We will re-use the indices for each files, this speeds-up the calculation
-        compute_indices=True
+        fnew_list.append(fnew)
+
+    #Indices are saved to/loaded from the .amesgcm_cache/ directory next to the data if --cache is used
+    use_cache=parser.parse_args().cache
+    cache_path=cache_dir(ifile)
+
+    #Variables are interpolated on a pool of threads if --threads is >1
+    nthreads=max(1,parser.parse_args().threads)
+    executor=ThreadPoolExecutor(max_workers=nthreads)
+
+    #Process the file by slabs of time steps: the levels, indices and interpolated fields only hold 'chunk' time steps at once
+    for t0 in range(0,nt,chunk):
+        t1=min(t0+chunk,nt)
+        if chunk<nt:prCyan("Processing time steps %i-%i (out of %i) ..."%(t0+1,t1,nt))
+        ps=np.array(fNcdf.variables['ps'][t0:t1,...])
+        #For diurn files, order ps as (time_of_day_XX,time,lat,lon) so the levels match the permuted variables (lev,time_of_day_XX,time,lat,lon)
+        if do_diurn:ps=ps.transpose([1,0,2,3])
+
+        #The temperature is only needed for the altitude of the levels
+        need_temp=any([target['interp_type'] in ['zagl','zstd'] for target in target_list])
+        temp=fNcdf.variables['temp'][t0:t1,...] if need_temp else None
+
+        #We will re-use the interpolation weights for each variable in the slab, this speeds-up the calculation
+        weights_list=None
+        #Variables being interpolated by the threads, as (new file, type, name, future). The results are written by this (main) thread only
+        pending=[]
         for ivar in var_list:
             if (fNcdf.variables[ivar].dimensions==('time','pfull', 'lat', 'lon') or
              fNcdf.variables[ivar].dimensions==('time',tod_name,'pfull', 'lat', 'lon')):
-                if compute_indices:
-                    prCyan("Computing indices ...")
-                    index=find_n(L_3D_P,lev_in,reverse_input=need_to_reverse)
-                    compute_indices=False
-
-                prCyan("Interpolating: %s ..."%(ivar))
-                varIN=fNcdf.variables[ivar][:]
-                #==This with loop suppresses divided by zero errors==
-                with np.errstate(divide='ignore', invalid='ignore'):
-                    varOUT=vinterp(varIN.transpose(permut),L_3D_P,
-                                   lev_in,type_int=interp_technic,reverse_input=need_to_reverse,
-                                   masktop=True,index=index).transpose(permut)
-
-                long_name_txt=getattr(fNcdf.variables[ivar],'long_name','')
-                units_txt=getattr(fNcdf.variables[ivar],'units','')
-
-                if not do_diurn:
-                    fnew.log_variable(ivar,varOUT,('time',interp_type, 'lat', 'lon'),
-                                      long_name_txt,units_txt)
-                else:
-                    fnew.log_variable(ivar,varOUT,('time',tod_name,interp_type, 'lat', 'lon'),
-                                      long_name_txt,units_txt)
-            else:
-
-                if  ivar not in ['time','pfull', 'lat', 'lon','phalf','pk','bk','pstd','zstd','zagl',tod_name]:
+                if weights_list is None:
+                    #Levels shared by the different types, e.g. zstd re-uses the altitude above ground of zagl
+                    levels=dict()
+                    weights_list=[]
+                    for target in target_list:
+                        interp_type=target['interp_type']
+                        weights=None
+                        if use_cache:
+                            #The levels, and therefore the interpolation weights, only depend on these inputs
+                            key_arrays=[pk,bk,ps,target['lev_in']]
+                            if interp_type in ['zagl','zstd']:key_arrays.append(temp)
+                            if interp_type=='zstd':key_arrays.append(zsurf)
+                            key=hash_arrays(*key_arrays,interp_type=interp_type,permut=permut,precision=parser.parse_args().precision)
+                            cached=cache_load(cache_path,key)
+                            if cached is not None:
+                                if t0==0:prCyan("Loading %s indices from %s ..."%(interp_type,cache_path))
+                                weights=(cached['nindex'],cached['nindexp1'],cached['alpha'])
+                        if weights is None:
+                            if t0==0:prCyan("Computing %s indices ..."%(interp_type))
+                            L_3D_P=compute_levels(ps,pk,bk,temp,zsurf,interp_type,permut,do_diurn,levels)
+                            #Make sure the levels have the same size as the permuted variables, even for a single time step
+                            L_3D_P=L_3D_P.reshape((len(fNcdf.dimensions['pfull']),)+ps.shape)
+                            index=find_n(L_3D_P,target['lev_in'],reverse_input=target['need_to_reverse'])
+                            with np.errstate(divide='ignore', invalid='ignore'):
+                                weights=vinterp_weights(L_3D_P,target['lev_in'],target['interp_technic'],target['need_to_reverse'],
+                                                        masktop=True,index=index,permut=permut)
+                            if use_cache:cache_save(cache_path,key,parser.parse_args().cache_size,nindex=weights[0],nindexp1=weights[1],alpha=weights[2])
+                        weights_list.append(weights)
+                    del levels
+
+                if t0==0:prCyan("Interpolating: %s ..."%(ivar))
+                #The variable is read once for all the types of interpolation
+                varIN=fNcdf.variables[ivar][t0:t1,...]
+                for fnew,target,weights in zip(fnew_list,target_list,weights_list):
+                    #The threads share the same interpolation weights, only the variable differs
+                    pending.append((fnew,target['interp_type'],ivar,executor.submit(interp_var,varIN,weights,permut)))
+                    #Limit the number of variables held in memory at once
+                    if len(pending)>=nthreads:
+                        write_var(fNcdf,pending.pop(0),t0,do_diurn,tod_name)
+            elif ivar not in ['time','pfull', 'lat', 'lon','phalf','pk','bk','pstd','zstd','zagl',tod_name]:
+                Ncvar=fNcdf.variables[ivar]
+                if Ncvar.dimensions[:1]==('time',):
+                    #Variables with a time axis but no vertical axis (e.g. ps, ts, areo) are copied slab by slab
+                    if t0==0:prCyan("Copying over: %s..."%(ivar))
+                    varIN=Ncvar[t0:t1,...]
+                    for fnew in fnew_list:fnew.log_slab(ivar,varIN,Ncvar.dimensions,t0,getattr(Ncvar,'long_name',ivar),getattr(Ncvar,'units',''))
+                elif t0==0:
+                    #Variables without a time axis are copied once, with the first slab
                     #print("\r Copying over: %s..."%(ivar), end='')
                     prCyan("Copying over: %s..."%(ivar))
-                    fnew.copy_Ncvar(fNcdf.variables[ivar])
-
+                    for fnew in fnew_list:fnew.copy_Ncvar(Ncvar)
+        #Write the remaining variables
+        while pending:
+            write_var(fNcdf,pending.pop(0),t0,do_diurn,tod_name)
+
+
+    executor.shutdown()
+    print('\r ', end='')
+    fNcdf.close()
+    for fnew in fnew_list:fnew.close()
+
+def compute_levels(ps,pk,bk,temp,zsurf,interp_type,permut,do_diurn,levels=None):
+    '''
+    Compute the pressure [Pa] or altitude [m] of the model levels.
+    Args:
+        ps       : surface pressure, (time,lat,lon) or (time_of_day_XX,time,lat,lon) for diurn files
+        pk,bk    : vertical grid coefficients
+        temp     : temperature in its original order, e.g. (time,pfull,lat,lon), only needed for zagl and zstd
+        zsurf    : topography, only needed for zstd
+        interp_type : 'pstd', 'zstd' or 'zagl'
+        permut   : permutation putting the vertical axis first, e.g. [1,0,2,3]
+        levels   : optional dictionary holding the levels already computed for the same slab, updated with the new levels
+    Returns:
+        L_3D_P   : levels, permuted with the vertical axis first
+    ***NOTE***
+    The altitude of the levels above the aeroid (zstd) is the altitude above ground (zagl) plus the topography, so with
+    both zagl and zstd requested, the hydrostatic integration in fms_press_Z_calc() is only done once.
+    '''
+    if levels is None:levels=dict()
+    if interp_type in levels.keys():return levels[interp_type]
+    # Suppress divided by zero error ==
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if interp_type=='pstd':
+            L_3D_P= fms_press_calc(ps,pk,bk,lev_type='full') #permuted by default, e.g lev is first
+
+        elif interp_type=='zagl':
+            #The pressure comes for free from the hydrostatic integration, keep it in case pstd is also requested
+            P_3D,L_3D_P= fms_press_Z_calc(ps,pk,bk,temp.transpose(permut),topo=0.,lev_type='full')
+            levels.setdefault('pstd',P_3D)
+
+        elif interp_type=='zstd':
+            #The topography (lat,lon) is broadcasted to the time (and time of day) dimensions
+            L_3D_P= compute_levels(ps,pk,bk,temp,zsurf,'zagl',permut,do_diurn,levels)+zsurf
+    levels[interp_type]=L_3D_P
+    return L_3D_P
+
+def interp_var(varIN,weights,permut):
+    '''
+    Interpolate one variable, this is the function executed by each thread when --threads is used.
+    Args:
+        varIN    : variable in the original order, e.g. (time,pfull,lat,lon)
+        weights  : interpolation operator from vinterp_weights(), shared by all the variables
+        permut   : permutation putting the vertical axis first, e.g. [1,0,2,3]
+    Returns:
+        varOUT   : interpolated variable in the original order, e.g. (time,pstd,lat,lon)
+    '''
+    #The weights directly index the variable in its original order, so only the output is transposed
+    return vinterp_apply(varIN,weights).transpose(permut)
+
+def write_var(fNcdf,pending_var,t0,do_diurn,tod_name):
+    '''
+    Wait for an interpolated variable and write it to its new file, starting at time step t0.
+    Args:
+        fNcdf       : original file
+        pending_var : (new file, interpolation type, name, future) with the future returning the interpolated variable
+    '''
+    fnew,interp_type,ivar,future=pending_var
+    varOUT=future.result()
+    long_name_txt=getattr(fNcdf.variables[ivar],'long_name','')
+    units_txt=getattr(fNcdf.variables[ivar],'units','')
+
+    if not do_diurn:
+        fnew.log_slab(ivar,varOUT,('time',interp_type, 'lat', 'lon'),t0,
+                          long_name_txt,units_txt)
+    else:
+        fnew.log_slab(ivar,varOUT,('time',tod_name,interp_type, 'lat', 'lon'),t0,
+                          long_name_txt,units_txt)
 
-        print('\r ', end='')
-        fNcdf.close()
-        fnew.close()
-        print("Completed in %.3f sec" % (time.time() - start_time))
 if __name__ == '__main__':
     main()
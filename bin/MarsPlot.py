@@ -13,6 +13,7 @@ from amesgcm.Script_utils import print_fileContent,print_varContent,FV3_file_typ
 from amesgcm.Script_utils import wbr_cmap,rjw_cmap,dkass_temp_cmap,dkass_dust_cmap
 from amesgcm.FV3_utils import lon360_to_180,lon180_to_360,UT_LTtxt,area_weights_deg
 from amesgcm.FV3_utils import add_cyclic,azimuth2cart,mollweide2cart,robin2cart,ortho2cart
+from amesgcm.Orbit_utils import MY_func,MY_Ls3602Ls_cont,nearest_index
 #=====Attempt to import specific scientic modules one may not find in the default python on NAS ====
 try:
     import matplotlib
@@ -338,18 +339,6 @@ def shift_data(lon,data):
     return lon_180,data
 
 
-def MY_func(Ls_cont):
-    '''
-    This function return the Mars Year
-    Args:
-        Ls_cont: solar longitude, contineuous
-    Returns:
-        MY : int the Mars year
-    '''
-    return (Ls_cont)//(360.)+1
-
-
-
 def get_lon_index(lon_query_180,lons):
     '''
     Given a range of requested longitudes, return the indexes to extract data from the netcdf file
@@ -561,6 +550,8 @@ def get_time_index(Ls_query_360,Ls):
     if len(np.atleast_1d(Ls))==1:Ls=np.array([Ls])
 
     Nt=len(Ls)
+    #Check once if the solar longitudes are increasing, so nearest_index() can use a bisection
+    Ls_sorted=bool(np.all(Ls[1:]>=Ls[:-1]))
     Ls_query_360=np.array(Ls_query_360)
 
     #If None, set to default, i.e last time step
@@ -577,14 +568,14 @@ def get_time_index(Ls_query_360,Ls):
             MY_end=MY_func(Ls[-1]) #number of Mars year at the end of the file.
             if MY_end >=1:
             #check if the desired Ls is available for this Mars Year
-                Ls_query=Ls_query_360+(MY_end-1)*360. #(MY starts at 1, not zero)
+                Ls_query=MY_Ls3602Ls_cont(MY_end,Ls_query_360) #(MY starts at 1, not zero)
             else:
                 Ls_query=Ls_query_360
             #If this time is greater that the last Ls, look one year back
             if Ls_query>Ls[-1] and MY_end>1:
                 MY_end-=1 #one year back
-                Ls_query=Ls_query_360+(MY_end-1)*360.
-            ti=np.argmin(np.abs(Ls_query-Ls))
+                Ls_query=MY_Ls3602Ls_cont(MY_end,Ls_query_360)
+            ti=nearest_index(Ls,Ls_query,Ls_sorted)
             txt_time=', Ls= (MY%2i) %.2f'%(MY_end,np.mod(Ls[ti],360.))
 
     # a range is requested
@@ -594,26 +585,26 @@ def get_time_index(Ls_query_360,Ls):
         MY_last=MY_func(Ls[-1]) #number of Mars year at the end of the file.
         if MY_last >=1:
         #try the mars year of the last time step
-            Ls_query_last=Ls_query_360[1]+(MY_last-1)*360.
+            Ls_query_last=MY_Ls3602Ls_cont(MY_last,Ls_query_360[1])
         else:
             Ls_query_last=Ls_query_360[1]
         #First consider the further end of the desired range
         #This time is greater that the last Ls, look one year back
         if Ls_query_last>Ls[-1] and  MY_last>1:
             MY_last-=1
-            Ls_query_last=Ls_query_360[1]+(MY_last-1)*360. #(MY starts at 1, not zero)
-        ti_last=np.argmin(np.abs(Ls_query_last-Ls))
+            Ls_query_last=MY_Ls3602Ls_cont(MY_last,Ls_query_360[1]) #(MY starts at 1, not zero)
+        ti_last=nearest_index(Ls,Ls_query_last,Ls_sorted)
         #then get the first value, for that Mars year
         MY_beg=MY_last.copy()
         #try the mars year of the last time step
-        Ls_query_beg=Ls_query_360[0]+(MY_beg-1)*360.
-        ti_beg=np.argmin(np.abs(Ls_query_beg-Ls))
+        Ls_query_beg=MY_Ls3602Ls_cont(MY_beg,Ls_query_360[0])
+        ti_beg=nearest_index(Ls,Ls_query_beg,Ls_sorted)
 
         #if the begining value is higher, search in the year before for ti_beg
         if ti_beg>=ti_last:
             MY_beg-=1
-            Ls_query_beg=Ls_query_360[0]+(MY_beg-1)*360.
-            ti_beg=np.argmin(np.abs(Ls_query_beg-Ls))
+            Ls_query_beg=MY_Ls3602Ls_cont(MY_beg,Ls_query_360[0])
+            ti_beg=nearest_index(Ls,Ls_query_beg,Ls_sorted)
 
 
         ti=np.arange(ti_beg,ti_last+1)
@@ -2225,9 +2216,11 @@ class Fig_2D_time_lat(Fig_2D):
             labels = [item for item in ax.get_xticklabels()]
 
 
+            #find the timesteps closest to the ticks, all at once
+            Ls_sorted=bool(np.all(Ls[1:]>=Ls[:-1]))
+            ids=nearest_index(Ls,Ls_ticks,Ls_sorted)
             for i in range(0,len(Ls_ticks)):
-                id=np.argmin(np.abs(Ls-Ls_ticks[i])) #find tmstep closest to this tick
-                labels[i]='Ls %g\nsol %i'%(np.mod(Ls_ticks[i],360.),tim[id])
+                labels[i]='Ls %g\nsol %i'%(np.mod(Ls_ticks[i],360.),tim[ids[i]])
 
 
             ax.set_xticklabels(labels)
@@ -2366,9 +2359,11 @@ class Fig_2D_time_lev(Fig_2D):
             labels = [item for item in ax.get_xticklabels()]
 
 
+            #find the timesteps closest to the ticks, all at once
+            Ls_sorted=bool(np.all(Ls[1:]>=Ls[:-1]))
+            ids=nearest_index(Ls,Ls_ticks,Ls_sorted)
             for i in range(0,len(Ls_ticks)):
-                id=np.argmin(np.abs(Ls-Ls_ticks[i])) #find tmstep closest to this tick
-                labels[i]='Ls %g\nsol %i'%(np.mod(Ls_ticks[i],360.),tim[id])
+                labels[i]='Ls %g\nsol %i'%(np.mod(Ls_ticks[i],360.),tim[ids[i]])
 
 
             ax.set_xticklabels(labels)
@@ -2425,9 +2420,11 @@ class Fig_2D_lon_time(Fig_2D):
             labels = [item for item in ax.get_yticklabels()]
 
 
+            #find the timesteps closest to the ticks, all at once
+            Ls_sorted=bool(np.all(Ls[1:]>=Ls[:-1]))
+            ids=nearest_index(Ls,Ls_ticks,Ls_sorted)
             for i in range(0,len(Ls_ticks)):
-                id=np.argmin(np.abs(Ls-Ls_ticks[i])) #find tmstep closest to this tick
-                labels[i]='Ls %g\nsol %i'%(np.mod(Ls_ticks[i],360.),tim[id])
+                labels[i]='Ls %g\nsol %i'%(np.mod(Ls_ticks[i],360.),tim[ids[i]])
 
             ax.set_yticklabels(labels)
 
@@ -2954,9 +2951,11 @@ class Fig_1D(object):
                 Ls_ticks = [item for item in ax.get_xticks()]
                 labels = [item for item in ax.get_xticklabels()]
 
+                #find the timesteps closest to the ticks, all at once
+                Ls_sorted=bool(np.all(Ls[1:]>=Ls[:-1]))
+                ids=nearest_index(Ls,Ls_ticks,Ls_sorted)
                 for i in range(0,len(Ls_ticks)):
-                    id=np.argmin(np.abs(Ls-Ls_ticks[i])) #find tmstep closest to this tick
-                    labels[i]='Ls %g\nsol %i'%(np.mod(Ls_ticks[i],360.),tim[id])
+                    labels[i]='Ls %g\nsol %i'%(np.mod(Ls_ticks[i],360.),tim[ids[i]])
 
                 ax.set_xticklabels(labels)
 
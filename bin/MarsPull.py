@@ -27,6 +27,7 @@ except Exception as exception:
     print(exception.__class__.__name__ + ": " + exception.message)
     exit()
 
+from amesgcm.Orbit_utils import nearest_index
 
 
 parser = argparse.ArgumentParser(description="""\033[93mUilities for accessing files on the MCMC NAS repository\033[00m """,       formatter_class=argparse.RawTextHelpFormatter)
@@ -119,15 +120,15 @@ def main():
     if parser.parse_args().ls :
         data_input=np.asarray(parser.parse_args().ls)
         if len(data_input)==1: #query only  the file that contains this Ls
-            i_start=np.argmin(np.abs(Ls_ini-data_input))
+            i_start=nearest_index(Ls_ini,data_input[0],True)
             if data_input<Ls_ini[i_start]:i_start-=1
             i_request=np.arange(i_start,i_start+1)
         
         elif len(data_input)==2: #start stop  is provided
-            i_start=np.argmin(np.abs(Ls_ini-data_input[0]))
+            i_start=nearest_index(Ls_ini,data_input[0],True)
             if data_input[0]<Ls_ini[i_start]:i_start-=1
 
-            i_end=np.argmin(np.abs(Ls_end-data_input[1]))
+            i_end=nearest_index(Ls_end,data_input[1]) #Ls_end wraps around to 0 for the last file
             if data_input[1]>Ls_end[i_end]:i_end+=1
          
             i_request=np.arange(i_start,i_end+1) 
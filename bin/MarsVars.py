@@ -8,9 +8,10 @@ import sys       #system command
 import warnings #Suppress certain errors when dealing with NaN arrays
 
 
-from amesgcm.FV3_utils import fms_press_calc,fms_Z_calc,dvar_dh,cart_to_azimut_TR,mass_stream,zonal_detrend,spherical_div,spherical_curl,frontogenesis
+from amesgcm.FV3_utils import set_precision,fms_press_calc,fms_Z_calc,dvar_dh,cart_to_azimut_TR,mass_stream,zonal_detrend,spherical_div,spherical_curl,frontogenesis
 from amesgcm.Script_utils import check_file_tape,prYellow,prRed,prCyan,prGreen,prPurple, print_fileContent,FV3_file_type,filter_vars
 from amesgcm.Ncdf_wrapper import Ncdf
+from amesgcm.Parallel_utils import run_file_jobs
 #=====Attempt to import specific scientic modules one may not find in the default python on NAS ====
 try:
     import matplotlib
@@ -128,6 +129,19 @@ parser.add_argument('-longname','--longname',type=str,default=None,help=argparse
 parser.add_argument('-unit','--unit',type=str,default=None,help=argparse.SUPPRESS) # used jointly with --edit
 parser.add_argument('-multiply','--multiply',type=float,default=None,help=argparse.SUPPRESS) # used jointly with --edit
 
+parser.add_argument('-chunk','--chunk',type=int,default=None,
+                 help='Number of timesteps processed at the time with -add, to limit the memory needed for large files [DEFAULT is all the timesteps] \n'
+                      '> Usage: MarsVars *.atmos_daily.nc -add Ri --chunk 10 \n')
+parser.add_argument('-mem','--max_mem',type=float,default=None,
+                 help='Memory budget in [MB] for -add, the number of timesteps processed at the time is derived from it \n'
+                      '> Usage: MarsVars *.atmos_daily.nc -add Ri --max_mem 2000 \n')
+
+parser.add_argument('-j','--jobs',type=int,default=1,
+                 help='Number of files processed in parallel [DEFAULT is 1, one file at the time] \n'
+                      '> Usage: MarsVars *.atmos_average.nc -add rho --jobs 8 \n')
+parser.add_argument('-prec','--precision',type=str,default='float32',choices=['float32','float64'],
+                 help='Floating point precision of the calculations [DEFAULT is float32, the precision of the files] \n'
+                      '> Usage: MarsVars *.atmos_average.nc -add zfull --precision float64 \n')
 
 parser.add_argument('--debug',  action='store_true', help='Debug flag: release the exceptions')
 
@@ -165,6 +179,50 @@ VAR= {'rho'       :['density (added postprocessing)','kg/m3'],
       'Vg_sed'    :['sedimentation rate (added postprocessing)', 'm/s'],
       'w_net'     :['w-Vg_sed (added postprocessing)', 'm/s'],
       }
+
+#Inputs of each variable in VAR (and of the intermediate fields shared by several variables), and the function computing it from those inputs.
+#An input is either another entry of this dictionary, a property of the file ('ak','bk','f_type','interp_type','shape_out','lev','lev_axis')
+#or a variable read from the file. Use e.g. 'file:theta' to read a variable from the file when it could also be computed.
+#See Var_evaluator() and file_deps(): each field is computed once per file, and only kept in memory while it is still needed.
+VAR_DEPS= {
+      #---Intermediate fields---
+      'p_3D'      :[['ps','ak','bk','shape_out'],     lambda ps,ak,bk,shape_out:compute_p_3D(ps,ak,bk,shape_out)],
+      'wind_TR'   :[['ucomp','vcomp'],                lambda ucomp,vcomp:cart_to_azimut_TR(ucomp,vcomp,mode='from')],
+      'q_dst'     :[['file:dst_mass'],                lambda q:q],
+      'n_dst'     :[['file:dst_num'],                 lambda n:n],
+      'q_ice'     :[['file:ice_mass'],                lambda q:q],
+      #---Variables---
+      'pfull3D'   :[['p_3D'],                         lambda p_3D:p_3D],
+      'DP'        :[['ps','ak','bk','shape_out'],     lambda ps,ak,bk,shape_out:compute_DP_3D(ps,ak,bk,shape_out)],
+      'rho'       :[['p_3D','temp'],                  lambda p_3D,temp:compute_rho(p_3D,temp)],
+      'theta'     :[['p_3D','ps','temp','f_type'],    lambda p_3D,ps,temp,f_type:compute_theta(p_3D,ps,temp,f_type)],
+      'w'         :[['rho','omega'],                  lambda rho,omega:compute_w(rho,omega)],
+      'zfull'     :[['ps','ak','bk','temp'],          lambda ps,ak,bk,temp:compute_zfull(ps,ak,bk,temp)], #TODO not with _pstd
+      'DZ'        :[['ps','ak','bk','temp','shape_out'],lambda ps,ak,bk,temp,shape_out:compute_DZ_3D(ps,ak,bk,temp,shape_out)],
+      'wdir'      :[['wind_TR'],                      lambda wind_TR:wind_TR[0]],
+      'wspeed'    :[['wind_TR'],                      lambda wind_TR:wind_TR[1]],
+      'N'         :[['theta','zfull'],                lambda theta,zfull:compute_N(theta,zfull)],
+      'Ri'        :[['N','ucomp','vcomp','zfull'],    lambda N,ucomp,vcomp,zfull:compute_Ri(N,ucomp,vcomp,zfull)],
+      'Tco2'      :[['p_3D','temp'],                  lambda p_3D,temp:compute_Tco2(p_3D,temp)],
+      'div'       :[['ucomp','vcomp','lon','lat'],    lambda ucomp,vcomp,lon,lat:spherical_div(ucomp,vcomp,lon,lat,R=3400*1000.,spacing='regular')],
+      'curl'      :[['ucomp','vcomp','lon','lat'],    lambda ucomp,vcomp,lon,lat:spherical_curl(ucomp,vcomp,lon,lat,R=3400*1000.,spacing='regular')],
+      'scorer_wl' :[['N','ucomp','zfull'],            lambda N,ucomp,zfull:compute_scorer(N,ucomp,zfull)],
+      'msf'       :[['vcomp','lat','lev','f_type','interp_type'],lambda vcomp,lat,lev,f_type,interp_type:compute_msf(vcomp,lat,lev,f_type,interp_type)],
+      'ep'        :[['temp'],                         lambda temp:compute_Ep(temp)],
+      'ek'        :[['ucomp','vcomp'],                lambda ucomp,vcomp:compute_Ek(ucomp,vcomp)],
+      'mx'        :[['ucomp','file:w'],               lambda ucomp,w:compute_MF(ucomp,w)],
+      'my'        :[['vcomp','file:w'],               lambda vcomp,w:compute_MF(vcomp,w)],
+      'ax'        :[['mx','file:rho','lev','interp_type'],lambda mx,rho,lev,interp_type:compute_WMFF(mx,rho,lev,interp_type)],
+      'ay'        :[['my','file:rho','lev','interp_type'],lambda my,rho,lev,interp_type:compute_WMFF(my,rho,lev,interp_type)],
+      'tp_t'      :[['temp'],                         lambda temp:zonal_detrend(temp)/temp],
+      'fn'        :[['ucomp','vcomp','file:theta','lon','lat'],lambda ucomp,vcomp,theta,lon,lat:frontogenesis(ucomp,vcomp,theta,lon,lat,R=3400*1000.,spacing='regular')],
+      'dzTau'     :[['q_dst','temp','p_3D'],          lambda q,temp,p_3D:compute_xzTau(q,temp,p_3D,C_dst)],
+      'izTau'     :[['q_ice','temp','p_3D'],          lambda q,temp,p_3D:compute_xzTau(q,temp,p_3D,C_ice)],
+      'dst_mass'  :[['file:dzTau','temp','p_3D'],     lambda xTau,temp,p_3D:compute_mmr(xTau,temp,p_3D,C_dst)],
+      'ice_mass'  :[['file:izTau','temp','p_3D'],     lambda xTau,temp,p_3D:compute_mmr(xTau,temp,p_3D,C_ice)],
+      'Vg_sed'    :[['q_dst','n_dst','temp'],         lambda xTau,nTau,temp:compute_Vg_sed(xTau,nTau,temp)],
+      'w_net'     :[['file:Vg_sed','file:w'],         lambda Vg,wvar:compute_w_net(Vg,wvar)],
+      }
 #=====================================================================
 #=====================================================================
 #=====================================================================
@@ -213,8 +271,8 @@ def compute_p_3D(ps,ak,bk,shape_out):
     *** NOTE***
     The shape_out argument ensures that, when time=1 (one timestep) results are returned as (1,lev,lat,lon), not (lev,lat,lon)
     """
-    p_3D= fms_press_calc(ps,ak,bk,lev_type='full')
-    p_3D=p_3D.transpose(lev_T)# p_3D [lev,tim,lat,lon] ->[tim, lev, lat, lon]
+    p_3D= fms_press_calc(ps,ak,bk,lev_type='full').reshape((-1,)+ps.shape) #Keep the time axis if there is only one timestep
+    p_3D=p_3D.transpose(lev_T_out)# p_3D [lev,tim,lat,lon] ->[tim, lev, lat, lon]
     return p_3D.reshape(shape_out)
 
 def compute_rho(p_3D,temp):
@@ -245,7 +303,7 @@ def compute_zfull(ps,ak,bk,temp):
     Compute the altitude AGL in [m]
     """
     dim_out=temp.shape
-    zfull=fms_Z_calc(ps,ak,bk,temp.transpose(lev_T),topo=0.,lev_type='full') # (lev, time, tod, lat,lon)
+    zfull=fms_Z_calc(ps,ak,bk,temp.transpose(np.argsort(lev_T_out)),topo=0.,lev_type='full').reshape((-1,)+ps.shape) # (lev, time, tod, lat,lon)
     zfull=zfull.transpose(lev_T_out)# p_3D [lev,tim,lat,lon] ->[tim, lev, lat, lon] # temp: [tim,tod,lev,lat,lon,lev] ->[lev,time, tod,lat, lon]
     return zfull
 
@@ -254,7 +312,7 @@ def compute_zhalf(ps,ak,bk,temp):
     Compute the altitude AGL in [m]
     """
     dim_out=temp.shape
-    zhalf=fms_Z_calc(ps,ak,bk,temp.transpose(lev_T),topo=0.,lev_type='half') # temp: [tim,lev,lat,lon,lev] ->[lev,time, lat, lon]
+    zhalf=fms_Z_calc(ps,ak,bk,temp.transpose(np.argsort(lev_T_out)),topo=0.,lev_type='half').reshape((-1,)+ps.shape) # temp: [tim,lev,lat,lon,lev] ->[lev,time, lat, lon]
     zhalf=zhalf.transpose(lev_T_out)# p_3D [lev+1,tim,lat,lon] ->[tim, lev+1, lat, lon]
     return zhalf
 
@@ -333,13 +391,34 @@ def compute_scorer(N,ucomp,zfull):
     scorer2= N**2/ucomp**2 -1./ucomp*dudz2
     return 2*np.pi/np.sqrt(scorer2)
 
+def compute_Ri(N,ucomp,vcomp,zfull):
+    """
+    Compute the Richardson number
+    """
+    du_dz=dvar_dh(ucomp.transpose(lev_T),zfull.transpose(lev_T)).transpose(lev_T)
+    dv_dz=dvar_dh(vcomp.transpose(lev_T),zfull.transpose(lev_T)).transpose(lev_T)
+    return N**2/(du_dz**2+dv_dz**2)
+
+def compute_msf(vcomp,lat,lev,f_type,interp_type):
+    """
+    Compute the mass stream function in [1.e8 x kg/s]
+    """
+    if f_type=='diurn':
+        #[time,tod,lev,lat,lon] > [lev,lat,time,tod,lon]  >  [time,tod,lev,lat,lon]
+        #  0    1   2   3   4       2   3    0   1   4         2    3   0   1   4
+        return mass_stream(vcomp.transpose([2,3,0,1,4]),lat,lev,type=interp_type).transpose([2,3,0,1,4])
+    else:
+        #[time,lev,lat,lon] > [lev,lat,lon,time]  >  [time,lev,lat,lon]
+        #  0    1   2   3       1   2    3   0         3    0   1   2
+        return mass_stream(vcomp.transpose([1,2,3,0]),lat,lev,type=interp_type).transpose([3,0,1,2])
+
 def compute_DP_3D(ps,ak,bk,shape_out):
     """
     Compute the thickness of a layer in [Pa]
     """
-    p_half3D= fms_press_calc(ps,ak,bk,lev_type='half') #[lev,tim,lat,lon]
+    p_half3D= fms_press_calc(ps,ak,bk,lev_type='half').reshape((-1,)+ps.shape) #[lev,tim,lat,lon]
     DP_3D=p_half3D[1:,...,]- p_half3D[0:-1,...]
-    DP_3D=DP_3D.transpose(lev_T)# p_3D [lev,tim,lat,lon] ->[tim, lev, lat, lon]
+    DP_3D=DP_3D.transpose(lev_T_out)# p_3D [lev,tim,lat,lon] ->[tim, lev, lat, lon]
     out=DP_3D.reshape(shape_out)
     return out
 
@@ -347,9 +426,9 @@ def compute_DZ_3D(ps,ak,bk,temp,shape_out):
     """
     Compute the thickness of a layer in [Pa]
     """
-    z_half3D= fms_Z_calc(ps,ak,bk,temp.transpose(lev_T),topo=0.,lev_type='half')
+    z_half3D= fms_Z_calc(ps,ak,bk,temp.transpose(np.argsort(lev_T_out)),topo=0.,lev_type='half').reshape((-1,)+ps.shape)
     DZ_3D=z_half3D[0:-1,...]-z_half3D[1:,...,] #Note the reverse order as Z decreases with increasing levels
-    DZ_3D=DZ_3D.transpose(lev_T)# DZ_3D [lev,tim,lat,lon] ->[tim, lev, lat, lon]
+    DZ_3D=DZ_3D.transpose(lev_T_out)# DZ_3D [lev,tim,lat,lon] ->[tim, lev, lat, lon]
     out=DZ_3D.reshape(shape_out)
     return out
 
@@ -434,9 +513,159 @@ def compute_w_net(Vg, wvar):
        
         
         
+def file_deps(fileNC,interp_type):
+    '''
+    Return the inputs and functions of VAR_DEPS, updated for a file.
+    Args:
+        fileNC     : netCDF4 file
+        interp_type: vertical grid of the file, 'pfull', 'pstd', 'zstd' or 'zagl'
+    Returns:
+        deps (dict): same as VAR_DEPS. The 3D pressure depends on the vertical grid, and the aerosols are read from the
+                     *_micro variables if those are present in the file
+    '''
+    deps=dict(VAR_DEPS)
+    #If using 'pstd', calculating the 3D pressure field is easy
+    if interp_type=='pstd':
+        deps['p_3D']=[['lev','lev_axis','shape_out'],lambda lev,lev_axis,shape_out:lev.reshape([len(lev) if i==lev_axis else 1 for i in range(0,len(shape_out))])] #e.g [1,28,1,1]
+    #If inter_type is 'zstd', or 'zagl', we need the field pfull3D  pre-computed before interpolation.
+    elif interp_type!='pfull':
+        deps['p_3D']=[['file:pfull3D'],lambda p_3D:p_3D]
+    for ivar,iname in [('q_dst','dst_mass'),('n_dst','dst_num'),('q_ice','ice_mass')]:
+        if iname+'_micro' in fileNC.variables.keys():deps[ivar]=[['file:'+iname+'_micro'],lambda x:x]
+    return deps
+
+def time_chunk(shape_out,nfields=1,chunk=None,max_mem=None):
+    '''
+    Return the number of timesteps processed at the time.
+    Args:
+        shape_out: shape of the new variables, with time first
+        nfields  : number of arrays involved in the computation, see Var_evaluator.nfields()
+        chunk    : number of timesteps requested with --chunk
+        max_mem  : memory budget in [MB] requested with --max_mem
+    Returns:
+        nchunk (int): number of timesteps, all the timesteps if neither chunk nor max_mem is provided
+    ***NOTE***
+    With max_mem, each array is assumed to be the size of the new variables in double precision, which is an upper bound.
+    '''
+    nt=shape_out[0]
+    if chunk:return max(1,min(chunk,nt))
+    if max_mem is None:return nt
+    nbytes_step=8*int(np.prod(shape_out[1:]))*max(1,nfields)
+    return max(1,min(nt,int(max_mem*1.e6//nbytes_step)))
+
+class Var_evaluator(object):
+    '''
+    Compute the requested variables and their inputs, following the dependencies declared in VAR_DEPS.
+    Args:
+        fileNC : netCDF4 file, the variables that are not computed are read from this file
+        deps   : inputs and function for each field, see VAR_DEPS and file_deps()
+        context: fields known for this file, e.g. {'ak':ak,'bk':bk,'f_type':'average'}
+        tslice : timesteps to read for the variables with a time dimension, e.g. slice(0,10), see time_chunk()
+    ***NOTE***
+    Each field is computed or read only once. plan() counts how many times each field is used for the requested variables,
+    and a field is only kept in memory until its last use, so large intermediate arrays are released as soon as possible.
+    Example:
+        evaluator=Var_evaluator(fileNC,file_deps(fileNC,'pfull'),{'ak':ak,...})
+        evaluator.plan(['N','Ri'])
+        N=evaluator.get('N');evaluator.release('N') #theta and zfull are computed once, for both N and Ri
+    '''
+    def __init__(self,fileNC,deps,context={},tslice=slice(None)):
+        self.fileNC=fileNC
+        self.tslice=tslice
+        self.deps=deps
+        self.context=dict(context)
+        self.memo={}
+        self.nuse={} #Number of remaining uses of each field
+
+    def _inputs(self,name):
+        if name in self.context or name not in self.deps:return []
+        return self.deps[name][0]
+
+    def plan(self,var_list):
+        '''
+        Count the number of times each field is used to compute the variables in var_list (the request itself counts as one use)
+        '''
+        visited=set()
+        def visit(name):
+            if name in visited:return
+            visited.add(name)
+            for iname in self._inputs(name):
+                self.nuse[iname]=self.nuse.get(iname,0)+1
+                visit(iname)
+        for ivar in var_list:
+            self.nuse[ivar]=self.nuse.get(ivar,0)+1
+            visit(ivar)
+
+    def get(self,name):
+        '''
+        Return a field, computing its inputs if needed. The field is kept in memory if it is used again.
+        '''
+        if name in self.context:return self.context[name]
+        if name in self.memo:return self.memo[name]
+        if name in self.deps:
+            inputs,function=self.deps[name]
+            value=function(*[self.get(iname) for iname in inputs])
+            for iname in inputs:self.release(iname)
+        else:
+            name_file=name[5:] if name.startswith('file:') else name
+            if name_file not in self.fileNC.variables.keys():
+                raise KeyError("variable '%s' is not present in the file"%(name_file))
+            var_Ncdf=self.fileNC.variables[name_file]
+            value=var_Ncdf[self.tslice,...] if var_Ncdf.dimensions[0:1]==('time',) else var_Ncdf[:]
+        if self.nuse.get(name,0)>0:self.memo[name]=value
+        return value
+
+    def release(self,name):
+        '''
+        Signal that a field has been used once, the field is removed from memory after its last use.
+        '''
+        if name in self.context:return
+        self.nuse[name]=self.nuse.get(name,0)-1
+        if self.nuse[name]<=0:self.memo.pop(name,None)
+
+    def nfields(self):
+        '''
+        Return the number of arrays involved in the computation (variables, intermediate fields and inputs), after plan()
+        '''
+        return len([iname for iname in self.nuse.keys() if iname not in self.context])
+
+    def is_shared(self,name,value):
+        '''
+        Return True if the array is still needed after this use, or shares its memory with another field, e.g. 'pfull3D' and 'p_3D'.
+        An array must be copied before being modified in place in those cases.
+        '''
+        if self.nuse.get(name,0)>1:return True
+        others=[]
+        for iname,ivalue in list(self.memo.items())+list(self.context.items()):
+            if iname!=name:others.extend(ivalue if isinstance(ivalue,tuple) else [ivalue])
+        return any([np.may_share_memory(np.ma.getdata(value),np.ma.getdata(ivalue)) for ivalue in others if isinstance(ivalue,np.ndarray)])
+
 def main():
     #load all the .nc files
     file_list=parser.parse_args().input_file
+    args=parser.parse_args()
+
+    #Check if an operation is requested, otherwise print file content.
+    if not (args.add or args.zdiff or args.zonal_detrend or args.remove or args.col or args.extract or args.dp_to_dz or args.dz_to_dp or args.edit):
+        print_fileContent(file_list[0])
+        prYellow(''' ***Notice***  No operation requested, use '-add var',  '-zdiff var','-zd var', '-col var', '-dp_to_dz var', '-rm var' '-edit var' ''')
+        exit() #Exit cleanly
+
+    if args.jobs>1:
+        #The files are updated in place, or written to *_extract.nc, so two jobs only write the same output if they process the same file
+        output_list=[[ifile,ifile[:-3]+'_extract.nc'] for ifile in file_list]
+        run_file_jobs(process_one_file,file_list,args.jobs,output_list)
+    else:
+        process_files(file_list)
+
+def process_one_file(ifile):
+    '''
+    Apply the requested operations to a single file, this is the function executed by each job when --jobs is used
+    '''
+    process_files([ifile])
+
+def process_files(file_list):
+    set_precision(parser.parse_args().precision)
     add_list=parser.parse_args().add
     zdiff_list=parser.parse_args().zdiff
     zdetrend_list=parser.parse_args().zonal_detrend
@@ -451,12 +680,6 @@ def main():
     global lev_T #an array to swap vertical axis first and back: [1,0,2,3] for [time,lev,lat,lon], and [2,1,0,3,4]for [tim, tod,lev, lat, lon]
     global lev_T_out #reshape in zfull, zhalf calculation
 
-    #Check if an operation is requested, otherwise print file content.
-    if not (add_list or zdiff_list or zdetrend_list or remove_list or col_list or extract_list or dp_to_dz_list or dz_to_dp_list or edit_var):
-        print_fileContent(file_list[0])
-        prYellow(''' ***Notice***  No operation requested, use '-add var',  '-zdiff var','-zd var', '-col var', '-dp_to_dz var', '-rm var' '-edit var' ''')
-        exit() #Exit cleanly
-
     #For all the files
     for ifile in file_list:
         #First check if file is present on the disk (Lou only)
@@ -467,28 +690,27 @@ def main():
         #=================================================================
 
         if remove_list:
-            cmd_txt='ncks --version'
-            try:
-                #If ncks is available, use it:--
-                subprocess.check_call(cmd_txt,shell=True,stdout=open(os.devnull, "w"), stderr=open(os.devnull, "w"))
-                for ivar in remove_list:
-                    print('Creating new file %s without %s:'%(ifile,ivar))
-                    cmd_txt='ncks -C -O -x -v %s %s %s'%(ivar,ifile,ifile)
-                    try:
-                        subprocess.check_call(cmd_txt,shell=True,stdout=open(os.devnull, "w"), stderr=open(os.devnull, "w"))
-                    except Exception as exception:
-                        print(exception.__class__.__name__ + ": " + exception.message)
-            #ncks is not available, we use internal method.
-            except subprocess.CalledProcessError:
-                f_IN=Dataset(ifile, 'r', format='NETCDF4_CLASSIC')
+            f_IN=Dataset(ifile, 'r', format='NETCDF4_CLASSIC')
+            missing_list=[ivar for ivar in remove_list if ivar not in f_IN.variables.keys()]
+            f_IN.close()
+            for ivar in missing_list:prYellow('***Warning*** %s not found in %s'%(ivar,ifile))
+            remove_now=[ivar for ivar in remove_list if ivar not in missing_list]
+            if remove_now:
+                #NetCDF does not support deleting variables, all the variables are removed with a single rewrite of the file
+                print('Creating new file %s without %s:'%(ifile,', '.join(remove_now)))
                 ifile_tmp=ifile[:-3]+'_tmp'+'.nc'
-                Log=Ncdf(ifile_tmp,'Edited in postprocessing')
-                Log.copy_all_dims_from_Ncfile(f_IN)
-                Log.copy_all_vars_from_Ncfile(f_IN,remove_list)
-                f_IN.close()
-                Log.close()
-                cmd_txt='mv '+ifile_tmp+' '+ifile
-                p = subprocess.run(cmd_txt, universal_newlines=True, shell=True)
+                try:
+                    #If ncks is available, use it:--
+                    subprocess.check_call(['ncks','-C','-O','-x','-v',','.join(remove_now),ifile,ifile_tmp],stdout=open(os.devnull, "w"), stderr=open(os.devnull, "w"))
+                #ncks is not available, we use internal method.
+                except (OSError,subprocess.CalledProcessError):
+                    f_IN=Dataset(ifile, 'r', format='NETCDF4_CLASSIC')
+                    Log=Ncdf(ifile_tmp,'Edited in postprocessing')
+                    Log.copy_all_dims_from_Ncfile(f_IN)
+                    Log.copy_all_vars_from_Ncfile(f_IN,remove_now)
+                    f_IN.close()
+                    Log.close()
+                os.replace(ifile_tmp,ifile)
                 prCyan(ifile+' was updated')
 
         #=================================================================
@@ -518,221 +740,89 @@ def main():
             ak=f_fixed.variables['pk'][:]
             bk=f_fixed.variables['bk'][:]
             f_fixed.close()
-        #----
-            #----Check if the variable is currently supported---
-        for ivar in add_list:
-            if ivar not in VAR.keys():
-                 prRed("Variable '%s' is not supported"%(ivar))
-            else:
-                print('Processing: %s...'%(ivar))
-                try:
-                    fileNC=Dataset(ifile, 'a', format='NETCDF4_CLASSIC')
-                    f_type,interp_type=FV3_file_type(fileNC)
-                    #---temp and ps are always needed---
-                    dim_out=fileNC.variables['temp'].dimensions #get dimension
-                    temp=fileNC.variables['temp'][:]
-                    shape_out=temp.shape
-                    if f_type=='diurn':
-                        lev_T= [2,1,0,3,4] # [tim, tod,lev, lat, lon] >[lev,tod,time,lat,lon] > [time, tod,lev, lat, lon]
-                        #                      0    1   2    3    4      2   1    0   3   4       2    1   0    3    4
-                        lev_T_out=[1,2,0,3,4]
-                        lev_axis=2 # in atmos_diurn,the levels is the 3rd axis" (time,tod,lev,lat,lon)
-                    else:
-                        lev_T= [1,0,2,3] # [tim,lev, lat, lon] > [lev,time,lat,lon] > [tim,lev,lat,lon]
-                        #                    0   1   2    3        1   0    2    3      1  0    2     3
-                        lev_T_out=lev_T
-                        lev_axis=1 # in atmos_average, atmos_daily, the levels is the 2nd axis" (time,lev,lat,lon)
-
-                    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-                    #~~~~~~~~~~~~  Non interpolated files ~~~~~~~~~~~~~~~~~
-                    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-
-                    #These are often needed so we will calculate once here
-                    if interp_type=='pfull':
-                        ps=fileNC.variables['ps'][:]
-                        p_3D=compute_p_3D(ps,ak,bk,shape_out)
-
-                    #If using 'pstd', calculating the 3D pressure field is easy
-                    elif interp_type=='pstd':
-                        lev=fileNC.variables['pstd'][:]
-                        reshape_shape=[1 for i in range(0,len(shape_out))]                 #(  0   1   2   3 )
-                        reshape_shape[lev_axis]=len(lev)  #e.g [1,28,1,1]
-                        p_3D=lev.reshape(reshape_shape)
-                    #If inter_type is 'zstd', or 'zagl', we need the field pfull3D  pre-computed before interpolation.
-                    # We use a 'try' statement as some computations (e.g. wind speed) do not require pfull and will work anyway
-                    else:
-                        try:
-                            p_3D=fileNC.variables['pfull3D'][:]
-                        except:
-                            pass
-
-                    if ivar=='pfull3D': OUT=p_3D
-                    if ivar=='DP':      OUT=compute_DP_3D(ps,ak,bk,shape_out)
-                    if ivar=='rho':
-                        OUT=compute_rho(p_3D,temp)
-                    if ivar=='theta':
-                        OUT=compute_theta(p_3D,ps,temp,f_type)
-                    if ivar=='w':
-                        omega=fileNC.variables['omega'][:]
-                        rho=compute_rho(p_3D,temp)
-                        OUT=compute_w(rho,omega)
-
-                    if ivar=='zfull': OUT=compute_zfull(ps,ak,bk,temp) #TODO not with _pstd
-                    if ivar=='DZ': OUT=compute_DZ_3D(ps,ak,bk,temp,shape_out)
-
-                    if ivar=='wspeed' or ivar=='wdir':
-                        ucomp=fileNC.variables['ucomp'][:]
-                        vcomp=fileNC.variables['vcomp'][:]
-                        theta,mag=cart_to_azimut_TR(ucomp,vcomp,mode='from')
-                        if ivar=='wdir':OUT=theta
-                        if ivar=='wspeed':OUT=mag
-
-                    if ivar=='N':
-                        theta=compute_theta(p_3D,ps,temp,f_type)
-                        zfull=compute_zfull(ps,ak,bk,temp)  #TODO not with _pstd
-                        OUT=compute_N(theta,zfull)
-
-                    if ivar=='Ri':
-                        theta=compute_theta(p_3D,ps,temp,f_type)
-                        zfull=compute_zfull(ps,ak,bk,temp) #TODO not with _pstd
-                        N=compute_N(theta,zfull)
-
-                        ucomp=fileNC.variables['ucomp'][:]
-                        vcomp=fileNC.variables['vcomp'][:]
-                        du_dz=dvar_dh(ucomp.transpose(lev_T),zfull.transpose(lev_T)).transpose(lev_T)
-                        dv_dz=dvar_dh(vcomp.transpose(lev_T),zfull.transpose(lev_T)).transpose(lev_T)
-                        OUT=N**2/(du_dz**2+dv_dz**2)
-
-                    if ivar=='Tco2':OUT=compute_Tco2(p_3D,temp)
-
-                    if ivar=='scorer_wl':
-                        ucomp=fileNC.variables['ucomp'][:]
-                        theta=compute_theta(p_3D,ps,temp,f_type)
-                        zfull=compute_zfull(ps,ak,bk,temp)
-                        N=compute_N(theta,zfull)
-                        OUT=compute_scorer(N,ucomp,zfull)
-
-                    if ivar in ['div','curl','fn']:
-                        lat=fileNC.variables['lat'][:]
-                        lon=fileNC.variables['lon'][:]
-                        ucomp=fileNC.variables['ucomp'][:]
-                        vcomp=fileNC.variables['vcomp'][:]
-
-                    if ivar =='div': OUT=spherical_div(ucomp,vcomp,lon,lat,R=3400*1000.,spacing='regular')
-                    if ivar =='curl':OUT=spherical_curl(ucomp,vcomp,lon,lat,R=3400*1000.,spacing='regular')
-                    if ivar =='fn':
-                        theta=fileNC.variables['theta'][:]
-                        OUT=frontogenesis(ucomp,vcomp,theta,lon,lat,R=3400*1000.,spacing='regular')
-
-                    if ivar == 'dzTau':
-                        if 'dst_mass_micro' in fileNC.variables.keys():
-                            q = fileNC.variables['dst_mass_micro'][:]
-                        elif 'dst_mass' in fileNC.variables.keys():
-                            q = fileNC.variables['dst_mass'][:]
-                        else:
-                            prYellow("""***Error*** dst_mass or dst_mass_micro not present in file""")  
-                        OUT = compute_xzTau(q, temp, p_3D, C_dst, f_type)
-
-                    if ivar == 'izTau':
-                        if 'ice_mass_micro' in fileNC.variables.keys():
-                            q = fileNC.variables['ice_mass_micro'][:]
-                        elif 'ice_mass' in fileNC.variables.keys():
-                            q = fileNC.variables['ice_mass'][:]
-                        else:
-                            prYellow("""***Error*** ice_mass or ice_mass_micro not present in file""")    
-                        OUT = compute_xzTau(q, temp, p_3D, C_ice, f_type)
-
-                    if ivar == 'dst_mass':
-                        xTau = fileNC.variables['dzTau'][:]
-                        OUT = compute_mmr(xTau, temp, p_3D, C_dst)
-
-                    if ivar == 'ice_mass':
-                        xTau = fileNC.variables['izTau'][:]
-                        OUT = compute_mmr(xTau, temp, p_3D, C_ice)
-
-                    if ivar == 'Vg_sed':
-                        if 'dst_mass_micro' in fileNC.variables.keys():
-                            xTau = fileNC.variables['dst_mass_micro'][:]
-                            nTau = fileNC.variables['dst_num_micro'][:]
-                        elif 'dst_mass' in fileNC.variables.keys():
-                            xTau = fileNC.variables['dst_mass'][:]
-                            nTau = fileNC.variables['dst_num'][:]
-                        else:    
-                            prYellow("""***Error*** dst_mass or dst_mass_micro not present in file""")    
-                        OUT = compute_Vg_sed(xTau, nTau, temp)
-
-                    if ivar == 'w_net':
-                        Vg = fileNC.variables['Vg_sed'][:]
-                        wvar = fileNC.variables['w'][:]
-                        OUT = compute_w_net(Vg, wvar)
-                    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-                    #~~~~~~~~~~~~~~~   Interpolated files ~~~~~~~~~~~~~~~~~~~
-                    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-
-                    #Common to all interpolated files:
-                    if interp_type!='pfull':
-                        lev=fileNC.variables[interp_type][:]
-
-                    if ivar=='msf':
-                        vcomp=fileNC.variables['vcomp'][:]
-                        lat=fileNC.variables['lat'][:]
-                        if f_type=='diurn':
-                            #[time,tod,lev,lat,lon] > [lev,lat,time,tod,lon]  >  [time,tod,lev,lat,lon]
-                            #  0    1   2   3   4       2   3    0   1   4         2    3   0   1   4
-                            OUT=mass_stream(vcomp.transpose([2,3,0,1,4]),lat,lev,type=interp_type).transpose([2,3,0,1,4])
-                        else:
-                            #[time,lev,lat,lon] > [lev,lat,lon,time]  >  [time,lev,lat,lon]
-                            #  0    1   2   3       1   2    3   0         3    0   1   2
-                            OUT=mass_stream(vcomp.transpose([1,2,3,0]),lat,lev,type=interp_type).transpose([3,0,1,2])
-
-                    if ivar=='ep':
-                        #TODO    N=fileNC.variables['N'][:]  >>> Replaced by constant N=0.01
-                        OUT=compute_Ep(temp)
-                    if ivar=='ek':
-                        ucomp=fileNC.variables['ucomp'][:]
-                        vcomp=fileNC.variables['vcomp'][:]
-                        OUT=compute_Ek(ucomp,vcomp)
-
-                    if ivar=='mx':OUT=compute_MF(fileNC.variables['ucomp'][:],fileNC.variables['w'][:])
-
-                    if ivar=='my':OUT=compute_MF(fileNC.variables['vcomp'][:],fileNC.variables['w'][:])
-
-                    if ivar=='ax':
-                        mx=compute_MF(fileNC.variables['ucomp'][:],fileNC.variables['w'][:])
-                        rho=fileNC.variables['rho'][:]
-                        OUT=compute_WMFF(mx,rho,lev,interp_type)
-
-                    if ivar=='ay':
-                        my=compute_MF(fileNC.variables['vcomp'][:],fileNC.variables['w'][:])
-                        rho=fileNC.variables['rho'][:]
-                        OUT=compute_WMFF(my,rho,lev,interp_type)
-
-                    if ivar=='tp_t':OUT=zonal_detrend(temp)/temp
 
-                    #filter nan for native files
-                    if interp_type=='pfull':
-                        OUT[np.isnan(OUT)]=fill_value
-
-                    #Add nan for interpolated file
-                    else :
-                        with warnings.catch_warnings():
-                            warnings.simplefilter("ignore", category=RuntimeWarning)
-                            OUT[OUT>1.e30]=np.NaN
-                            OUT[OUT<-1.e30]=np.NaN
+            #All the variables are added with the file opened once
+            fileNC=Dataset(ifile, 'a', format='NETCDF4_CLASSIC')
+            f_type,interp_type=FV3_file_type(fileNC)
+            #---temp has the dimensions of all the new variables---
+            dim_out=fileNC.variables['temp'].dimensions #get dimension
+            shape_out=fileNC.variables['temp'].shape
+            if f_type=='diurn':
+                lev_T= [2,1,0,3,4] # [tim, tod,lev, lat, lon] >[lev,tod,time,lat,lon] > [time, tod,lev, lat, lon]
+                #                      0    1   2    3    4      2   1    0   3   4       2    1   0    3    4
+                lev_T_out=[1,2,0,3,4]
+                lev_axis=2 # in atmos_diurn,the levels is the 3rd axis" (time,tod,lev,lat,lon)
+            else:
+                lev_T= [1,0,2,3] # [tim,lev, lat, lon] > [lev,time,lat,lon] > [tim,lev,lat,lon]
+                #                    0   1   2    3        1   0    2    3      1  0    2     3
+                lev_T_out=lev_T
+                lev_axis=1 # in atmos_average, atmos_daily, the levels is the 2nd axis" (time,lev,lat,lon)
 
-                    #Log the variable
-                    var_Ncdf = fileNC.createVariable(ivar,'f4',dim_out)
-                    var_Ncdf.long_name=VAR[ivar][0]
-                    var_Ncdf.units=    VAR[ivar][1]
-                    var_Ncdf[:]= OUT
-                    fileNC.close()
+            context={'ak':ak,'bk':bk,'f_type':f_type,'interp_type':interp_type,'shape_out':shape_out,'lev_axis':lev_axis}
+            #Common to all interpolated files:
+            if interp_type!='pfull':context['lev']=fileNC.variables[interp_type][:]
 
-                    print('%s: \033[92mDone\033[00m'%(ivar))
-                except Exception as exception:
-                    if debug:raise
-                    if str(exception)=='NetCDF: String match to name in use':
-                        prYellow("""***Error*** Variable already exists""")
-                        prYellow("""Delete existing variables %s with 'MarsVars.py %s -rm %s'"""%(ivar,ifile,ivar))
+            #----Check if the variable is currently supported---
+            var_list=[]
+            for ivar in add_list:
+                if ivar not in VAR.keys():
+                    prRed("Variable '%s' is not supported"%(ivar))
+                elif ivar in fileNC.variables.keys():
+                    prYellow("""***Error*** Variable already exists""")
+                    prYellow("""Delete existing variables %s with 'MarsVars.py %s -rm %s'"""%(ivar,ifile,ivar))
+                elif ivar not in var_list:
+                    var_list.append(ivar)
+
+            deps=file_deps(fileNC,interp_type)
+            evaluator=Var_evaluator(fileNC,deps,context)
+            evaluator.plan(var_list)
+            #The variables are computed by slabs of nchunk timesteps and written slab by slab, see --chunk and --max_mem
+            nt=shape_out[0]
+            nchunk=time_chunk(shape_out,evaluator.nfields(),parser.parse_args().chunk,parser.parse_args().max_mem)
+            if var_list and nchunk<nt:prCyan('Processing %i timesteps at the time'%(nchunk))
+
+            for t0 in range(0,nt,nchunk):
+                t1=min(t0+nchunk,nt)
+                #Intermediate fields are shared between the variables within a slab
+                context['shape_out']=(t1-t0,)+tuple(shape_out[1:])
+                evaluator=Var_evaluator(fileNC,deps,context,slice(t0,t1))
+                evaluator.plan(var_list)
+                for ivar in list(var_list):
+                    if t0==0:print('Processing: %s...'%(ivar))
+                    try:
+                        OUT=evaluator.get(ivar)
+                        #The array is modified in place below, use a copy if it is still needed for another variable
+                        if evaluator.is_shared(ivar,OUT):OUT=OUT.copy()
+
+                        #filter nan for native files
+                        if interp_type=='pfull':
+                            OUT[np.isnan(OUT)]=fill_value
+
+                        #Add nan for interpolated file
+                        else :
+                            with warnings.catch_warnings():
+                                warnings.simplefilter("ignore", category=RuntimeWarning)
+                                OUT[OUT>1.e30]=np.NaN
+                                OUT[OUT<-1.e30]=np.NaN
+
+                        #Fields derived from the vertical grid only (e.g. pfull3D in pstd files) are broadcasted to the full shape
+                        if OUT.shape!=context['shape_out']:OUT=np.broadcast_to(OUT,context['shape_out'])
+
+                        #Log the variable
+                        if t0==0:
+                            var_Ncdf = fileNC.createVariable(ivar,'f4',dim_out)
+                            var_Ncdf.long_name=VAR[ivar][0]
+                            var_Ncdf.units=    VAR[ivar][1]
+                        fileNC.variables[ivar][t0:t1,...]= OUT
+
+                        if t1==nt:print('%s: \033[92mDone\033[00m'%(ivar))
+                    except Exception as exception:
+                        if debug:raise
+                        prRed('***Error*** %s could not be computed: %s'%(ivar,exception))
+                        if t0>0:prYellow("The values after timestep %i are missing, remove %s with 'MarsVars.py %s -rm %s'"%(t0,ivar,ifile,ivar))
+                        var_list.remove(ivar)
+                    evaluator.release(ivar)
+            fileNC.close()
 
         #=================================================================
         #=============Vertical Differentiation action=====================
@@ -976,43 +1066,46 @@ def main():
                         prYellow("""Delete existing variable %s with 'MarsVars %s -rm %s'"""%(icol+'_col',ifile,icol+'_col'))
 
         if edit_var:
-            f_IN=Dataset(ifile, 'r', format='NETCDF4_CLASSIC')
-            ifile_tmp=ifile[:-3]+'_tmp.nc'
-            Log=Ncdf(ifile_tmp,'Edited in postprocessing')
-            Log.copy_all_dims_from_Ncfile(f_IN)
-            #Copy all variable but this one
-            Log.copy_all_vars_from_Ncfile(f_IN,exclude_var=edit_var)
-            #Read value, longname, units, name, and log new variable
+            #The file is edited in place, the other variables are not rewritten
+            f_IN=Dataset(ifile, 'a')
+            if edit_var not in f_IN.variables.keys():
+                prRed('***Error*** %s not found in %s'%(edit_var,ifile))
+                f_IN.close()
+                continue
             var_Ncdf=f_IN.variables[edit_var]
-            
-            name_txt=edit_var
-            vals= var_Ncdf[:]
-            dim_out=var_Ncdf.dimensions 
-            longname_txt=getattr(var_Ncdf,'long_name','')
-            units_txt=getattr(var_Ncdf,'units','')
-            cart_txt=getattr(var_Ncdf,'cartesian_axis','')
-            
-            if parser.parse_args().rename:  name_txt=parser.parse_args().rename
-            if parser.parse_args().longname:longname_txt=parser.parse_args().longname
-            if parser.parse_args().unit:    units_txt=parser.parse_args().unit
-            if parser.parse_args().multiply:vals*=parser.parse_args().multiply
-            
-            if cart_txt == '':
-                Log.log_variable(name_txt,vals,dim_out,longname_txt,units_txt)
-            else:
-                Log.log_axis1D(name_txt,vals,dim_out,longname_txt,units_txt,cart_txt)
-                    
+            try:
+                if parser.parse_args().multiply:scale_variable(var_Ncdf,parser.parse_args().multiply)
+                if parser.parse_args().longname:var_Ncdf.long_name=parser.parse_args().longname
+                if parser.parse_args().unit:    var_Ncdf.units=parser.parse_args().unit
+                if parser.parse_args().rename:  f_IN.renameVariable(edit_var,parser.parse_args().rename)
+                prCyan(ifile+' was updated')
+            except Exception as exception:
+                if debug:raise
+                if str(exception)=='NetCDF: String match to name in use':
+                    prYellow("""***Error*** Variable %s already exists"""%(parser.parse_args().rename))
+                else:
+                    prRed('***Error*** while editing %s: %s'%(edit_var,exception))
             f_IN.close()
-            Log.close()
-            
-            #Rename the new file
-            cmd_txt='mv '+ifile_tmp+' '+ifile
-            subprocess.call(cmd_txt,shell=True)
-            
-            prCyan(ifile+' was updated')
-            
-            
-            
+
+def scale_variable(var_Ncdf,factor,max_mem=500.):
+    '''
+    Multiply a variable by a factor in place, reading and writing the data by slabs along the first dimension.
+    Args:
+        var_Ncdf: netCDF4 variable, from a file opened in 'a' mode
+        factor  : multiplication factor
+        max_mem : maximum size of one slab in [MB]
+    '''
+    if var_Ncdf.ndim==0:
+        var_Ncdf[...]=var_Ncdf[...]*factor
+        return
+    nbytes_row=var_Ncdf.dtype.itemsize*int(np.prod(var_Ncdf.shape[1:]))
+    nstep=max(1,int(max_mem*1.e6//nbytes_row))
+    n0=var_Ncdf.shape[0]
+    for t0 in range(0,n0,nstep):
+        #Do not write past the end, the first dimension may be unlimited
+        t1=min(t0+nstep,n0)
+        var_Ncdf[t0:t1,...]=var_Ncdf[t0:t1,...]*factor
+
 if __name__ == '__main__':
     main()
 #